@@ -10,7 +10,13 @@ from pyqstrat.strategy import *
 from pyqstrat.strategy_builder import *
 from pyqstrat.strategy_components import *
 from pyqstrat.portfolio import *
+from pyqstrat.shared_data import *
+from pyqstrat.thread_budget import *
+from pyqstrat.worker_pool import *
 from pyqstrat.optimize import *
+from pyqstrat.walk_forward import *
+from pyqstrat.purged_cv import *
+from pyqstrat.distributed import *
 from pyqstrat.interactive_plot import *
 from pyqstrat.evaluator import *
 from pyqstrat.pyqstrat_cpp import *
@@ -375,6 +375,7 @@ class Account:
         self.contracts: dict[str, Contract] = {}
         self._trades: list[Trade] = []
         self._trades_for_date: dict[tuple[str, np.datetime64], list[Trade]] = defaultdict(list)
+        self._num_trades_for_cgroup_date: dict[tuple[str, np.datetime64], int] = defaultdict(int)
         self._pnl = SortedDict()
         self.symbol_pnls_by_contract_group: dict[str, list[ContractPNL]] = defaultdict(list)
         
@@ -406,7 +407,9 @@ class Account:
             self.symbol_pnls[symbol]._add_trades(contract_trades)
             
         for trade in trades:
-            self._trades_for_date[(contract.symbol, trade.timestamp.astype('M8[D]'))].append(trade)
+            date = trade.timestamp.astype('M8[D]')
+            self._trades_for_date[(trade.contract.symbol, date)].append(trade)
+            self._num_trades_for_cgroup_date[(trade.contract.contract_group.name, date)] += 1
             
         self._trades += trades
         
@@ -473,6 +476,10 @@ class Account:
         if ret is None: return []
         return ret
     
+    def num_trades_for_date(self, contract_group: ContractGroup, date: np.datetime64) -> int:
+        '''Returns the number of trades for contracts in a contract group on the given date'''
+        return self._num_trades_for_cgroup_date.get((contract_group.name, date.astype('M8[D]')), 0)
+    
     def trades(self,
                contract_group: ContractGroup | None = None, 
                start_date: np.datetime64 = NAT, 
@@ -569,6 +576,24 @@ class Account:
         df['equity'] = self.starting_equity + df.net_pnl
         return df[['timestamp', 'position', 'unrealized', 'realized', 'commission', 'fee', 'net_pnl', 'equity']]
     
+    def net_pnl_array(self, timestamps: np.ndarray) -> np.ndarray:
+        '''
+        Returns net pnl summed over all contracts at each timestamp.  Like df_account_pnl, this uses the most recent
+        pnl computed at or before each timestamp, but looks it up for all timestamps at once instead of one by one.
+        
+        Args:
+            timestamps: Sorted timestamps to return net pnl for
+        '''
+        net_pnl = np.zeros(len(timestamps))
+        for symbol_pnl in self.symbol_pnls.values():
+            if not len(symbol_pnl._net_pnl): continue
+            pnl_timestamps = np.array(list(symbol_pnl._net_pnl.keys()))
+            pnl_values = np.array([v[3] for v in symbol_pnl._net_pnl.values()], dtype=float)
+            pnl_values = np.where(np.isfinite(pnl_values), pnl_values, 0.)
+            indices = np.searchsorted(pnl_timestamps, timestamps, side='right') - 1
+            net_pnl += np.where(indices >= 0, pnl_values[np.maximum(indices, 0)], 0.)
+        return net_pnl
+    
     def df_trades(self, 
                   contract_group: ContractGroup | None = None, 
                   start_date: np.datetime64 = NAT, 
@@ -655,10 +680,16 @@ def test_account():
     account.calc(np.datetime64('2018-01-05 13:35'))
 
     assert_(len(account.df_trades()) == 5)
+    assert_(account.num_trades_for_date(ibm_cg, np.datetime64('2018-01-02')) == 2)
+    assert_(account.num_trades_for_date(msft_cg, np.datetime64('2018-01-02 09:00')) == 3)
+    assert_(account.num_trades_for_date(msft_cg, np.datetime64('2018-01-05')) == 0)
+    assert_(len(account.get_trades_for_date('IBM', np.datetime64('2018-01-02'))) == 2)
     assert_(len(account.df_pnl()) == 6)
     assert_(np.allclose(np.array([9.99, 61.96, 79.97, 109.33, 69.97, 154.33]), account.df_pnl().net_pnl.values, rtol=0))
     assert_(np.allclose(np.array([10, 20, -10, 45, -10, 45]), account.df_pnl().position.values, rtol=0))
     assert_(np.allclose(np.array([1000000., 1000000., 1000189.3, 1000224.3]), account.df_account_pnl().equity.values, rtol=0))
+    df_account_pnl = account.df_account_pnl()
+    assert_(np.allclose(account.net_pnl_array(df_account_pnl.timestamp.values), df_account_pnl.net_pnl.values, rtol=0))
 
 
 if __name__ == "__main__":
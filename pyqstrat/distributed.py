@@ -0,0 +1,415 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import os
+import time
+import socket
+import threading
+import collections
+import concurrent.futures
+import multiprocessing as mp
+from dataclasses import dataclass, field
+from multiprocessing.connection import Listener, Client, Connection
+from typing import Any, Callable
+from pyqstrat.pq_utils import get_child_logger, assert_, PQException
+
+_logger = get_child_logger(__name__)
+
+# Protocol between the coordinator (DistributedExecutor) and workers (run_worker).  Messages are pickled tuples.
+#
+# coordinator -> worker:
+#     ('init', initializer, initargs, heartbeat_interval) when the worker connects
+#     ('task', task_id, fn, args, kwargs)
+# worker -> coordinator:
+#     ('ready',) after running the initializer
+#     ('heartbeat', task_id) every heartbeat_interval seconds while a task is running
+#     ('result', task_id, succeeded, result or exception)
+
+
+@dataclass
+class _Task:
+    task_id: int
+    fn: Callable
+    args: tuple
+    kwargs: dict[str, Any]
+    future: concurrent.futures.Future
+    attempts: int = 0
+
+
+@dataclass
+class _Worker:
+    conn: Connection
+    name: str
+    task: _Task | None = None
+    last_seen: float = field(default_factory=time.monotonic)
+    # Set when the worker has run the initializer.  We only send tasks after this so they are not sent while we send init
+    ready: bool = False
+    lost: bool = False
+
+
+class DistributedExecutor(concurrent.futures.Executor):
+    '''
+    An executor that hands out tasks to worker processes, which may be on other hosts, over a socket.
+    Start a worker on another host by calling run_worker with the address and authkey of the executor.
+    Workers send heartbeats while they run a task.  If a worker disconnects or stops sending heartbeats, its task is
+    requeued and sent to another worker.  Functions and arguments are pickled, so they must be importable on the workers,
+    for example functions defined at module level.
+
+    To use with the Optimizer, pass in a function that creates the executor, for example
+    functools.partial(DistributedExecutor, address=('0.0.0.0', 6100), authkey=b'secret', num_local_workers=4)
+
+    Args:
+        address: (host, port) to listen on for workers.  Default listens on localhost on any free port.  See the address attribute
+        authkey: Workers must use the same key to connect.  If not set, a random key is generated, which is only useful
+            for local workers
+        initializer: If set, called with initargs in each worker when it connects
+        initargs: Arguments for initializer
+        num_local_workers: Number of worker processes to start on this machine.  Default 0
+        heartbeat_interval: Seconds between heartbeats from workers.  Default 1
+        heartbeat_timeout: If we don't hear from a worker for this many seconds while it is running a task, we consider it lost.
+            Default 30
+        max_attempts: A task that has been sent to this many workers that were lost fails with a PQException.  Default 3
+        mp_start_method: Start method for local worker processes.  Default is fork if it is available, otherwise spawn
+
+    >>> with DistributedExecutor(num_local_workers=2) as executor:
+    ...     print(list(executor.map(pow, [2, 3, 4], [2, 2, 2])))
+    [4, 9, 16]
+    '''
+    def __init__(self,
+                 address: tuple[str, int] = ('localhost', 0),
+                 authkey: bytes | None = None,
+                 initializer: Callable | None = None,
+                 initargs: tuple = (),
+                 num_local_workers: int = 0,
+                 heartbeat_interval: float = 1.,
+                 heartbeat_timeout: float = 30.,
+                 max_attempts: int = 3,
+                 mp_start_method: str | None = None) -> None:
+        assert_(heartbeat_timeout > heartbeat_interval, f'heartbeat_timeout: {heartbeat_timeout} must be > heartbeat_interval: {heartbeat_interval}')
+        if authkey is None: authkey = os.urandom(16)
+        self._listener = Listener(address, authkey=authkey)
+        self.address: tuple[str, int] = self._listener.address  # type: ignore
+        self._authkey = authkey
+        self._initializer = initializer
+        self._initargs = initargs
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._queue: collections.deque[_Task] = collections.deque()
+        self._workers: list[_Worker] = []
+        self._next_task_id = 0
+        self._shutdown = False
+
+        # Start local workers before we start any threads, since forking a process with threads is not safe
+        if mp_start_method is None: mp_start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+        context = mp.get_context(mp_start_method)
+        self._local_workers = [context.Process(target=run_worker, args=(self.address, authkey, False), daemon=True)  # type: ignore
+                               for _ in range(num_local_workers)]
+        for process in self._local_workers: process.start()
+
+        threading.Thread(target=self._accept_workers, daemon=True).start()
+        threading.Thread(target=self._check_heartbeats, daemon=True).start()
+
+    def _accept_workers(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception as e:
+                # A client with the wrong authkey for example
+                if self._shutdown: return
+                _logger.warning(f'could not accept worker: {e}')
+                continue
+            if self._shutdown:
+                conn.close()
+                return
+            threading.Thread(target=self._serve_worker, args=(conn, str(self._listener.last_accepted)), daemon=True).start()
+
+    def _serve_worker(self, conn: Connection, name: str) -> None:
+        worker = _Worker(conn, name)
+        with self._lock:
+            if self._shutdown:
+                conn.close()
+                return
+            self._workers.append(worker)
+        try:
+            conn.send(('init', self._initializer, self._initargs, self.heartbeat_interval))
+            while True:
+                message = conn.recv()
+                assignments: list[tuple[_Worker, _Task]] = []
+                with self._lock:
+                    if worker.lost: return
+                    worker.last_seen = time.monotonic()
+                    if message[0] == 'result':
+                        _, task_id, succeeded, result = message
+                        task = worker.task
+                        worker.task = None
+                        # A task that was requeued may finish on two workers
+                        if task is not None and task.task_id == task_id and not task.future.done():
+                            if succeeded:
+                                task.future.set_result(result)
+                            else:
+                                task.future.set_exception(result)
+                    if message[0] == 'ready': worker.ready = True
+                    if message[0] in ['ready', 'result']: assignments = self._assign(worker)
+                self._send(assignments)
+        except (OSError, EOFError):
+            pass
+        except Exception as e:
+            _logger.warning(f'worker {worker.name} failed: {e}')
+        finally:
+            with self._lock: assignments = self._remove_worker(worker)
+            self._send(assignments)
+            conn.close()
+
+    def _assign(self, worker: _Worker) -> list[tuple[_Worker, _Task]]:
+        '''
+        Take the next task off the queue if the worker is idle.  Must be called with the lock held.  Returns the (worker, task) 
+        to send with _send after the lock is released, so sending to a slow worker does not block the other threads
+        '''
+        while worker.ready and not worker.lost and not self._shutdown and worker.task is None and len(self._queue):
+            task = self._queue.popleft()
+            if task.attempts == 0:
+                if not task.future.set_running_or_notify_cancel(): continue
+            elif task.future.done():
+                # A requeued task that finished on the worker we thought was lost
+                continue
+            task.attempts += 1
+            worker.task = task
+            worker.last_seen = time.monotonic()
+            return [(worker, task)]
+        return []
+
+    def _send(self, assignments: list[tuple[_Worker, _Task]]) -> None:
+        '''Send tasks returned by _assign.  Must be called without the lock held.  If a send fails, the task is requeued'''
+        while len(assignments):
+            worker, task = assignments.pop()
+            try:
+                worker.conn.send(('task', task.task_id, task.fn, task.args, task.kwargs))
+                # Heartbeats only start once the worker gets the task
+                worker.last_seen = time.monotonic()
+            except (OSError, EOFError):
+                with self._lock:
+                    if worker.task is task: assignments += self._remove_worker(worker)
+            except Exception as e:
+                # For example, the function or its arguments cannot be pickled
+                with self._lock:
+                    if worker.task is not task: continue
+                    worker.task = None
+                    task.future.set_exception(e)
+                    assignments += self._assign(worker)
+
+    def _remove_worker(self, worker: _Worker) -> list[tuple[_Worker, _Task]]:
+        '''
+        Requeue the task the worker was running and assign it to another worker.  Must be called with the lock held.  
+        Returns assignments to send with _send
+        '''
+        if worker.lost: return []
+        worker.lost = True
+        _close_connection(worker.conn)
+        self._workers.remove(worker)
+        task = worker.task
+        worker.task = None
+        if task is None or task.future.done(): return []
+        if task.attempts >= self.max_attempts:
+            task.future.set_exception(PQException(f'task {task.task_id} lost on {task.attempts} workers, last one: {worker.name}'))
+            return []
+        _logger.warning(f'lost worker: {worker.name}, requeueing task: {task.task_id}')
+        self._queue.appendleft(task)
+        return self._assign_idle()
+
+    def _assign_idle(self) -> list[tuple[_Worker, _Task]]:
+        '''Assign queued tasks to idle workers.  Must be called with the lock held.  Returns assignments to send with _send'''
+        assignments: list[tuple[_Worker, _Task]] = []
+        for worker in list(self._workers):
+            if not len(self._queue): break
+            assignments += self._assign(worker)
+        return assignments
+
+    def _check_heartbeats(self) -> None:
+        while not self._shutdown:
+            time.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            assignments: list[tuple[_Worker, _Task]] = []
+            with self._lock:
+                for worker in list(self._workers):
+                    if worker.task is not None and now - worker.last_seen > self.heartbeat_timeout:
+                        assignments += self._remove_worker(worker)
+            self._send(assignments)
+
+    def num_workers(self) -> int:
+        '''Number of workers connected to the executor'''
+        with self._lock: return len(self._workers)
+
+    def submit(self, fn: Callable, /, *args: Any, **kwargs: Any) -> concurrent.futures.Future:
+        with self._lock:
+            assert_(not self._shutdown, 'cannot submit after shutdown')
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            self._queue.append(_Task(self._next_task_id, fn, args, kwargs, future))
+            self._next_task_id += 1
+            assignments = self._assign_idle()
+        self._send(assignments)
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        if cancel_futures:
+            with self._lock:
+                for task in self._queue: task.future.cancel()
+                self._queue.clear()
+        if wait:
+            while True:
+                with self._lock:
+                    if not len(self._queue) and not any([worker.task is not None for worker in self._workers]): break
+                time.sleep(0.01)
+        with self._lock:
+            self._shutdown = True
+            for worker in list(self._workers): self._remove_worker(worker)
+        # Closing the listener does not wake up a thread waiting to accept a connection, so connect to it instead
+        try:
+            socket.create_connection(self.address, timeout=self.heartbeat_timeout).close()
+        except OSError:
+            pass
+        self._listener.close()
+        for process in self._local_workers:
+            process.join(timeout=self.heartbeat_timeout)
+            if process.is_alive(): process.kill()
+
+
+def _close_connection(conn: Connection) -> None:
+    '''
+    Shut down the socket so a thread that is waiting to receive from it wakes up.  Closing the connection from another
+    thread does not do this
+    '''
+    try:
+        sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+    except OSError:
+        pass
+
+
+def _serve_coordinator(conn: Connection) -> None:
+    _, initializer, initargs, heartbeat_interval = conn.recv()
+    if initializer is not None: initializer(*initargs)
+    send_lock = threading.Lock()
+    conn.send(('ready',))
+    while True:
+        _, task_id, fn, args, kwargs = conn.recv()
+        done = threading.Event()
+
+        def send_heartbeats() -> None:
+            while not done.wait(heartbeat_interval):
+                with send_lock:
+                    try:
+                        conn.send(('heartbeat', task_id))
+                    except (OSError, EOFError):
+                        return
+
+        heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        try:
+            message = ('result', task_id, True, fn(*args, **kwargs))
+        except Exception as e:
+            message = ('result', task_id, False, e)
+        done.set()
+        heartbeat_thread.join()
+        try:
+            conn.send(message)
+        except (OSError, EOFError):
+            raise
+        except Exception as e:
+            # Results or exceptions that cannot be pickled
+            conn.send(('result', task_id, False, PQException(f'could not send result of task: {task_id}: {e}')))
+
+
+def run_worker(address: tuple[str, int], authkey: bytes, reconnect: bool = True, retry_seconds: float = 1.) -> None:
+    '''
+    Connect to a DistributedExecutor and run tasks it sends till it shuts down
+
+    Args:
+        address: (host, port) of the executor
+        authkey: Same authkey that was passed to the executor
+        reconnect: If set, keep trying to connect, so the worker can be started before the executor and be used
+            by one executor after another, for example when the Optimizer runs successive halving.  Default True
+        retry_seconds: Seconds to wait before trying to connect again.  Default 1
+    '''
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+        except (OSError, EOFError):
+            if not reconnect: return
+            time.sleep(retry_seconds)
+            continue
+        try:
+            _serve_coordinator(conn)
+        except (OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+        if not reconnect: return
+
+
+# Functions used in unit testing
+def _exit_once(path: str) -> str:
+    # Kill the worker the first time this is called to simulate a host going down
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        os._exit(1)
+    return 'done'
+
+
+def _stop_once(path: str) -> str:
+    # Suspend the worker the first time this is called, so it stops sending heartbeats
+    import signal
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        os.kill(os.getpid(), signal.SIGSTOP)
+    return 'done'
+
+
+class _SlowPickle:
+    # Slow to pickle, like a large argument sent over a slow network
+    def __reduce__(self) -> tuple[type, tuple]:
+        time.sleep(0.6)
+        return (_SlowPickle, ())
+
+
+def test_distributed_executor() -> None:
+    import math
+    import functools
+    from pyqstrat.pq_utils import get_temp_dir
+    from pyqstrat.optimize import Optimizer, _generator_1d, _cost_func_1d
+
+    with DistributedExecutor(num_local_workers=3, heartbeat_interval=0.1, heartbeat_timeout=1.) as executor:
+        assert_(list(executor.map(math.sqrt, [4., 9.])) == [2., 3.])
+        future = executor.submit(math.sqrt, -1.)
+        assert_(isinstance(future.exception(), ValueError))
+        # Tasks that cannot be pickled fail without losing the worker
+        assert_(executor.submit(lambda: 1).exception() is not None)
+        assert_(executor.submit(math.sqrt, 16.).result(timeout=30) == 4.)
+        # Tasks are sent without holding the lock, so a slow send does not block other threads
+        thread = threading.Thread(target=lambda: executor.submit(bool, _SlowPickle()).result())
+        thread.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        executor.num_workers()
+        assert_(time.monotonic() - start < 0.3)
+        thread.join()
+        for func in [_exit_once, _stop_once]:
+            path = f'{get_temp_dir()}/test_distributed_{func.__name__}'
+            if os.path.exists(path): os.remove(path)
+            # The task is requeued and run by another worker
+            assert_(executor.submit(func, path).result(timeout=30) == 'done')
+
+    optimizer = Optimizer('test', _generator_1d(), _cost_func_1d,
+                          executor_factory=functools.partial(DistributedExecutor, num_local_workers=2))
+    optimizer.run(raise_on_error=True)
+    assert_(len(optimizer.experiments) == 63)
+
+
+if __name__ == "__main__":
+    test_distributed_executor()
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -6,11 +6,24 @@ import numpy as np
 import pandas as pd
 import os
 import sys
+import math
+import json
+import time
+import pickle
+import sqlite3
+import enum
+import hashlib
 import itertools
+import collections
+import scipy.linalg
+import scipy.stats
 import concurrent
 import concurrent.futures
 import multiprocessing as mp
-from pyqstrat.pq_utils import get_child_logger, has_display
+from pyqstrat.pq_utils import get_child_logger, has_display, assert_
+from pyqstrat.shared_data import SharedDataStore
+from pyqstrat.worker_pool import WorkerPool, LimitExceededError
+from pyqstrat.thread_budget import ThreadBudget
 import plotly.graph_objects as go
 import plotly
 from plotly.subplots import make_subplots
@@ -36,89 +49,940 @@ def flatten_keys(experiments: Sequence[Any]) -> list[str]:
 
 class Experiment:
     '''An Experiment stores a suggestion and its result'''
-    def __init__(self, suggestion: dict[str, Any], cost: float, other_costs: dict[str, float]) -> None:
+    def __init__(self, 
+                 suggestion: dict[str, Any], 
+                 cost: float, 
+                 other_costs: dict[str, float], 
+                 seconds: float = math.nan, 
+                 pid: int = 0,
+                 peak_rss_mb: float = math.nan,
+                 budget: Any = None,
+                 error: str = '') -> None:
         '''
         Args:
             suggestion: A dictionary of variable name -> value
             cost: A float representing output of the function we are testing with this suggestion as input.
             other_costs: A dictionary of other results we want to store and look at later.
-
+            seconds: How long the cost function took to run for this suggestion.  Default nan
+            pid: Process id of the worker that ran the cost function.  Default 0
+            peak_rss_mb: Peak resident memory of the worker process in MB after it ran the cost function.  Default nan
+            budget: If the Optimizer was run with budgets, the budget the cost function was given for this result.  Default None
+            error: If the experiment was terminated because it exceeded the Optimizer's time or memory limit, the reason.  
+                Its cost is nan.  Default empty string
         '''
         self.suggestion = suggestion
         self.cost = cost
         self.other_costs = other_costs
+        self.seconds = seconds
+        self.pid = pid
+        self.peak_rss_mb = peak_rss_mb
+        self.budget = budget
+        self.error = error
         
     def valid(self) -> bool:
         '''
         Returns True if all suggestions and costs are finite, i.e not NaN or +/- Infinity
         '''
-        if not all(np.isfinite(list(self.suggestion.values()))): return False
+        # Only numeric parameters can be nan or infinite.  Others, such as tuples or dates, are always valid
+        if not all([np.isfinite(value) for value in self.suggestion.values() if isinstance(value, (int, float, np.number))]): return False
         if not np.isfinite(self.cost): return False
         if not all(np.isfinite(list(self.other_costs.values()))): return False
         return True
     
     def __repr__(self) -> str:
-        return f'suggestion: {self.suggestion} cost: {self.cost} other costs: {self.other_costs}'
+        budget = '' if self.budget is None else f' budget: {self.budget}'
+        error = f' error: {self.error}' if self.error else ''
+        return f'suggestion: {self.suggestion} cost: {self.cost} other costs: {self.other_costs}{budget}{error}'
+
+
+class CostResult(tuple[float, dict[str, float]]):
+    '''
+    The (cost, other_costs) tuple the Optimizer sends back to its generator.  It also has the suggestion it is the result for,
+    since when max_in_flight is set results can arrive in a different order than the generator yielded the suggestions.
+
+    >>> cost, other_costs = result = CostResult(1.5, {'sharpe': 0.8}, {'x': 2})
+    >>> print(cost, other_costs, result.suggestion)
+    1.5 {'sharpe': 0.8} {'x': 2}
+    '''
+    suggestion: dict[str, Any]
+
+    def __new__(cls, cost: float, other_costs: dict[str, float], suggestion: dict[str, Any]) -> CostResult:
+        result = super().__new__(cls, (cost, other_costs))
+        result.suggestion = suggestion
+        return result
+
+    @classmethod
+    def from_experiment(cls, experiment: Experiment) -> CostResult:
+        return cls(experiment.cost, experiment.other_costs, experiment.suggestion)
+
+
+def _json_default(obj: Any) -> Any:
+    # numpy scalars
+    if isinstance(obj, np.datetime64): return str(obj)
+    if hasattr(obj, 'isoformat'): return obj.isoformat()
+    if hasattr(obj, 'item'): return obj.item()
+    raise TypeError(f'cannot convert {obj} of type: {type(obj)} to json')
+
+
+def _key_default(obj: Any) -> Any:
+    try:
+        return _json_default(obj)
+    except TypeError:
+        # Values that cannot be converted to json, such as enums, functions or contracts, are identified by their repr
+        return repr(obj)
+
+
+def suggestion_key(suggestion: dict[str, Any]) -> str:
+    '''
+    Returns a string that uniquely identifies a suggestion, used to find suggestions that already have results.
+    Values that cannot be converted to json are identified by their repr, so objects that don't define __repr__ only match
+    themselves within a process, and are not found in a cache or journal written by another process
+    
+    >>> suggestion_key({'y': np.int64(3), 'x': np.float64(0.5)})
+    '{"x": 0.5, "y": 3}'
+    >>> suggestion_key({'func': abs})
+    '{"func": "<built-in function abs>"}'
+    '''
+    return json.dumps(suggestion, sort_keys=True, default=_key_default)
+
+
+def _experiment_key(suggestion: dict[str, Any], budget: Any) -> str:
+    if budget is None: return suggestion_key(suggestion)
+    return f'{suggestion_key(suggestion)} budget: {json.dumps(budget, default=_key_default)}'
+
+
+class ExperimentJournal:
+    '''
+    Stores experiments in a SQLite database as soon as they complete, so an optimization that stops partway through 
+    can be resumed, and results can be read from another process while the optimization is still running.
+    Suggestions and budgets are pickled, so they are read back with the same types, for example tuples or numpy datetimes.
+    They are also stored as json for display by other tools.
+    
+    Args:
+        filename: Path of the SQLite database.  It is created if it does not exist
+        
+    >>> from pyqstrat.pq_utils import get_temp_dir
+    >>> filename = f'{get_temp_dir()}/test_journal.sqlite'
+    >>> if os.path.exists(filename): os.remove(filename)
+    >>> journal = ExperimentJournal(filename)
+    >>> journal.add(Experiment({'x': 1.5}, -0.5, {'sharpe': 2.1}, seconds=0.2))
+    >>> journal.add(Experiment({'x': 2.5, 'win': (5, 20)}, np.nan, {}, budget=(0, 100)))
+    >>> with ExperimentJournal(filename) as reader: reader.experiments()
+    [suggestion: {'x': 1.5} cost: -0.5 other costs: {'sharpe': 2.1}, suggestion: {'x': 2.5, 'win': (5, 20)} cost: nan other costs: {} budget: (0, 100)]
+    >>> journal.close()
+    '''
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # We hold one connection for the lifetime of the journal instead of opening one for each experiment
+        self._conn = self._connect()
+        with self._conn as conn:
+            # write ahead logging lets readers see completed experiments while the optimizer is writing
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS experiments (
+                             id INTEGER PRIMARY KEY AUTOINCREMENT,
+                             suggestion TEXT NOT NULL,
+                             cost REAL,
+                             other_costs TEXT NOT NULL,
+                             seconds REAL,
+                             budget TEXT,
+                             error TEXT,
+                             completed_at TEXT NOT NULL,
+                             data BLOB)''')
+            # Journals written before suggestions were pickled don't have the data column
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(experiments)')]
+            if 'data' not in columns: conn.execute('ALTER TABLE experiments ADD COLUMN data BLOB')
+        
+    def _connect(self) -> sqlite3.Connection:
+        # The optimizer may be run from a different thread than the one that created it
+        return sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            
+    def add(self, experiment: Experiment) -> None:
+        '''Append an experiment to the journal'''
+        try:
+            data: bytes | None = pickle.dumps((experiment.suggestion, experiment.budget))
+        except Exception as e:
+            # For example, a suggestion containing a lambda.  We read back the json version instead
+            _logger.warning(f'could not pickle suggestion: {experiment.suggestion} budget: {experiment.budget}: {e}')
+            data = None
+        with self._conn as conn:  # commits when the block exits
+            conn.execute('INSERT INTO experiments (suggestion, cost, other_costs, seconds, budget, error, completed_at, data) '
+                         'VALUES (?, ?, ?, ?, ?, ?, datetime(\'now\'), ?)',
+                         (suggestion_key(experiment.suggestion), 
+                          float(experiment.cost), 
+                          json.dumps(experiment.other_costs, default=_json_default), 
+                          float(experiment.seconds),
+                          None if experiment.budget is None else json.dumps(experiment.budget, default=_key_default),
+                          experiment.error,
+                          data))
+            
+    def experiments(self) -> list[Experiment]:
+        '''Returns experiments in the order in which they completed'''
+        rows = self._conn.execute('SELECT suggestion, cost, other_costs, seconds, budget, error, data FROM experiments ORDER BY id').fetchall()
+        experiments = []
+        for suggestion, cost, other_costs, seconds, budget, error, data in rows:
+            if data is not None:
+                suggestion, budget = pickle.loads(data)
+            else:
+                suggestion, budget = json.loads(suggestion), None if budget is None else json.loads(budget)
+            # SQLite stores nan as NULL
+            experiments.append(Experiment(suggestion, 
+                                          np.nan if cost is None else cost, 
+                                          json.loads(other_costs), 
+                                          np.nan if seconds is None else seconds,
+                                          budget=budget,
+                                          error=error or ''))
+        return experiments
+    
+    def df_experiments(self, sort_column: str = 'cost', ascending: bool = True) -> pd.DataFrame:
+        '''Returns a dataframe of experiments in the journal.  See Optimizer.df_experiments'''
+        return _df_experiments(self.experiments(), sort_column, ascending)
+    
+    def close(self) -> None:
+        '''Close the database connection.  The journal should not be used after this'''
+        self._conn.close()
+        
+    def __enter__(self) -> ExperimentJournal:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+        
+    def __getstate__(self) -> dict[str, Any]:
+        return {'filename': self.filename}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.filename = state['filename']
+        self._conn = self._connect()
+    
+
+class ExperimentCache:
+    '''
+    A persistent cache of cost function results that can be shared by optimizer runs, so suggestions that were already
+    evaluated by an earlier run are not evaluated again.  Results are keyed by the suggestion, budget and a version tag.
+    
+    Args:
+        filename: Path of the SQLite database.  It is created if it does not exist
+        version: Change this when the cost function or the data it uses changes, so results from the old version are not used.
+            Default empty string
+        
+    >>> from pyqstrat.pq_utils import get_temp_dir
+    >>> filename = f'{get_temp_dir()}/test_cache.sqlite'
+    >>> if os.path.exists(filename): os.remove(filename)
+    >>> ExperimentCache(filename, 'v1').add(Experiment({'x': 1.5, 'y': 2}, -0.5, {'sharpe': 2.1}))
+    >>> ExperimentCache(filename, 'v1').get({'y': 2, 'x': 1.5})
+    suggestion: {'y': 2, 'x': 1.5} cost: -0.5 other costs: {'sharpe': 2.1}
+    >>> with ExperimentCache(filename, 'v2') as cache: print(cache.get({'x': 1.5, 'y': 2}))
+    None
+    >>> cache = ExperimentCache(filename, 'v1')
+    >>> cache.load()
+    >>> cache.add(Experiment({'x': 2.5, 'y': 2}, -0.25, {}))
+    >>> print(cache.get({'x': 1.5, 'y': 2}).cost, cache.get({'x': 2.5, 'y': 2}).cost, len(cache))
+    -0.5 -0.25 2
+    >>> cache.close()
+    '''
+    def __init__(self, filename: str, version: str = '') -> None:
+        self.filename = filename
+        self.version = version
+        # Results for this version read by load, keyed by _key.  None until load is called
+        self._results: dict[str, tuple[float, str, float]] | None = None
+        self._conn = self._connect()
+        with self._conn as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                             key TEXT PRIMARY KEY,
+                             version TEXT NOT NULL,
+                             cost REAL,
+                             other_costs TEXT NOT NULL,
+                             seconds REAL,
+                             created_at TEXT NOT NULL)''')
+            
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+    
+    def _key(self, suggestion: dict[str, Any], budget: Any) -> str:
+        return hashlib.sha256(f'{self.version}\n{_experiment_key(suggestion, budget)}'.encode()).hexdigest()
+        
+    def add(self, experiment: Experiment) -> None:
+        '''Add the result of an experiment to the cache, replacing any earlier result for the same suggestion'''
+        key = self._key(experiment.suggestion, experiment.budget)
+        row = (float(experiment.cost), json.dumps(experiment.other_costs, default=_json_default), float(experiment.seconds))
+        with self._conn as conn:
+            conn.execute('INSERT OR REPLACE INTO results (key, version, cost, other_costs, seconds, created_at) VALUES (?, ?, ?, ?, ?, datetime(\'now\'))',
+                         (key, self.version, *row))
+        if self._results is not None: self._results[key] = row
+            
+    def load(self) -> None:
+        '''
+        Read all results for this version into memory, so get does not query the database for each suggestion.  
+        Results added by other processes after this are not seen
+        '''
+        rows = self._conn.execute('SELECT key, cost, other_costs, seconds FROM results WHERE version = ?', (self.version,)).fetchall()
+        self._results = {key: (cost, other_costs, seconds) for key, cost, other_costs, seconds in rows}
+            
+    def get(self, suggestion: dict[str, Any], budget: Any = None) -> Experiment | None:
+        '''Returns an Experiment with the cached result for this suggestion and budget, or None if it is not in the cache'''
+        key = self._key(suggestion, budget)
+        if self._results is not None:
+            row = self._results.get(key)
+        else:
+            row = self._conn.execute('SELECT cost, other_costs, seconds FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None: return None
+        cost, other_costs, seconds = row
+        return Experiment(suggestion, np.nan if cost is None else cost, json.loads(other_costs), np.nan if seconds is None else seconds, budget=budget)
+    
+    def __len__(self) -> int:
+        return self._conn.execute('SELECT COUNT(*) FROM results WHERE version = ?', (self.version,)).fetchone()[0]
+    
+    def close(self) -> None:
+        '''Close the database connection.  The cache should not be used after this'''
+        self._conn.close()
+        
+    def __enter__(self) -> ExperimentCache:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+        
+    def __getstate__(self) -> dict[str, Any]:
+        return {'filename': self.filename, 'version': self.version}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.filename = state['filename']
+        self.version = state['version']
+        self._results = None
+        self._conn = self._connect()
+    
+
+def _df_experiments(experiments: Sequence[Experiment], sort_column: str, ascending: bool) -> pd.DataFrame:
+    if len(experiments) == 0: return None
+    pc_keys = flatten_keys(experiments)
+    # pc_keys = list(self.experiments[0].other_costs.keys())
+    sugg_keys = list(experiments[0].suggestion.keys())
+    records = [[exp.suggestion[k] for k in sugg_keys] + [exp.cost] + [exp.other_costs[k] for k in pc_keys]
+               for exp in experiments if exp.valid()]
+    df = pd.DataFrame.from_records(records, columns=sugg_keys + ['cost'] + pc_keys)
+    if any([exp.budget is not None for exp in experiments]):
+        df.insert(len(sugg_keys), 'budget', [exp.budget for exp in experiments if exp.valid()])
+    df = df.sort_values(by=[sort_column], ascending=ascending)
+    return df
+
+
+def _experiment_columns(experiments: Sequence[Experiment], names: Sequence[str]) -> dict[str, np.ndarray]:
+    '''
+    Returns a dictionary of name -> array of values, one for each experiment.  A name can be a parameter, cost or another cost
+    
+    >>> columns = _experiment_columns([Experiment({'x': 1}, 0.5, {'sharpe': 2.}), Experiment({'x': 2}, 0.25, {'sharpe': 3.})], ['x', 'sharpe'])
+    >>> print(columns['x'].tolist(), columns['sharpe'].tolist())
+    [1, 2] [2.0, 3.0]
+    '''
+    columns = {}
+    for name in names:
+        if name == 'cost':
+            columns[name] = np.fromiter((experiment.cost for experiment in experiments), dtype=float, count=len(experiments))
+        elif name in experiments[0].suggestion:
+            columns[name] = np.array([experiment.suggestion[name] for experiment in experiments])
+        else:
+            columns[name] = np.fromiter((experiment.other_costs[name] for experiment in experiments), dtype=float, count=len(experiments))
+    return columns
+
+
+def _bin_axis(values: np.ndarray, max_bins: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns the index of the bin each value falls in and the center of each bin.  If there are no more than max_bins distinct 
+    values, or values are not numbers, each distinct value gets its own bin.  Otherwise we use max_bins bins of equal width
+    '''
+    unique = np.unique(values)
+    if len(unique) <= max_bins or not np.issubdtype(values.dtype, np.number):
+        return np.searchsorted(unique, values), unique
+    edges = np.linspace(unique[0], unique[-1], max_bins + 1)
+    indices = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, max_bins - 1)
+    return indices, (edges[:-1] + edges[1:]) / 2
+
+
+def bin_values(coords: Sequence[np.ndarray], 
+               values: np.ndarray, 
+               max_bins: int = 100, 
+               statistic: str | float = 'mean') -> tuple[list[np.ndarray], np.ndarray, np.ndarray]:
+    '''
+    Aggregates values over the cells of a grid, for example the costs of experiments over 2 parameters, so we can plot 
+    a large number of experiments.  Uses sorting and bincount instead of a python loop over cells, so it is fast for 
+    millions of values.
+    
+    Args:
+        coords: An array for each axis of the grid, with the coordinate of each value on that axis
+        values: Values to aggregate
+        max_bins: Maximum number of bins along each axis.  An axis with no more than this many distinct coordinates
+            gets a bin for each one.  Default 100
+        statistic: Can be mean, min, max, count or a quantile between 0 and 1, for example 0.5 for the median.  Default mean
+        
+    Returns:
+        The center of each bin along each axis, the statistic for each cell and the number of values in each cell.
+        The last two have an axis for each axis of the grid, and cells without any values are nan
+    
+    >>> centers, stat, counts = bin_values([np.array([1, 1, 2, 3])], np.array([1., 3., 5., 7.]))
+    >>> print(centers[0].tolist(), stat.tolist(), counts.tolist())
+    [1, 2, 3] [2.0, 5.0, 7.0] [2, 1, 1]
+    >>> x = np.arange(1000.)
+    >>> centers, stat, counts = bin_values([x, x % 2], x, max_bins=4, statistic=0.5)
+    >>> print(centers[0].tolist(), centers[1].tolist(), counts.tolist())
+    [124.875, 374.625, 624.375, 874.125] [0.0, 1.0] [[125, 125], [125, 125], [125, 125], [125, 125]]
+    >>> print(stat[:, 0].tolist(), stat[:, 1].tolist())
+    [124.0, 374.0, 624.0, 874.0] [125.0, 375.0, 625.0, 875.0]
+    '''
+    assert_(len(coords) > 0 and all([len(coord) == len(values) for coord in coords]), 'coords and values must have the same length')
+    assert_(statistic in ['mean', 'min', 'max', 'count'] or (not isinstance(statistic, str) and 0 <= statistic <= 1), 
+            f'invalid statistic: {statistic}')
+    values = np.asarray(values, dtype=float)
+    bins = [_bin_axis(np.asarray(coord), max_bins) for coord in coords]
+    shape = tuple([len(centers) for _, centers in bins])
+    cells = np.ravel_multi_index([indices for indices, _ in bins], shape) if len(values) else np.zeros(0, dtype=int)
+    size = int(np.prod(shape))
+    counts = np.bincount(cells, minlength=size)
+    nonempty = counts > 0
+    result = np.full(size, np.nan)
+    if statistic == 'count':
+        result[nonempty] = counts[nonempty]
+    elif statistic == 'mean':
+        result[nonempty] = np.bincount(cells, weights=values, minlength=size)[nonempty] / counts[nonempty]
+    else:
+        quantile = {'min': 0., 'max': 1.}.get(statistic, statistic)  # type: ignore
+        # Sort values by cell and then by value, so values of each cell are contiguous and in order
+        sorted_values = values[np.lexsort((values, cells))]
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        # Linear interpolation between the two closest values, like np.quantile
+        position = starts + quantile * (counts[nonempty] - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        result[nonempty] = sorted_values[lower] + (position - lower) * (sorted_values[upper] - sorted_values[lower])
+    return [centers for _, centers in bins], result.reshape(shape), counts.reshape(shape)
+
+
+def _peak_rss_mb() -> float:
+    '''Peak resident memory of this process in MB, or nan if we cannot get it on this platform'''
+    try:
+        import resource
+    except ImportError:
+        return math.nan
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, KB elsewhere
+    return max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3
+
+
+def _timed_cost_func(cost_func: Callable[..., tuple[float, dict[str, float]]], 
+                     suggestion: dict[str, Any],
+                     budget: Any = None) -> tuple[float, dict[str, float], float, int, float]:
+    '''Returns cost, other costs, seconds, process id and peak memory'''
+    start_time = time.perf_counter()
+    cost, other_costs = cost_func(suggestion) if budget is None else cost_func(suggestion, budget)
+    return cost, other_costs, time.perf_counter() - start_time, os.getpid(), _peak_rss_mb()
+
+
+def _suggestion_arrays(suggestions: Sequence[dict[str, Any]]) -> dict[str, np.ndarray]:
+    '''
+    Converts a list of suggestions to a dictionary of parameter name -> array of values
+    
+    >>> arrays = _suggestion_arrays([{'x': 1, 'y': 0.5}, {'x': 2, 'y': 0.25}])
+    >>> print(arrays['x'].tolist(), arrays['y'].tolist())
+    [1, 2] [0.5, 0.25]
+    '''
+    keys = list(suggestions[0].keys())
+    for suggestion in suggestions: assert_(list(suggestion.keys()) == keys, f'suggestions in a batch must have the same keys: {keys} {suggestion}')
+    return {key: np.array([suggestion[key] for suggestion in suggestions]) for key in keys}
+
+
+def _timed_batch_cost_func(cost_func: Callable[..., Any],
+                           suggestions: Sequence[dict[str, Any]]) -> tuple[np.ndarray, dict[str, np.ndarray], float, int, float]:
+    '''
+    cost_func is the Optimizer's cost function.  With batch_size set, it takes a dictionary of parameter name -> array of values 
+    and returns an array of costs and a dictionary of other cost name -> array of values
+    '''
+    start_time = time.perf_counter()
+    costs, other_costs = cost_func(_suggestion_arrays(suggestions))
+    costs = np.asarray(costs)
+    assert_(costs.shape == (len(suggestions),), f'expected {len(suggestions)} costs, got shape: {costs.shape}')
+    for key, values in other_costs.items():
+        assert_(len(values) == len(suggestions), f'expected {len(suggestions)} values for {key}, got: {len(values)}')
+    return costs, other_costs, time.perf_counter() - start_time, os.getpid(), _peak_rss_mb()
+    
+
+# Set in each worker process by _init_worker, and in the main process when the Optimizer runs
+_worker_cost_func: Callable[..., tuple[float, dict[str, float]]] | None = None
+_worker_shared_data: SharedDataStore | None = None
+
+
+def _init_worker(cost_func: Callable[..., tuple[float, dict[str, float]]], shared_data: SharedDataStore | None) -> None:
+    global _worker_cost_func, _worker_shared_data
+    _worker_cost_func = cost_func
+    _worker_shared_data = shared_data
+    
+
+def _run_worker_cost_func(suggestion: dict[str, Any], budget: Any = None) -> tuple[float, dict[str, float], float, int, float]:
+    # Only the suggestion is sent to the worker for each experiment
+    assert _worker_cost_func is not None
+    return _timed_cost_func(_worker_cost_func, suggestion, budget)
+
+
+def _run_worker_batch_cost_func(suggestions: list[dict[str, Any]]) -> tuple[np.ndarray, dict[str, np.ndarray], float, int, float]:
+    assert _worker_cost_func is not None
+    return _timed_batch_cost_func(_worker_cost_func, suggestions)
+
+
+def get_shared_data() -> SharedDataStore:
+    '''
+    Returns the SharedDataStore passed to the Optimizer that is running.  Call this from a cost function to get large 
+    read-only inputs such as market data.  In worker processes the arrays in the store are attached to, not copied.
+    '''
+    assert_(_worker_shared_data is not None, 'shared_data was not passed to the Optimizer')
+    return _worker_shared_data  # type: ignore
 
 
 class Optimizer:
     '''Optimizer is used to optimize parameters for a strategy.'''
     def __init__(self, name: str, 
                  generator: Generator[dict[str, Any], tuple[float, dict[str, float]], None], 
-                 cost_func: Callable[[dict[str, Any]], tuple[float, dict[str, float]]], 
-                 max_processes: int | None = None) -> None:
+                 cost_func: Callable[..., tuple[float, dict[str, float]]], 
+                 max_processes: int | None = None,
+                 max_in_flight: int | None = None,
+                 journal: str | None = None,
+                 shared_data: SharedDataStore | None = None,
+                 mp_start_method: str | None = None,
+                 executor_factory: Callable[..., concurrent.futures.Executor] | None = None,
+                 budgets: Sequence[Any] | None = None,
+                 promote_fraction: float = 0.5,
+                 batch_size: int | None = None,
+                 progress_callback: Callable[[dict[str, float]], None] | None = None,
+                 num_suggestions: int | None = None,
+                 deduplicate: bool = True,
+                 cache: str | None = None,
+                 cache_version: str = '',
+                 timeout_seconds: float | None = None,
+                 max_memory_mb: float | None = None,
+                 thread_budget: ThreadBudget | None = None) -> None:
         '''
         Args:
             name: Display title for plotting, etc.
             generator: A generator (see Python Generators) that takes no inputs and yields a dictionary with parameter name -> parameter value.
+                When running in a single process, (cost, other_costs) for each suggestion is sent back to the generator
+                before it yields the next suggestion.  This is a CostResult tuple, so its suggestion attribute has the suggestion
+                it is the result for.
             cost_func: A function that takes a dictionary of parameter name -> parameter value as input and outputs cost for that set of parameters.
             max_processes: If not set, the Optimizer will look at the number of CPU cores on your machine to figure out how many processes to run.
+            max_in_flight: If set, at most this many experiments are queued or running at a time, and (cost, other_costs) for each
+                completed experiment is sent back to the generator as soon as its result arrives, so adaptive generators can use
+                all processes.  Results can arrive out of order, so use the suggestion attribute of the CostResult to match them up.
+                The generator can yield None if it needs more results before it can make another suggestion.  None is sent back
+                when there are no more results outstanding.  If not set and we are running more than one process, 
+                all suggestions are queued up front and nothing is sent back to the generator.  Default None
+            journal: Path of a SQLite file that each experiment is written to as soon as it completes.  If the file already has 
+                experiments, for example from a run that did not finish, they are loaded and suggestions that already have 
+                results are not run again.  Their saved results are sent back to the generator instead.  Default None
+            shared_data: Large read-only inputs such as market data.  Each worker process attaches to the store once when it starts, 
+                and the cost function can get it by calling get_shared_data, so it does not need to capture the data.  Default None
+            mp_start_method: How worker processes are started, one of fork, spawn or forkserver.  With spawn and forkserver, 
+                the cost function has to be picklable, for example a function defined at module level, and on Microsoft Windows
+                optimizer.run has to be called from within an if __name__ == '__main__' block.  
+                Default is fork if it is available, otherwise spawn
+            executor_factory: If set, a function that takes initializer and initargs keyword arguments and returns a 
+                concurrent.futures.Executor that is used instead of a local process pool, for example to run experiments on 
+                other hosts.  See DistributedExecutor.  Default None
+            budgets: If set, run successive halving.  The cost function is called as cost_func(suggestion, budget), where budget 
+                is what the cost function should limit itself to, for example a fraction of the bars or an end date.
+                All suggestions are evaluated with the first budget, and then the best promote_fraction of them are evaluated 
+                with the next budget and so on, so most of the compute goes to suggestions that look promising.  
+                Results for every budget are stored in experiments.  Budgets must be in increasing order.  Default None
+            promote_fraction: When budgets are set, the fraction of suggestions, by lowest cost, that are promoted to the 
+                next budget.  At least one suggestion is always promoted.  Default 0.5
+            batch_size: If set, suggestions are grouped into batches of up to this many, and the cost function is called once
+                per batch with a dictionary of parameter name -> numpy array containing the value of that parameter for each
+                suggestion in the batch.  It returns an array of costs and a dictionary of other cost name -> array, 
+                so it can evaluate all suggestions at once, for example by broadcasting thresholds over a signal matrix.  
+                Results are stored as one Experiment per suggestion.  Batches are run in parallel if we are running more 
+                than one process.  Nothing is sent back to the generator.  Default None
+            progress_callback: If set, called with a dictionary of run statistics each time an experiment completes.
+                See df_run_stats for what it contains.  Default None
+            num_suggestions: If set, the number of experiments we expect to run, used to estimate time remaining.  Default None
+            deduplicate: If set, a suggestion that has the same parameters as one that was already evaluated in this run is not
+                evaluated again.  Its earlier result is used instead, and sent back to the generator if we send results back.
+                When running more than one process, duplicates of suggestions that are still running are skipped as well.
+                Default True
+            cache: Path of a SQLite file used as an ExperimentCache.  Suggestions with results in the cache for cache_version
+                are not evaluated, and their cached result is added to experiments instead.  New results are added to the 
+                cache.  Default None
+            cache_version: Tag for the version of the cost function and data.  Change it when either changes so
+                older cached results are not used.  Default empty string
+            timeout_seconds: If set, an experiment that runs for longer than this many seconds is terminated, and the worker process 
+                that ran it is replaced with a new one.  It is stored in experiments with a cost of nan and the reason in its error
+                attribute, and is not run again if it is suggested again or if we resume from a journal.  With limits, experiments 
+                always run in worker processes, even if max_processes is 1.  Default None
+            max_memory_mb: If set, an experiment is terminated in the same way if the resident memory of the worker process running it 
+                goes above this many MB.  Only supported on Linux.  Default None
+            thread_budget: How cores are split between worker processes and the threads that BLAS and OpenMP libraries use in 
+                each worker.  If max_processes is not set, it also decides how many worker processes to start.
+                Default splits cores evenly between worker processes
         '''
         self.name = name
         self.generator = generator
         self.cost_func = cost_func
-        import sys
-        if sys.platform in ['win32', 'cygwin']:
-            if max_processes is not None and max_processes != 1:
-                raise Exception("max_processes must be 1 on Microsoft Windows")
-            max_processes = 1
+        # on mac m1 the default start method is set to spawn so use fork unless asked otherwise
+        if mp_start_method is None: mp_start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+        assert_(mp_start_method in mp.get_all_start_methods(), f'start method {mp_start_method} not available on this platform')
+        self.mp_start_method = mp_start_method
         self.max_processes = max_processes
+        self.shared_data = shared_data
+        self.executor_factory = executor_factory
+        assert_(budgets is None or len(budgets) > 0, 'budgets cannot be empty')
+        assert_(0 < promote_fraction <= 1, f'promote_fraction must be > 0 and <= 1: {promote_fraction}')
+        assert_(budgets is None or batch_size is None, 'budgets and batch_size cannot both be set')
+        assert_(batch_size is None or batch_size > 0, f'batch_size must be positive: {batch_size}')
+        self.budgets = budgets
+        self.batch_size = batch_size
+        self.progress_callback = progress_callback
+        self.deduplicate = deduplicate
+        self.cache = ExperimentCache(cache, cache_version) if cache is not None else None
+        self.num_suggestions = num_suggestions
+        self._reset_run_stats()
+        self.promote_fraction = promote_fraction
+        assert_(max_in_flight is None or max_in_flight > 0, f'max_in_flight must be positive: {max_in_flight}')
+        self.max_in_flight = max_in_flight
+        self.journal = ExperimentJournal(journal) if journal is not None else None
+        assert_(executor_factory is None or (timeout_seconds is None and max_memory_mb is None), 
+                'timeout_seconds and max_memory_mb cannot be used with executor_factory')
+        self.timeout_seconds = timeout_seconds
+        self.max_memory_mb = max_memory_mb
+        self.thread_budget = thread_budget if thread_budget is not None else ThreadBudget()
+        self._cancelled = False
         self.experiments: list[Experiment] = []
+        # Experiments loaded from the journal, and if deduplicate is set, experiments completed in this run, keyed by suggestion
+        self._completed: dict[str, Experiment] = {}
         
-    def _run_single_process(self) -> None:
+    def _has_limits(self) -> bool:
+        return self.timeout_seconds is not None or self.max_memory_mb is not None
+    
+    def _single_process(self) -> bool:
+        '''True if we run the cost function in this process'''
+        return self.max_processes == 1 and self.executor_factory is None and not self._has_limits()
+    
+    def _executor(self, 
+                  initializer: Callable = _init_worker, 
+                  initargs: tuple | None = None, 
+                  num_tasks: int | None = None) -> concurrent.futures.Executor:
+        '''
+        Returns the executor used to run tasks in worker processes.  If we know how many tasks we will run, we don't start 
+        more processes than that, so each one can use more threads
+        '''
+        if initargs is None: initargs = (self.cost_func, self.shared_data)
+        if self.executor_factory is not None: return self.executor_factory(initializer=initializer, initargs=initargs)
+        num_processes, num_threads = self.thread_budget.split(self.max_processes, num_tasks)
+        return WorkerPool(num_processes, 
+                          mp_context=mp.get_context(self.mp_start_method),
+                          initializer=initializer,
+                          initargs=initargs,
+                          timeout_seconds=self.timeout_seconds,
+                          max_memory_mb=self.max_memory_mb,
+                          threads_per_worker=num_threads)
+    
+    def _stop(self, executor: concurrent.futures.Executor) -> None:
+        '''Called when the run is cancelled.  Cancels experiments that have not started and terminates running ones if we can'''
+        if isinstance(executor, WorkerPool):
+            executor.terminate()
+        else:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def cancel(self) -> None:
+        '''
+        Stop the optimizer.  Experiments that have not started are cancelled, and experiments that are running in worker processes 
+        are terminated.  Experiments that already completed are kept, so you can look at them or resume from the journal later.
+        You can call this from another thread or from progress_callback.  Interrupting the optimizer, for example with 
+        the stop button in a notebook, does the same thing.
+        '''
+        self._cancelled = True
+    
+    def _get_completed(self, suggestion: dict[str, Any], budget: Any = None) -> Experiment | None:
+        '''Returns the result for a suggestion that does not need to be evaluated, or None if it does'''
+        if not len(self._completed) and self.cache is None: return None
+        key = _experiment_key(suggestion, budget)
+        experiment = self._completed.get(key)
+        if experiment is None and self.cache is not None:
+            experiment = self.cache.get(suggestion, budget)
+            if experiment is not None: self._add_experiment(experiment, from_cache=True)
+        return experiment
+    
+    def _add_experiment(self, experiment: Experiment, from_cache: bool = False) -> None:
+        self.experiments.append(experiment)
+        if self.journal is not None: self.journal.add(experiment)
+        if self.deduplicate or from_cache: self._completed[_experiment_key(experiment.suggestion, experiment.budget)] = experiment
+        # Cached results are not included in run statistics since we did not run them
+        if from_cache: return
+        # Experiments that were terminated are not cached since they may complete with different limits
+        if self.cache is not None and not experiment.error: self.cache.add(experiment)
+        self._record_stats(experiment)
+        
+    def _reset_run_stats(self) -> None:
+        # Statistics for experiments completed in the current run
+        self._run_stats: list[tuple[Experiment, dict[str, float]]] = []
+        self._run_start_time = time.perf_counter()
+        self._num_completed = 0
+        self._num_failed = 0
+        self._busy_seconds = 0.
+        self._pids: set[int] = set()
+        self._max_rss_mb = math.nan
+        
+    def _handle_error(self, e: Exception, description: str, raise_on_error: bool) -> None:
+        '''Called from an except block when a cost function fails.  Counts the failure and raises or prints the exception'''
+        self._num_failed += 1
+        new_exc = type(e)(f'Exception: {str(e)} with {description}').with_traceback(sys.exc_info()[2])
+        if raise_on_error: raise new_exc
+        print(str(new_exc))
+        
+    def _record_stats(self, experiment: Experiment) -> None:
+        elapsed = time.perf_counter() - self._run_start_time
+        if np.isfinite(experiment.seconds): self._busy_seconds += experiment.seconds
+        self._pids.add(experiment.pid)
+        self._max_rss_mb = np.nanmax([self._max_rss_mb, experiment.peak_rss_mb])
+        if experiment.error:
+            self._num_failed += 1
+        else:
+            self._num_completed += 1
+        completed = self._num_completed
+        rate = completed / elapsed if elapsed > 0 else math.nan
+        eta = math.nan
+        if self.num_suggestions is not None and rate > 0: eta = max(self.num_suggestions - completed - self._num_failed, 0) / rate
+        stats = {'elapsed_seconds': elapsed,
+                 'completed': completed,
+                 'failed': self._num_failed,
+                 'experiments_per_sec': rate,
+                 'num_workers': len(self._pids),
+                 'utilization': self._busy_seconds / (elapsed * len(self._pids)) if elapsed > 0 else math.nan,
+                 'max_peak_rss_mb': self._max_rss_mb,
+                 'eta_seconds': eta}
+        self._run_stats.append((experiment, stats))
+        if self.progress_callback is not None: self.progress_callback(stats)
+        
+    def _add_result(self, 
+                    suggestion: dict[str, Any], 
+                    get_result: Callable[[], tuple[float, dict[str, float], float, int, float]], 
+                    raise_on_error: bool,
+                    budget: Any = None) -> Experiment:
+        '''
+        Adds an experiment with the result of the cost function and returns it.  If the cost function exceeded a time or memory limit 
+        we add an experiment with a cost of nan and the reason.  If it raised an exception, we return an experiment with a cost of nan
+        without adding it
+        '''
         try:
-            for suggestion in self.generator:
+            experiment = Experiment(suggestion, *get_result(), budget=budget)
+        except LimitExceededError as e:
+            experiment = Experiment(suggestion, np.nan, {}, e.seconds, e.pid, e.rss_mb, budget, str(e))
+        except Exception as e:
+            self._handle_error(e, f'suggestion: {suggestion}' + ('' if budget is None else f' budget: {budget}'), raise_on_error)
+            return Experiment(suggestion, np.nan, {}, budget=budget)
+        self._add_experiment(experiment)
+        return experiment
+        
+    def _run_single_process(self, raise_on_error: bool) -> None:
+        # With time or memory limits, we run one experiment at a time in a worker process so we can terminate it
+        executor = self._executor() if self._has_limits() else None
+        # Send the cost of each suggestion back to the generator.  The value returned by send is the next suggestion
+        value: CostResult | None = None
+        try:
+            while not self._cancelled:
+                try:
+                    suggestion = self.generator.send(value)  # type: ignore
+                except StopIteration:
+                    # Exhausted generator
+                    return
+                value = None
                 if suggestion is None: continue
-                cost, other_costs = self.cost_func(suggestion)
-                self.generator.send((cost, other_costs))
-                self.experiments.append(Experiment(suggestion, cost, other_costs))
-        except StopIteration:
-            # Exhausted generator
-            return
+                experiment = self._get_completed(suggestion)  # type: ignore
+                if experiment is None and executor is None:
+                    experiment = Experiment(suggestion, *_timed_cost_func(self.cost_func, suggestion))  # type: ignore
+                    self._add_experiment(experiment)
+                elif experiment is None:
+                    experiment = self._add_result(suggestion, executor.submit(_run_worker_cost_func, suggestion).result, raise_on_error)  # type: ignore
+                value = CostResult.from_experiment(experiment)
+        finally:
+            if executor is not None: self._stop(executor)
+            
+    def _run_bounded_multi_process(self, raise_on_error: bool) -> None:
+        '''
+        Keeps at most max_in_flight experiments queued or running and sends the result of each one back to the generator
+        as soon as it completes
+        '''
+        assert self.max_in_flight is not None
+        generator: Any = self.generator
+        pending: dict[concurrent.futures.Future, dict[str, Any]] = {}
+        # Keys of suggestions that are queued or running, so we don't run duplicates of them
+        in_flight: set[str] = set()
+        exhausted = False
+        # Set when the generator yields None.  We only send it None again once there are no results outstanding
+        waiting = False
+        
+        def next_suggestion(value: CostResult | None) -> dict[str, Any] | None:
+            nonlocal exhausted
+            while True:
+                try:
+                    suggestion = generator.send(value)
+                except StopIteration:
+                    exhausted = True
+                    return None
+                if suggestion is None: return None
+                # If we already have a result for this suggestion, send it back instead of running it again
+                experiment = self._get_completed(suggestion)
+                value = None if experiment is None else CostResult.from_experiment(experiment)
+                if value is not None: continue
+                if not self.deduplicate: return suggestion
+                # A duplicate of a suggestion that is still running is skipped.  The generator gets its result when it completes
+                key = suggestion_key(suggestion)
+                if key in in_flight: continue
+                in_flight.add(key)
+                return suggestion
+        
+        with self._executor() as executor:
+            while True:
+                while not exhausted and not self._cancelled and len(pending) < self.max_in_flight and not (waiting and len(pending)):
+                    suggestion = next_suggestion(None)
+                    waiting = suggestion is None
+                    if suggestion is None: continue
+                    pending[executor.submit(_run_worker_cost_func, suggestion)] = suggestion
+                    
+                if not len(pending): break
+                
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    suggestion = pending.pop(future)
+                    if self.deduplicate: in_flight.discard(suggestion_key(suggestion))
+                    experiment = self._add_result(suggestion, future.result, raise_on_error)
+                    if exhausted or self._cancelled: continue
+                    # A slot was freed up so we can queue the next suggestion right away
+                    next_sugg = next_suggestion(CostResult.from_experiment(experiment))
+                    waiting = next_sugg is None
+                    if next_sugg is not None: pending[executor.submit(_run_worker_cost_func, next_sugg)] = next_sugg
+                if self._cancelled:
+                    self._stop(executor)
+                    break
     
-    # TODO: Needs to be rewritten to send costs back to generator when we do parallel gradient descent, etc.
+    # Costs are not sent back to the generator here.  Generators that need feedback must set max_in_flight
     def _run_multi_process(self, raise_on_error: bool) -> None:
         fut_map = {}
+        submitted: set[str] = set()
         
-        # on mac m1 the default start method is set to spawn so change to fork instead
-        with concurrent.futures.ProcessPoolExecutor(self.max_processes, mp_context=mp.get_context('fork')) as executor:
+        with self._executor() as executor:
             for suggestion in self.generator:
-                if suggestion is None: continue
-                future = executor.submit(self.cost_func, suggestion)
+                if self._cancelled: break
+                if suggestion is None or self._get_completed(suggestion) is not None: continue
+                if self.deduplicate:
+                    key = suggestion_key(suggestion)
+                    if key in submitted: continue
+                    submitted.add(key)
+                future = executor.submit(_run_worker_cost_func, suggestion)
                 fut_map[future] = suggestion
                 
             for future in concurrent.futures.as_completed(fut_map):
-                try:
-                    cost, other_costs = future.result()
-                except Exception as e:
-                    _suggestion = fut_map.get(future)
-                    new_exc = type(e)(f'Exception: {str(e)} with suggestion: {_suggestion}').with_traceback(sys.exc_info()[2])
-                    if raise_on_error: raise new_exc
-                    else: print(str(new_exc))
-                    continue
-                suggestion = fut_map[future]
-                self.experiments.append(Experiment(suggestion, cost, other_costs))
+                if self._cancelled:
+                    self._stop(executor)
+                    break
+                self._add_result(fut_map[future], future.result, raise_on_error)
     
+    def _evaluate(self, suggestions: list[dict[str, Any]], budget: Any, raise_on_error: bool) -> list[Experiment]:
+        '''
+        Runs the cost function for each suggestion with this budget and returns the experiments in the same order as the suggestions.
+        Experiments that raised an exception have a cost of nan
+        '''
+        experiments: dict[int, Experiment] = {}
+        to_run: list[int] = []
+        first_index: dict[str, int] = {}
+        duplicates: dict[int, int] = {}
+        for i, suggestion in enumerate(suggestions):
+            experiment = self._get_completed(suggestion, budget)
+            if experiment is not None:
+                experiments[i] = experiment
+                continue
+            key = suggestion_key(suggestion)
+            if self.deduplicate and key in first_index:
+                duplicates[i] = first_index[key]
+            else:
+                first_index[key] = i
+                to_run.append(i)
+            
+        if self._single_process():
+            for i in to_run:
+                if self._cancelled: break
+                experiments[i] = self._add_result(suggestions[i], lambda: _timed_cost_func(self.cost_func, suggestions[i], budget), raise_on_error, budget)
+        elif len(to_run):
+            with self._executor(num_tasks=len(to_run)) as executor:
+                fut_map = {executor.submit(_run_worker_cost_func, suggestions[i], budget): i for i in to_run}
+                for future in concurrent.futures.as_completed(fut_map):
+                    if self._cancelled:
+                        self._stop(executor)
+                        break
+                    i = fut_map[future]
+                    experiments[i] = self._add_result(suggestions[i], future.result, raise_on_error, budget)
+        for i, j in duplicates.items(): 
+            if j in experiments: experiments[i] = experiments[j]
+        # If the run was cancelled, some suggestions may not have results
+        return [experiments[i] for i in range(len(suggestions)) if i in experiments]
+            
+    def _run_successive_halving(self, raise_on_error: bool) -> None:
+        assert self.budgets is not None
+        suggestions = [suggestion for suggestion in self.generator if suggestion is not None]
+        for i, budget in enumerate(self.budgets):
+            experiments = self._evaluate(suggestions, budget, raise_on_error)
+            if i == len(self.budgets) - 1 or self._cancelled: break
+            valid = sorted([experiment for experiment in experiments if np.isfinite(experiment.cost)], key=lambda x: x.cost)
+            num_promote = max(1, math.ceil(len(valid) * self.promote_fraction))
+            suggestions = [experiment.suggestion for experiment in valid[:num_promote]]
+            _logger.info(f'promoting {len(suggestions)} of {len(experiments)} suggestions from budget: {budget} to {self.budgets[i + 1]}')
+            if not len(suggestions): break
+        
+    def _batches(self) -> Generator[list[dict[str, Any]], None, None]:
+        assert self.batch_size is not None
+        batch: list[dict[str, Any]] = []
+        submitted: set[str] = set()
+        for suggestion in self.generator:
+            if suggestion is None or self._get_completed(suggestion) is not None: continue
+            if self.deduplicate:
+                key = suggestion_key(suggestion)
+                if key in submitted: continue
+                submitted.add(key)
+            batch.append(suggestion)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch): yield batch
+        
+    def _run_batches(self, raise_on_error: bool) -> None:
+        def add_batch(suggestions: list[dict[str, Any]], 
+                      get_result: Callable[[], tuple[np.ndarray, dict[str, np.ndarray], float, int, float]]) -> None:
+            try:
+                costs, other_costs, seconds, pid, peak_rss_mb = get_result()
+            except LimitExceededError as e:
+                for suggestion in suggestions:
+                    self._add_experiment(Experiment(suggestion, np.nan, {}, e.seconds / len(suggestions), e.pid, e.rss_mb, error=str(e)))
+                return
+            except Exception as e:
+                self._handle_error(e, f'batch starting at suggestion: {suggestions[0]}', raise_on_error)
+                return
+            for i, suggestion in enumerate(suggestions):
+                self._add_experiment(Experiment(suggestion, 
+                                                float(costs[i]), 
+                                                {key: float(values[i]) for key, values in other_costs.items()}, 
+                                                seconds / len(suggestions),
+                                                pid,
+                                                peak_rss_mb))
+                
+        if self._single_process():
+            for suggestions in self._batches():
+                if self._cancelled: break
+                add_batch(suggestions, lambda: _timed_batch_cost_func(self.cost_func, suggestions))
+            return
+            
+        with self._executor() as executor:
+            fut_map = {executor.submit(_run_worker_batch_cost_func, suggestions): suggestions for suggestions in self._batches()}
+            for future in concurrent.futures.as_completed(fut_map):
+                if self._cancelled:
+                    self._stop(executor)
+                    break
+                add_batch(fut_map[future], future.result)
+        
     def run(self, raise_on_error: bool = False) -> None:
         '''Run the optimizer.
         
@@ -126,8 +990,24 @@ class Optimizer:
             raise_on_error: If set to True, even if we are running a multiprocess optimization, any Exceptions will bubble up and stop the Optimizer.
               This can be useful for debugging to see stack traces for Exceptions.
         '''
-        if self.max_processes == 1: self._run_single_process()
-        else: self._run_multi_process(raise_on_error)
+        if self.journal is not None:
+            # Resume from experiments that completed in earlier runs
+            self.experiments = self.journal.experiments()
+            self._completed = {_experiment_key(experiment.suggestion, experiment.budget): experiment for experiment in self.experiments}
+        # Read the cache once instead of querying it for each suggestion
+        if self.cache is not None: self.cache.load()
+        _init_worker(self.cost_func, self.shared_data)
+        self._reset_run_stats()
+        self._cancelled = False
+        try:
+            if self.budgets is not None: self._run_successive_halving(raise_on_error)
+            elif self.batch_size is not None: self._run_batches(raise_on_error)
+            elif self.max_processes == 1 and self.executor_factory is None: self._run_single_process(raise_on_error)
+            elif self.max_in_flight is not None: self._run_bounded_multi_process(raise_on_error)
+            else: self._run_multi_process(raise_on_error)
+        except KeyboardInterrupt:
+            self._cancelled = True
+        if self._cancelled: _logger.warning(f'optimizer cancelled after {len(self.experiments)} experiments')
         
     def experiment_list(self, sort_order: str = 'lowest_cost') -> Sequence[Experiment]:
         '''Returns the list of experiments we have run
@@ -146,19 +1026,55 @@ class Optimizer:
             raise Exception(f'invalid sort order: {sort_order}')
         return experiments
     
-    def df_experiments(self, sort_column: str = 'cost', ascending: bool = True) -> pd.DataFrame:
+    def _valid_experiments(self) -> list[Experiment]:
+        '''Experiments without nans.  If we ran with budgets, only experiments that were run with the largest budget'''
+        experiments = [experiment for experiment in self.experiments if experiment.valid()]
+        if self.budgets is not None: experiments = [experiment for experiment in experiments if experiment.budget == self.budgets[-1]]
+        return experiments
+        
+    def df_experiments(self, sort_column: str = 'cost', ascending: bool = True, from_journal: bool = False) -> pd.DataFrame:
         '''
         Returns a dataframe containing experiment data, sorted by sort_column (default "cost")
+        
+        Args:
+            from_journal: If set, read experiments from the journal file instead of memory.  You can use this to look at 
+                results from another process, for example a notebook, while the optimizer is running.  Default False
         '''
-        if len(self.experiments) == 0: return None
-        pc_keys = flatten_keys(self.experiments)
-        # pc_keys = list(self.experiments[0].other_costs.keys())
-        sugg_keys = list(self.experiments[0].suggestion.keys())
-        records = [[exp.suggestion[k] for k in sugg_keys] + [exp.cost] + [exp.other_costs[k] for k in pc_keys]
-                   for exp in self.experiments if exp.valid()]
-        df = pd.DataFrame.from_records(records, columns=sugg_keys + ['cost'] + pc_keys)
-        df = df.sort_values(by=[sort_column], ascending=ascending)
-        return df
+        if from_journal:
+            assert_(self.journal is not None, 'journal not set')
+            return self.journal.df_experiments(sort_column, ascending)  # type: ignore
+        return _df_experiments(self.experiments, sort_column, ascending)
+    
+    def df_run_stats(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe with a row for each experiment completed in the last call to run, in the order they completed, 
+        with columns for:
+            parameters, budget if we ran with budgets, and cost
+            seconds: how long the cost function took
+            pid: process id of the worker that ran it
+            peak_rss_mb: peak memory of that worker
+            elapsed_seconds: time since the run started
+            completed: number of experiments completed so far
+            failed: number of experiments that raised an exception or were terminated so far
+            error: why the experiment was terminated, if it exceeded the time or memory limit
+            experiments_per_sec: completed / elapsed_seconds
+            num_workers: number of distinct worker processes seen so far
+            utilization: fraction of time workers spent running the cost function
+            max_peak_rss_mb: highest peak memory of any worker so far
+            eta_seconds: estimated time remaining, if num_suggestions was set
+        
+        You can use this to find slow regions of the parameter space and to decide how many workers to use.
+        Experiments that were loaded from the journal are not included since we did not run them.
+        '''
+        records = []
+        for experiment, stats in self._run_stats:
+            record = dict(experiment.suggestion)
+            if experiment.budget is not None: record['budget'] = experiment.budget
+            record.update({'cost': experiment.cost, 'seconds': experiment.seconds, 'pid': experiment.pid, 'peak_rss_mb': experiment.peak_rss_mb,
+                           'error': experiment.error})
+            record.update(stats)
+            records.append(record)
+        return pd.DataFrame.from_records(records)
     
     def plot_3d(self, 
                 x: str, 
@@ -171,8 +1087,13 @@ class Optimizer:
                 xlim: tuple[float, float] | None = None,
                 ylim: tuple[float, float] | None = None, 
                 vertical_spacing: float = 0.05,
+                max_bins: int = 100,
+                statistic: str | float = 'mean',
+                top_k: int = 0,
                 show: bool = True) -> go.Figure:
         '''Creates a 3D plot of the optimization output for plotting 2 parameters and costs.
+        Experiments are aggregated over a grid of at most max_bins x max_bins cells before plotting, so the size of the plot
+        does not depend on the number of experiments.
         
         Args:
             x: Name of the parameter to plot on the x axis, corresponding to the same name in the generator.
@@ -186,51 +1107,42 @@ class Optimizer:
                 from that dimension
             marker: Adds a marker to each point in x, y, z to show the actual data used for interpolation.  You can set this to None to turn markers off.
             vertical_spacing: Vertical space between subplots        
+            max_bins: Maximum number of bins along each axis.  A parameter with no more than this many distinct values gets a bin for each value.
+                Default 100
+            statistic: How to aggregate experiments that fall in the same cell.  See bin_values.  Default mean
+            top_k: If set, highlight this many experiments with the lowest cost.  Default 0
         '''
         if len(self.experiments) == 0: 
             _logger.warning('No experiments found')
             return go.Figure()
 
         # Get rid of nans
-        experiments = [experiment for experiment in self.experiments if experiment.valid()]
+        experiments = self._valid_experiments()
         if filter_func: experiments = filter_func(experiments)
         if not len(experiments):
             _logger.warning('No valid experiments found')
             return go.Figure()
 
-        if xlim:
-            experiments = [experiment for experiment in experiments if experiment.suggestion[x] >= xlim[0] and experiment.suggestion[x] <= xlim[1]]
-        if ylim:
-            experiments = [experiment for experiment in experiments if experiment.suggestion[y] >= ylim[0] and experiment.suggestion[y] <= ylim[1]]
-
-        xvalues = np.array([experiment.suggestion[x] for experiment in experiments])
-        yvalues = np.array([experiment.suggestion[y] for experiment in experiments])
-        zvalues = []
-
         if z == 'all':
-            zvalues.append(('cost', np.array([experiment.cost for experiment in experiments])))
-            if len(experiments[0].other_costs):
-                other_cost_keys = experiments[0].other_costs.keys()
-                for key in other_cost_keys:
-                    zvalues.append((key, np.array([experiment.other_costs[key] for experiment in experiments])))
-        elif z == 'cost':
-            zvalues.append(('cost', np.array([experiment.cost for experiment in experiments])))
+            metrics = sorted(['cost'] + list(experiments[0].other_costs.keys()))
         else:
-            zvalues.append((z, np.array([experiment.other_costs[z] for experiment in experiments])))
-
-        cols: dict[str, np.ndarray] = dict(x=xvalues, y=yvalues)
-        for metric, _z in zvalues:
-            cols[metric] = _z
-        _df = pd.DataFrame(cols).sort_values(by=['x', 'y'])
-        _x = np.unique(_df.x.values)
-        _y = np.unique(_df.y.values)
-        df = _df.set_index(['x', 'y']).reindex(itertools.product(_x, _y)).reset_index()
-
-        metrics = np.unique([metric[0] for metric in zvalues])
-        _z = np.full((len(metrics), len(_x), len(_y)), np.nan)
-
-        for i, metric in enumerate(metrics):
-            _z[i, :, :] = df[metric].values.reshape((len(_x), len(_y)))
+            metrics = [z]
+        columns = _experiment_columns(experiments, list(dict.fromkeys([x, y, 'cost'] + metrics)))
+        mask = np.full(len(experiments), True)
+        if xlim: mask &= (columns[x] >= xlim[0]) & (columns[x] <= xlim[1])
+        if ylim: mask &= (columns[y] >= ylim[0]) & (columns[y] <= ylim[1])
+        if not mask.any():
+            _logger.warning('No experiments found within xlim and ylim')
+            return go.Figure()
+        columns = {name: values[mask] for name, values in columns.items()}
+        
+        _z = []
+        for metric in metrics:
+            (_x, _y), zmatrix, counts = bin_values([columns[x], columns[y]], columns[metric], max_bins, statistic)
+            _z.append(zmatrix)
+        # Cells that contain at least one experiment
+        marker_x, marker_y = np.nonzero(counts)
+        top_indices = np.argsort(columns['cost'], kind='stable')[:top_k]
 
         fig = make_subplots(rows=len(metrics), cols=1, subplot_titles=metrics, shared_xaxes=True, vertical_spacing=vertical_spacing)
         fig.update_layout(height=height)
@@ -275,7 +1187,13 @@ class Optimizer:
             fig.add_trace(trace, row=row, col=1)
 
             if markers:
-                scatter = go.Scatter(x=df.x, y=df.y, mode='markers', marker=dict(color='black'))
+                scatter = go.Scatter(x=_x[marker_x], y=_y[marker_y], mode='markers', marker=dict(color='black'))
+                fig.add_trace(scatter, row=row, col=1)
+                
+            if top_k:
+                scatter = go.Scatter(x=columns[x][top_indices], y=columns[y][top_indices], mode='markers', name=f'top {top_k}',
+                                     text=[f'cost: {cost:.4g}' for cost in columns['cost'][top_indices]],
+                                     marker=dict(color='blue', symbol='star', size=12))
                 fig.add_trace(scatter, row=row, col=1)
 
         fig.update_layout(showlegend=False)
@@ -290,8 +1208,14 @@ class Optimizer:
                 marker_mode: str = 'lines+markers', 
                 height: int = 1000,
                 width: int = 0,
+                max_bins: int = 100,
+                statistic: str | float = 'mean',
+                quantiles: tuple[float, float] | None = None,
+                top_k: int = 0,
                 show: bool = True) -> go.Figure:
-        """Creates a 2D plot of the optimization output for plotting 1 parameter and costs
+        """Creates a 2D plot of the optimization output for plotting 1 parameter and costs.
+        Experiments are aggregated into at most max_bins bins along the x axis before plotting, so the size of the plot
+        does not depend on the number of experiments.
         
         Args:
             x: Name of the parameter to plot on the x axis, corresponding to the same name in the generator.
@@ -300,39 +1224,43 @@ class Optimizer:
               The name of another cost variable corresponding to the output from the cost function
               "all", which creates a subplot for cost plus all other costs
             marker_mode: see plotly mode.  Set to 'lines' to turn markers off
+            max_bins: Maximum number of bins along the x axis.  A parameter with no more than this many distinct values 
+                gets a bin for each value.  Default 100
+            statistic: How to aggregate experiments that fall in the same bin.  See bin_values.  Default mean
+            quantiles: If set, a lower and upper quantile, for example (0.1, 0.9), to show as a band around the line.  Default None
+            top_k: If set, highlight this many experiments with the lowest cost.  Default 0
          """
         if len(self.experiments) == 0:
             _logger.warning('No experiments found')
             return
 
         # Get rid of nans
-        experiments = [experiment for experiment in self.experiments if experiment.valid()]
-
-        xvalues = [experiment.suggestion[x] for experiment in experiments]
-        yvalues = []
+        experiments = self._valid_experiments()
 
         if y == 'all':
-            yvalues.append(('cost', np.array([experiment.cost for experiment in experiments])))
-            other_cost_keys = experiments[0].other_costs.keys()
-            for key in other_cost_keys:
-                yvalues.append((key, np.array([experiment.other_costs[key] for experiment in experiments])))
-        elif y == 'cost':
-            yvalues.append(('cost', np.array([experiment.cost for experiment in experiments])))
+            metrics = ['cost'] + list(experiments[0].other_costs.keys())
         else:
-            yvalues.append((y, np.array([experiment.other_costs[y] for experiment in experiments])))
-
-        xarray = np.array(xvalues)
-        x_sort_indices = np.argsort(xarray)
-        xarray = xarray[x_sort_indices]
-        fig = make_subplots(rows=len(yvalues), cols=1)
-
-        for i, tup in enumerate(yvalues):
-            name = tup[0]
-            yarray = tup[1]
-            yarray = yarray[x_sort_indices]
-            trace = go.Scatter(name=name, x=xarray, y=yarray, mode=marker_mode)
+            metrics = [y]
+        columns = _experiment_columns(experiments, list(dict.fromkeys([x, 'cost'] + metrics)))
+        top_indices = np.argsort(columns['cost'], kind='stable')[:top_k]
+        fig = make_subplots(rows=len(metrics), cols=1)
+
+        for i, name in enumerate(metrics):
             row = i + 1
+            (xarray,), yarray, counts = bin_values([columns[x]], columns[name], max_bins, statistic)
+            nonempty = counts > 0
+            if quantiles is not None:
+                for quantile, fill in zip(quantiles, [None, 'tonexty']):
+                    _, band, _ = bin_values([columns[x]], columns[name], max_bins, quantile)
+                    trace = go.Scatter(name=f'{name} q{quantile}', x=xarray[nonempty], y=band[nonempty], mode='lines', 
+                                       line=dict(width=0), fill=fill, fillcolor='rgba(99, 110, 250, 0.2)')
+                    fig.add_trace(trace, row=row, col=1)
+            trace = go.Scatter(name=name, x=xarray[nonempty], y=yarray[nonempty], mode=marker_mode)
             fig.add_trace(trace, row=row, col=1)
+            if top_k:
+                trace = go.Scatter(name=f'top {top_k}', x=columns[x][top_indices], y=columns[name][top_indices], mode='markers',
+                                   marker=dict(color='blue', symbol='star', size=12))
+                fig.add_trace(trace, row=row, col=1)
             fig.update_xaxes(title_text=x, row=row, col=1)
             fig.update_yaxes(title_text=name, row=row, col=1)
 
@@ -342,6 +1270,181 @@ class Optimizer:
         return fig
 
 
+class _GaussianProcess:
+    '''
+    Gaussian process regression with a squared exponential kernel on inputs scaled to [0, 1].  The length scale is picked from
+    a few candidates by maximizing marginal likelihood
+    '''
+    def __init__(self, noise: float = 1e-6) -> None:
+        self.noise = noise
+        
+    @staticmethod
+    def _kernel(a: np.ndarray, b: np.ndarray, length_scale: float) -> np.ndarray:
+        sq_dist = np.sum(a**2, axis=1)[:, np.newaxis] + np.sum(b**2, axis=1)[np.newaxis, :] - 2 * a @ b.T
+        return np.exp(-0.5 * np.maximum(sq_dist, 0) / length_scale**2)
+        
+    def fit(self, x: np.ndarray, y: np.ndarray) -> _GaussianProcess:
+        self._x = x
+        self._y_mean = y.mean()
+        self._y_std = y.std() if y.std() > 0 else 1.
+        y = (y - self._y_mean) / self._y_std
+        best_likelihood = -np.inf
+        for length_scale in [0.05, 0.1, 0.2, 0.4, 0.8]:
+            k = self._kernel(x, x, length_scale) + self.noise * np.eye(len(x))
+            try:
+                chol = np.linalg.cholesky(k)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = scipy.linalg.cho_solve((chol, True), y)
+            likelihood = -0.5 * y @ alpha - np.log(np.diag(chol)).sum()
+            if likelihood > best_likelihood:
+                best_likelihood = likelihood
+                self._length_scale, self._chol, self._alpha = length_scale, chol, alpha
+        assert_(np.isfinite(best_likelihood), 'could not fit gaussian process')
+        return self
+    
+    def predict(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns mean and standard deviation at each point'''
+        k = self._kernel(x, self._x, self._length_scale)
+        mean = k @ self._alpha
+        v = scipy.linalg.solve_triangular(self._chol, k.T, lower=True)
+        std = np.sqrt(np.maximum(1 - np.sum(v**2, axis=0), 1e-12))
+        return mean * self._y_std + self._y_mean, std * self._y_std
+    
+
+def _expected_improvement(mean: np.ndarray, std: np.ndarray, best: float, xi: float) -> np.ndarray:
+    '''Expected amount by which each point improves on best, when minimizing'''
+    improvement = best - mean - xi
+    z = improvement / std
+    return improvement * scipy.stats.norm.cdf(z) + std * scipy.stats.norm.pdf(z)
+
+
+class _ParamSpace:
+    '''Converts between suggestions and points in [0, 1]^n'''
+    def __init__(self, params: dict[str, tuple[float, float] | Sequence[Any]]) -> None:
+        assert_(len(params) > 0, 'no params')
+        self.params = params
+        for name, values in params.items():
+            assert_(len(values) > 0, f'no values for param: {name}')
+            if isinstance(values, tuple): assert_(len(values) == 2 and values[0] < values[1], f'invalid range for param: {name} {values}')
+            
+    def to_suggestion(self, point: np.ndarray) -> dict[str, Any]:
+        suggestion = {}
+        for i, (name, values) in enumerate(self.params.items()):
+            if isinstance(values, tuple):
+                low, high = values
+                value = low + point[i] * (high - low)
+                if isinstance(low, int) and isinstance(high, int): value = int(round(value))
+            else:
+                value = values[min(int(point[i] * len(values)), len(values) - 1)]
+            suggestion[name] = value
+        return suggestion
+    
+    def to_point(self, suggestion: dict[str, Any]) -> np.ndarray:
+        point = np.empty(len(self.params))
+        for i, (name, values) in enumerate(self.params.items()):
+            if isinstance(values, tuple):
+                low, high = values
+                point[i] = (suggestion[name] - low) / (high - low)
+            else:
+                # Middle of the bucket for this choice
+                point[i] = (list(values).index(suggestion[name]) + 0.5) / len(values)
+        return point
+    
+
+def surrogate_generator(params: dict[str, tuple[float, float] | Sequence[Any]],
+                        max_experiments: int = 50,
+                        batch_size: int = 4,
+                        num_initial: int | None = None,
+                        xi: float = 0.01,
+                        num_candidates: int = 2000,
+                        seed: int = 0) -> Generator[dict[str, Any] | None, CostResult | None, None]:
+    '''
+    A generator for the Optimizer that fits a Gaussian process to completed experiments and suggests the points with the 
+    highest expected improvement in cost.  Suggestions are made in batches, so several of them can run in parallel.  
+    Each batch is picked greedily, assuming that suggestions that are still running will cost as much as the best 
+    result so far, so the suggestions in a batch are spread out.  The model is refit with all results received so far 
+    before each batch.
+    
+    Use it with max_in_flight set to the number of processes so results are sent back as soon as they complete.  
+    It also works in a single process, where the result of each suggestion is sent back before the next one.
+    
+    Args:
+        params: Parameter name -> either a (low, high) tuple for a numeric parameter, which is an integer 
+            parameter if both are ints, or a list of choices
+        max_experiments: Total number of suggestions to make.  Default 50
+        batch_size: Number of suggestions to pick each time the model is refit.  Default 4
+        num_initial: Number of random suggestions, spread over the parameter space, to make before fitting the model.
+            Default is max(batch_size, 2 * number of params) 
+        xi: Improvements in cost smaller than this are not counted, higher values explore more.  Default 0.01
+        num_candidates: Number of random points in which we look for the highest expected improvement.  Default 2000
+        seed: Random seed.  Default 0
+    '''
+    rng = np.random.default_rng(seed)
+    space = _ParamSpace(params)
+    num_params = len(params)
+    if num_initial is None: num_initial = max(batch_size, 2 * num_params)
+    num_initial = min(num_initial, max_experiments)
+    
+    # Latin hypercube so initial points are spread out in each dimension
+    initial = (np.argsort(rng.random((num_params, num_initial)), axis=1).T + rng.random((num_initial, num_params))) / num_initial
+    queue: collections.deque[np.ndarray] = collections.deque(initial)
+    done_x: list[np.ndarray] = []
+    done_y: list[float] = []
+    done_keys: set[str] = set()
+    pending: dict[str, np.ndarray] = {}
+    
+    def receive(value: CostResult | None) -> None:
+        if value is None: return
+        key, cost = suggestion_key(value.suggestion), value[0]
+        point = pending.pop(key, None)
+        if point is None: return
+        done_keys.add(key)
+        if np.isfinite(cost):
+            done_x.append(point)
+            done_y.append(cost)
+            
+    def propose(num: int) -> list[np.ndarray]:
+        if len(done_y) < 2: return list(rng.random((num, num_params)))
+        x = np.array(done_x + list(pending.values()))
+        best = min(done_y)
+        y = np.array(done_y + [best] * len(pending))
+        batch = []
+        for _ in range(num):
+            gp = _GaussianProcess().fit(x, y)
+            # Candidates are random points plus points near the best results so far
+            best_x = x[np.argsort(y)[:5]]
+            local = best_x[rng.integers(len(best_x), size=num_candidates // 2)] + rng.normal(0, 0.05, (num_candidates // 2, num_params))
+            candidates = np.vstack([rng.random((num_candidates - len(local), num_params)), np.clip(local, 0, 1)])
+            mean, std = gp.predict(candidates)
+            point = candidates[np.argmax(_expected_improvement(mean, std, best, xi))]
+            batch.append(point)
+            x = np.vstack([x, point])
+            y = np.append(y, best)
+        return batch
+    
+    num_suggested = 0
+    num_skipped = 0
+    while num_suggested < max_experiments:
+        if not len(queue):
+            if len(done_y) < 2 and len(pending):
+                # Wait for results so we can fit the model.  None is sent back when there are no results outstanding
+                receive((yield None))
+                continue
+            queue.extend(propose(min(batch_size, max_experiments - num_suggested)))
+        suggestion = space.to_suggestion(queue.popleft())
+        key = suggestion_key(suggestion)
+        if key in pending or key in done_keys:
+            # Integer and choice parameters can map different points to the same suggestion.  Try a random point instead
+            num_skipped += 1
+            if num_skipped > 10 * max_experiments: return
+            queue.appendleft(rng.random(num_params))
+            continue
+        pending[key] = space.to_point(suggestion)
+        num_suggested += 1
+        receive((yield suggestion))
+
+
 # Functions used in unit testing
 def _generator_1d() -> Generator[dict[str, Any], tuple[float, dict[str, float]], None]:
     for x in np.arange(0, np.pi * 2, 0.1):
@@ -355,6 +1458,18 @@ def _cost_func_1d(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
     return ret
 
 
+def _cost_func_budget_1d(suggestion: dict[str, Any], budget: float) -> tuple[float, dict[str, float]]:
+    # Cost is noisier when the budget is smaller, like a backtest on fewer bars
+    x = suggestion['x']
+    cost = np.sin(x) + 0.2 * (1 - budget) * np.cos(7 * x)
+    return cost, {}
+
+
+def _batch_cost_func_2d(params: dict[str, np.ndarray]) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    cost = np.sin(np.sqrt(params['x']**2 + params['y'] ** 2))
+    return cost, {'sharpe': cost, 'std': -0.1 * cost}
+
+
 def _generator_2d() -> Generator[dict[str, Any], tuple[float, dict[str, float]], None]:
     for x in np.arange(0, np.pi * 2, 0.5):
         for y in np.arange(0, np.pi * 2, 0.5):
@@ -367,19 +1482,218 @@ def _cost_func_2d(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
     cost = np.sin(np.sqrt(x**2 + y ** 2))
     return cost, {'sharpe': cost, 'std': -0.1 * cost}
 
+
+def _cost_func_shared(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
+    # Reads its inputs from shared memory instead of capturing them
+    df = get_shared_data().get_df('prices')
+    returns = np.diff(df.c.values[::suggestion['step']])
+    return -returns.mean(), {'pid': float(os.getpid())}
+
+
+def _cost_func_thread_limit(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
+    import threadpoolctl
+    return 0., {'threads': float(max([info['num_threads'] for info in threadpoolctl.threadpool_info()]))}
+
+
+def _cost_func_window(suggestion: dict[str, Any], budget: tuple[int, int]) -> tuple[float, dict[str, float]]:
+    # Parameters and budgets that are not json types
+    assert_(isinstance(suggestion['win'], tuple) and isinstance(suggestion['d'], np.datetime64) and isinstance(budget, tuple))
+    fast, slow = suggestion['win']
+    return float(np.sin(fast / slow) * (budget[1] - budget[0])), {}
+
+
+def _cost_func_slow(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
+    # A pathological region of the parameter space that takes much longer to run
+    if suggestion['x'] > 5: time.sleep(60)
+    return _cost_func_1d(suggestion)
+
+            
+def _adaptive_generator_1d() -> Generator[dict[str, Any] | None, CostResult | None, None]:
+    '''
+    Evaluates a coarse grid, then repeatedly waits for all results and searches on either side of the lowest cost found so far
+    '''
+    best: CostResult | None = None
+    
+    def update(result: CostResult | None) -> None:
+        nonlocal best
+        if result is not None and (best is None or result[0] < best[0]): best = result
+        
+    for x in np.arange(0, np.pi * 2, 1.):
+        update((yield {'x': x}))
+    for step in [0.5, 0.25, 0.125]:
+        # Yield None till the optimizer sends None back, meaning there are no more results outstanding
+        while True:
+            result = yield None
+            if result is None: break
+            update(result)
+        assert best is not None
+        for x in [best.suggestion['x'] - step, best.suggestion['x'] + step]:
+            update((yield {'x': x}))
+            
+            
+def _duplicate_generator_1d(received: list[tuple[float, dict[str, float]]]) -> Generator[dict[str, Any], tuple[float, dict[str, float]], None]:
+    '''Yields each suggestion twice and unpacks each result it is sent into cost and other costs'''
+    for x in [0., 1., 2., 3.]:
+        for _ in range(2):
+            value = yield {'x': x}
+            if value is None: continue
+            cost, other_costs = value
+            received.append(value)
+            
+            
+class _Mode(enum.Enum):
+    A = 1
+    B = 2
+    
+
+def _cost_func_mode(suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
+    return float(suggestion['mode'].value * suggestion['x']), {}
+            
             
 def test_optimize():
+    from pyqstrat.pq_utils import get_temp_dir
     max_processes = 1 if os.name == 'nt' else 4
+    
+    optimizer = Optimizer('test', _generator_1d(), _cost_func_1d, max_processes=1)
+    optimizer.run(raise_on_error=True)
+    # All suggestions are evaluated when costs are sent back to the generator
+    assert_(len(optimizer.experiments) == len(np.arange(0, np.pi * 2, 0.1)))
 
+    optimizer = Optimizer('test', _adaptive_generator_1d(), _cost_func_1d, max_processes=max_processes, max_in_flight=max_processes)
+    optimizer.run(raise_on_error=True)
+    assert_(len(optimizer.experiments) == 13)
+    assert_(math.isclose(min([experiment.cost for experiment in optimizer.experiments]), np.sin(4.75)))
+    
+    # Generators that unpack (cost, other_costs) work with max_in_flight, and duplicates of running suggestions are not run
+    for _max_processes in [1, max_processes]:
+        received: list[tuple[float, dict[str, float]]] = []
+        optimizer = Optimizer('test', _duplicate_generator_1d(received), _cost_func_1d, max_processes=_max_processes, max_in_flight=2)
+        optimizer.run(raise_on_error=True)
+        assert_(sorted([experiment.suggestion['x'] for experiment in optimizer.experiments]) == [0., 1., 2., 3.])
+        assert_(len(received) > 0 and all([isinstance(value, CostResult) for value in received]))
+        assert_(all([value[0] == np.sin(value.suggestion['x']) for value in received]))  # type: ignore
+    
     optimizer_1d = Optimizer('test', _generator_1d(), _cost_func_1d, max_processes=max_processes)
     optimizer_1d.run(raise_on_error=True)
     if has_display():
         optimizer_1d.plot_2d(x='x', marker_mode='lines+markers', title='Optimizer 1D Test')
     
-    optimizer_2d = Optimizer('test', _generator_2d(), _cost_func_2d, max_processes=max_processes)
+    progress: list[dict[str, float]] = []
+    optimizer_2d = Optimizer('test', _generator_2d(), _cost_func_2d, max_processes=max_processes, 
+                             progress_callback=progress.append, num_suggestions=169)
     optimizer_2d.run()
+    df_stats = optimizer_2d.df_run_stats()
+    assert_(len(df_stats) == len(progress) == 169 and df_stats.completed.iloc[-1] == 169 and df_stats.failed.iloc[-1] == 0)
+    assert_(df_stats.eta_seconds.iloc[-1] == 0 and (df_stats.seconds > 0).all() and 0 < df_stats.num_workers.iloc[-1] <= max_processes)
+    assert_(os.getpid() not in df_stats.pid.values and (df_stats.peak_rss_mb > 0).all())
+    
+    # Cores are split between worker processes and the threads each one uses
+    optimizer = Optimizer('test', ({'x': x} for x in range(8)), _cost_func_thread_limit, max_processes=2, thread_budget=ThreadBudget(num_cores=8))
+    optimizer.run(raise_on_error=True)
+    assert_(len(optimizer.experiments) == 8 and all([experiment.other_costs['threads'] == 4 for experiment in optimizer.experiments]))
+    
+    # Experiments that run too long are terminated and stored with the reason.  The run can be cancelled, keeping completed experiments
+    start_time = time.perf_counter()
+    num_slow = (np.arange(0, np.pi * 2, 0.1) > 5).sum()
+    for _max_processes in [1, max_processes]:
+        optimizer = Optimizer('test', _generator_1d(), _cost_func_slow, max_processes=_max_processes, timeout_seconds=0.5)
+        optimizer.run(raise_on_error=True)
+        errors = [experiment for experiment in optimizer.experiments if experiment.error]
+        assert_(len(optimizer.experiments) == 63 and len(errors) == num_slow and all([x.error.startswith('timeout') for x in errors]))
+        assert_(optimizer.df_run_stats().failed.iloc[-1] == num_slow and len(optimizer.df_experiments()) == 63 - num_slow)
+    assert_(time.perf_counter() - start_time < 60)
+    optimizer = Optimizer('test', _generator_1d(), _cost_func_slow, max_processes=max_processes, 
+                          progress_callback=lambda stats: optimizer.cancel() if stats['completed'] >= 10 else None)
+    optimizer.run(raise_on_error=True)
+    assert_(10 <= len(optimizer.experiments) < 63)
+    
+    # Suggestions with values that cannot be converted to json are still deduplicated
+    for _max_processes in [1, max_processes]:
+        suggestions = [{'mode': mode, 'x': x} for mode in _Mode for x in range(3)]
+        optimizer = Optimizer('test', (s for s in suggestions * 2), _cost_func_mode, max_processes=_max_processes)
+        optimizer.run(raise_on_error=True)
+        assert_(len(optimizer.experiments) == 6 and len(optimizer.df_run_stats()) == 6)
+        
+    # Duplicate suggestions are only evaluated once, and results are reused across runs with the same cache version
+    cache_file = f'{get_temp_dir()}/test_optimize_cache.sqlite'
+    if os.path.exists(cache_file): os.remove(cache_file)
+    for i, _max_processes in enumerate([1, max_processes]):
+        optimizer = Optimizer('test', (s for _ in range(2) for s in _generator_1d()), _cost_func_1d, max_processes=_max_processes,
+                              cache=cache_file, cache_version='v1')
+        optimizer.run(raise_on_error=True)
+        assert_(len(optimizer.experiments) == 63)
+        # The second run gets all results from the cache
+        assert_(len(optimizer.df_run_stats()) == (63 if i == 0 else 0))
+    optimizer = Optimizer('test', _generator_1d(), _cost_func_1d, max_processes=1, cache=cache_file, cache_version='v2')
+    optimizer.run()
+    assert_(len(optimizer.df_run_stats()) == 63)
+    
+    # Resume an optimization that stopped partway through
+    journal_file = f'{get_temp_dir()}/test_optimize_journal.sqlite'
+    if os.path.exists(journal_file): os.remove(journal_file)
+    optimizer = Optimizer('test', itertools.islice(_generator_1d(), 20), _cost_func_1d, max_processes=max_processes, journal=journal_file)
+    optimizer.run(raise_on_error=True)
+    assert_(len(optimizer.df_experiments(from_journal=True)) == 20)
+    resumed = Optimizer('test', _generator_1d(), _cost_func_1d, max_processes=max_processes, journal=journal_file)
+    resumed.run(raise_on_error=True)
+    df = resumed.df_experiments(from_journal=True)
+    assert_(len(df) == len(np.arange(0, np.pi * 2, 0.1)) and len(np.unique(df.x)) == len(df))
+    assert_(math.isclose(df.cost.min(), -1, abs_tol=1e-3))
+    
+    # Resumed experiments have the same parameter and budget types as experiments that were just run
+    journal_file = f'{get_temp_dir()}/test_optimize_journal_types.sqlite'
+    if os.path.exists(journal_file): os.remove(journal_file)
+    suggestions = [{'win': (fast, 20), 'd': np.datetime64('2023-01-01')} for fast in range(1, 9)]
+    budgets = [(0, 50), (0, 100)]
+    optimizer = Optimizer('test', iter(suggestions), _cost_func_window, max_processes=1, budgets=budgets, journal=journal_file)
+    optimizer.run(raise_on_error=True)
+    resumed = Optimizer('test', iter(suggestions), _cost_func_window, max_processes=1, budgets=budgets, journal=journal_file)
+    resumed.run(raise_on_error=True)
+    assert_(len(resumed.df_run_stats()) == 0 and len(resumed.experiments) == len(optimizer.experiments))
+    assert_([(exp.suggestion, exp.budget) for exp in resumed.experiments] == [(exp.suggestion, exp.budget) for exp in optimizer.experiments])
+    assert_(len(resumed._valid_experiments()) == len(optimizer._valid_experiments()) > 0)
     if has_display():
         optimizer_2d.plot_3d(x='x', y='y')
+    # Plots aggregate experiments into at most max_bins bins along each axis, so their size does not grow with the number of experiments
+    fig = optimizer_2d.plot_3d(x='x', y='y', z='cost', max_bins=5, top_k=3, show=False)
+    assert_(np.shape(fig.data[0].z) == (5, 5) and len(fig.data[1].x) == 25 and len(fig.data[2].x) == 3)
+    assert_(fig.data[2].text[0] == f'cost: {optimizer_2d.df_experiments().cost.min():.4g}')
+    fig = optimizer_2d.plot_2d(x='x', y='cost', max_bins=5, quantiles=(0.1, 0.9), show=False)
+    assert_([len(trace.x) for trace in fig.data] == [5, 5, 5])
+
+    # Surrogate model search gets close to the minimum of -1 with far fewer experiments than the 169 in the grid.
+    # With several experiments in flight, results come back in a nondeterministic order, so only check that it runs to completion
+    for _max_processes, max_in_flight, max_cost in [(1, None, -0.99), (max_processes, max_processes, 0.)]:
+        generator = surrogate_generator({'x': (0., np.pi * 2), 'y': (0., np.pi * 2)}, max_experiments=30)
+        optimizer = Optimizer('test', generator, _cost_func_2d, max_processes=_max_processes, max_in_flight=max_in_flight)  # type: ignore
+        optimizer.run(raise_on_error=True)
+        assert_(len(optimizer.experiments) == 30 and min([experiment.cost for experiment in optimizer.experiments]) < max_cost)
+        
+    # Batches give the same results as calling the cost function for each suggestion
+    for _max_processes in [1, max_processes]:
+        optimizer = Optimizer('test', _generator_2d(), _batch_cost_func_2d, max_processes=_max_processes, batch_size=50)
+        optimizer.run(raise_on_error=True)
+        df = optimizer.df_experiments().sort_values(['x', 'y']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(df, optimizer_2d.df_experiments().sort_values(['x', 'y']).reset_index(drop=True), check_like=True)
+        
+    # Successive halving, 63 suggestions, then the best 32, then the best 16
+    for _max_processes in [1, max_processes]:
+        optimizer = Optimizer('test', _generator_1d(), _cost_func_budget_1d, max_processes=_max_processes, budgets=[0.25, 0.5, 1.])
+        optimizer.run(raise_on_error=True)
+        assert_([experiment.budget for experiment in optimizer.experiments].count(1.) == 16 and len(optimizer.experiments) == 111)
+        df = optimizer.df_experiments()
+        assert_(math.isclose(df[df.budget == 1.].cost.min(), -1, abs_tol=1e-3))
+        assert_(len(optimizer._valid_experiments()) == 16)
+        
+    # Workers started with spawn attach to the shared data instead of inheriting it
+    with SharedDataStore() as store:
+        store.add_df('prices', pd.DataFrame({'c': np.arange(1000.) ** 2}))
+        optimizer = Optimizer('test', ({'step': step} for step in range(1, 9)), _cost_func_shared, max_processes=2, 
+                              shared_data=store, mp_start_method='spawn')
+        optimizer.run(raise_on_error=True)
+        df = optimizer.df_experiments()
+        assert_(len(df) == 8 and df.step.iloc[0] == 8)
+        assert_(os.getpid() not in df.pid.values)
             
 
 if __name__ == "__main__":
@@ -4,26 +4,135 @@
 from __future__ import annotations
 import pandas as pd
 import numpy as np
-from functools import reduce
+import io
+import heapq
+import sys
+import time
+import pickle
+import concurrent.futures
+import multiprocessing as mp
 from pyqstrat.evaluator import compute_return_metrics, display_return_metrics, plot_return_metrics
 from pyqstrat.strategy import Strategy
+from pyqstrat.pq_types import Contract, ContractGroup
 from pyqstrat.pq_utils import get_child_logger
-from typing import Any
+from pyqstrat.thread_budget import ThreadBudget, limit_threads
+from typing import Any, Iterator
 from collections.abc import Sequence
 
 _logger = get_child_logger(__name__)
 
 NAT = np.datetime64('NaT')
 
+# Account attributes that are updated while running rules and sent back from worker processes
+_ACCOUNT_RESULT_ATTRS = ['contracts', '_trades', '_trades_for_date', '_num_trades_for_cgroup_date', '_pnl', 
+                         'symbol_pnls_by_contract_group', 'symbol_pnls']
+
+# Strategies that worker processes inherit when they are forked
+_worker_strategies: dict[str, Strategy] = {}
+
+
+def _rule_index_range(timestamps: np.ndarray, start_date: np.datetime64, end_date: np.datetime64) -> tuple[int, int]:
+    '''Returns start and end (exclusive) indices of timestamps between start date and end date, inclusive'''
+    start_idx = 0 if np.isnat(start_date) else int(np.searchsorted(timestamps, start_date))
+    end_idx = len(timestamps) if np.isnat(end_date) else int(np.searchsorted(timestamps, end_date, side='right'))
+    return start_idx, end_idx
+    
+
+def _run_strategy_rules(strategy: Strategy, start_date: np.datetime64, end_date: np.datetime64) -> None:
+    '''Run rules for a single strategy for timestamps between start date and end date, inclusive'''
+    strategy._generate_order_iterations(start_date=start_date, end_date=end_date)
+    start_idx, end_idx = _rule_index_range(strategy.timestamps, start_date, end_date)
+    for idx in range(start_idx, end_idx):
+        strategy._run_iteration(idx)
+    strategy.account.calc(strategy.timestamps[-1])
+    
+
+def _shared_objects(strategies: Sequence[Strategy]) -> dict[int, Any]:
+    '''
+    Objects that exist before worker processes are forked, so workers can refer to them by id instead of pickling them.
+    '''
+    objs: list[Any] = list(Contract._instances.values()) + list(ContractGroup._instances.values())
+    for strategy in strategies:
+        account = strategy.account
+        objs += [strategy.timestamps, strategy.strategy_context, 
+                 account.timestamps, account.calc_timestamps, account._price_function, account.strategy_context]
+    return {id(obj): obj for obj in objs}
+
+
+class _ResultPickler(pickle.Pickler):
+    def __init__(self, file: io.BytesIO, shared: dict[int, Any]) -> None:
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+        
+    def persistent_id(self, obj: Any) -> int | None:
+        if id(obj) in self.shared: return id(obj)
+        return None
+    
+
+class _ResultUnpickler(pickle.Unpickler):
+    def __init__(self, file: io.BytesIO, shared: dict[int, Any]) -> None:
+        super().__init__(file)
+        self.shared = shared
+        
+    def persistent_load(self, pid: Any) -> Any:
+        return self.shared[pid]
+    
+
+def _run_strategy_stages(strategy: Strategy, 
+                         stages: Sequence[str], 
+                         start_date: np.datetime64, 
+                         end_date: np.datetime64) -> list[tuple[str, float]]:
+    '''
+    Runs the given stages, i.e. "indicators", "signals" or "rules" for a strategy in order and returns how long each one took
+    '''
+    timings = []
+    for stage in stages:
+        start_time = time.perf_counter()
+        if stage == 'indicators':
+            strategy.run_indicators()
+        elif stage == 'signals':
+            strategy.run_signals()
+        else:
+            assert stage == 'rules', f'unknown stage: {stage}'
+            _run_strategy_rules(strategy, start_date, end_date)
+        timings.append((stage, time.perf_counter() - start_time))
+    return timings
+
+
+def _run_strategy_in_worker(name: str, stages: Sequence[str], start_date: np.datetime64, end_date: np.datetime64) -> bytes:
+    '''
+    Runs stages for a strategy in a forked worker process and returns their results.  
+    Objects created before the fork, such as contracts, price functions and timestamps, are sent back as references 
+    so only indicator and signal values, the order and trade journal, open orders and the pnl ledgers are copied back to the 
+    parent process.
+    '''
+    strategy = _worker_strategies[name]
+    shared = _shared_objects([strategy])
+    result: dict[str, Any] = {'timings': _run_strategy_stages(strategy, stages, start_date, end_date)}
+    if 'indicators' in stages: result['indicator_values'] = strategy.indicator_values
+    if 'signals' in stages: result['signal_values'] = strategy.signal_values
+    if 'rules' in stages: 
+        result['orders'] = strategy._orders
+        result['trades'] = strategy._trades
+        result['open_orders'] = strategy._get_open_order_state()
+        result['account'] = {attr: getattr(strategy.account, attr) for attr in _ACCOUNT_RESULT_ATTRS}
+    f = io.BytesIO()
+    _ResultPickler(f, shared).dump(result)
+    return f.getvalue()
+
 
 class Portfolio:
     '''A portfolio contains one or more strategies that run concurrently so you can test running strategies that are uncorrelated together.'''
-    def __init__(self, name: str = 'main') -> None:
+    def __init__(self, name: str = 'main', thread_budget: ThreadBudget | None = None) -> None:
         '''Args:
             name: String used for displaying this portfolio
+            thread_budget: When strategies run in worker processes, how cores are split between processes and the threads 
+                each process uses.  Default splits cores evenly between processes
         '''
         self.name = name
+        self.thread_budget = thread_budget if thread_budget is not None else ThreadBudget()
         self.strategies: dict[str, Strategy] = {}
+        self.stage_timings: list[tuple[str, str, float, int]] = []
         
     def add_strategy(self, name: str, strategy: Strategy) -> None:
         '''
@@ -34,107 +143,193 @@ class Portfolio:
         self.strategies[name] = strategy
         strategy.name = name
         
-    def run_indicators(self, strategy_names: Sequence[str] | None = None) -> None:
+    def run_indicators(self, strategy_names: Sequence[str] | None = None, max_processes: int | None = 1) -> None:
         '''Compute indicators for the strategies specified
         
         Args:
             strategy_names: By default this is set to None and we use all strategies.
+            max_processes: Number of worker processes used to compute indicators for different strategies in parallel.  
+                See run function
         '''
-        if strategy_names is None: strategy_names = list(self.strategies.keys())
-        if len(strategy_names) == 0: raise Exception('a portfolio must have at least one strategy')
-        for name in strategy_names:
-            _logger.info(f'running strategy indicators: {name}')
-            self.strategies[name].run_indicators()
+        self._run_stages(strategy_names, ['indicators'], NAT, NAT, max_processes)
                 
-    def run_signals(self, strategy_names: Sequence[str] | None = None) -> None:
+    def run_signals(self, strategy_names: Sequence[str] | None = None, max_processes: int | None = 1) -> None:
         '''Compute signals for the strategies specified.  Must be called after run_indicators
         
         Args:
             strategy_names: By default this is set to None and we use all strategies.
+            max_processes: Number of worker processes used to compute signals for different strategies in parallel.  
+                See run function
+        '''
+        self._run_stages(strategy_names, ['signals'], NAT, NAT, max_processes)
+        
+    def _get_max_processes(self, max_processes: int | None) -> int | None:
+        if sys.platform in ['win32', 'cygwin']:
+            if max_processes is not None and max_processes != 1:
+                raise Exception("max_processes must be 1 on Microsoft Windows")
+            max_processes = 1
+        return max_processes
+        
+    def _record_timing(self, name: str, stage: str, seconds: float) -> None:
+        num_bars = len(self.strategies[name].timestamps)
+        self.stage_timings.append((name, stage, seconds, num_bars))
+        _logger.info(f'{name} {stage}: {seconds:.3f} sec {num_bars / max(seconds, 1e-9):.0f} bars/sec')
+        
+    def _run_stages(self, 
+                    strategy_names: Sequence[str] | None, 
+                    stages: Sequence[str], 
+                    start_date: np.datetime64, 
+                    end_date: np.datetime64, 
+                    max_processes: int | None) -> None:
+        '''
+        Strategies in a portfolio are independent, so we can run their stages in parallel, one strategy per worker process.
+        A strategy's stages are run one after the other in the same process so each one is computed exactly once.
+        Rules in the same process are run on the merged timeline of all strategies so that they are called in time order.
         '''
         if strategy_names is None: strategy_names = list(self.strategies.keys())
         if len(strategy_names) == 0: raise Exception('a portfolio must have at least one strategy')
-        for name in strategy_names: 
-            _logger.info(f'running signals: {name}')
-            self.strategies[name].run_indicators()
-            self.strategies[name].run_signals()
+        max_processes = self._get_max_processes(max_processes)
+        
+        if max_processes != 1 and len(strategy_names) > 1:
+            self._run_stages_multi_process(strategy_names, stages, start_date, end_date, max_processes)
+            return
+        
+        for name in strategy_names:
+            timings = _run_strategy_stages(self.strategies[name], [stage for stage in stages if stage != 'rules'], start_date, end_date)
+            for stage, seconds in timings: self._record_timing(name, stage, seconds)
             
+        if 'rules' in stages: self._run_rules_single_process(strategy_names, start_date, end_date)
+                
     def _generate_order_iterations(self, 
                                    strategies: Sequence[Strategy], 
                                    start_date: np.datetime64 = NAT, 
-                                   end_date: np.datetime64 = NAT) -> tuple[np.ndarray, Sequence[tuple[Strategy, np.ndarray]]]:
+                                   end_date: np.datetime64 = NAT) -> Iterator[tuple[Strategy, int]]:
         '''
+        Yields each strategy and index into its timestamps in timestamp order, merging strategy timelines with a heap 
+        so each strategy is only visited at its own timestamps.  When strategies have the same timestamp, 
+        they are visited in the order they are passed in.
+        
         >>> class Strategy:
         ...    def __init__(self, num): 
         ...        self.timestamps = [
         ...            np.array(['2018-01-01', '2018-01-02', '2018-01-03'], dtype='M8[D]'),
-        ...            np.array(['2018-01-02', '2018-01-03', '2018-01-04'], dtype='M8[D]')][num]
+        ...            np.array(['2018-01-02 00:00', '2018-01-03 12:00', '2018-01-04 00:00'], dtype='M8[m]')][num]
         ...        self.num = num
-        ...    def _generate_order_iterations(self, start_date, end_date):
-        ...        pass
         ...    def __repr__(self):
         ...        return f'{self.num}'
-        >>> all_timestamps, orders_iter = Portfolio._generate_order_iterations(None, [Strategy(0), Strategy(1)])
-        >>> assert(all(all_timestamps == np.array(['2018-01-01', '2018-01-02', '2018-01-03','2018-01-04'], dtype = 'M8[D]')))
-        >>> assert(all(orders_iter[0][1] == np.array([0, 1, 2, 3])))
-        >>> assert(all(orders_iter[1][1] == np.array([0, 0, 1, 2])))
+        >>> list(Portfolio._generate_order_iterations(None, [Strategy(0), Strategy(1)]))
+        [(0, 0), (0, 1), (1, 0), (0, 2), (1, 1), (1, 2)]
+        >>> list(Portfolio._generate_order_iterations(None, [Strategy(0), Strategy(1)], end_date=np.datetime64('2018-01-03')))
+        [(0, 0), (0, 1), (1, 0), (0, 2)]
         '''
-        if strategies is None: strategies = self.strategies.values
-            
-        timestamps_list = [strategy.timestamps for strategy in strategies]
+        heap: list[tuple[int, int, int]] = []
+        end_indices: list[int] = []
+        timestamps_list: list[np.ndarray] = []
+        for k, strategy in enumerate(strategies):
+            # compare timestamps as integers so strategies with different timestamp units can be merged
+            timestamps = strategy.timestamps.astype('M8[ns]').view(np.int64)
+            start_idx, end_idx = _rule_index_range(strategy.timestamps, start_date, end_date)
+            timestamps_list.append(timestamps)
+            end_indices.append(end_idx)
+            if start_idx < end_idx: heap.append((int(timestamps[start_idx]), k, start_idx))
+        heapq.heapify(heap)
         
-        all_timestamps = np.array(reduce(np.union1d, timestamps_list))
-        
-        if not np.isnat(start_date):
-            all_timestamps = all_timestamps[(all_timestamps >= start_date)]
-        if not np.isnat(end_date):
-            all_timestamps = all_timestamps[(all_timestamps <= end_date)]
-        
-        iterations = []
-        
-        for strategy in strategies:
-            indices = np.searchsorted(strategy.timestamps, all_timestamps)
-            iterations.append((strategy, indices))
-            strategy._generate_order_iterations(start_date=start_date, end_date=end_date)
-            
-        return all_timestamps, iterations
+        while heap:
+            _, k, idx = heap[0]
+            yield strategies[k], idx
+            idx += 1
+            if idx < end_indices[k]:
+                heapq.heapreplace(heap, (int(timestamps_list[k][idx]), k, idx))
+            else:
+                heapq.heappop(heap)
                 
     def run_rules(self, 
                   strategy_names: Sequence[str] | None = None, 
                   start_date: np.datetime64 = NAT, 
-                  end_date: np.datetime64 = NAT) -> None:
+                  end_date: np.datetime64 = NAT,
+                  max_processes: int | None = 1) -> None:
         '''Run rules for the strategies specified.  Must be called after run_indicators and run_signals.  
           See run function for argument descriptions
         '''
-        if strategy_names is None: strategy_names = list(self.strategies.keys())
-        if len(strategy_names) == 0: raise Exception('a portfolio must have at least one strategy')
-
+        self._run_stages(strategy_names, ['rules'], start_date, end_date, max_processes)
+        
+    def _run_rules_single_process(self, strategy_names: Sequence[str], start_date: np.datetime64, end_date: np.datetime64) -> None:
         strategies = [self.strategies[key] for key in strategy_names]
         
-        min_date = min([strategy.timestamps[0] for strategy in strategies])
-        if start_date: min_date = max(min_date, start_date)
-        max_date = max([strategy.timestamps[-1] for strategy in strategies])
-        if end_date: max_date = min(max_date, end_date)
-            
         _logger.info(f'generating order iterations: {start_date} {end_date}')
+        for strategy in strategies:
+            strategy._generate_order_iterations(start_date=start_date, end_date=end_date)
             
-        all_timestamps, iterations = self._generate_order_iterations(strategies, start_date, end_date)
-        
-        for i, timestamp in enumerate(all_timestamps):
-            for (strategy, indices) in iterations:
-                # index into strategy timestamps
-                idx = indices[i]
-                if idx != len(strategy.timestamps) and strategy.timestamps[idx] == timestamp:
-                    strategy._run_iteration(idx)
+        rule_times = {strategy.name: 0. for strategy in strategies}
+        for strategy, idx in self._generate_order_iterations(strategies, start_date, end_date):
+            start_time = time.perf_counter()
+            strategy._run_iteration(idx)
+            rule_times[strategy.name] += time.perf_counter() - start_time
                     
         # Make sure we calc to the end for each strategy
         for strategy in strategies:
+            start_time = time.perf_counter()
             strategy.account.calc(strategy.timestamps[-1])
+            self._record_timing(strategy.name, 'rules', rule_times[strategy.name] + time.perf_counter() - start_time)
+            
+    def _run_stages_multi_process(self, 
+                                  strategy_names: Sequence[str], 
+                                  stages: Sequence[str],
+                                  start_date: np.datetime64, 
+                                  end_date: np.datetime64, 
+                                  max_processes: int | None) -> None:
+        '''
+        Each strategy in a portfolio has its own account so we can run each one in its own process and copy back
+        indicator and signal values, orders, open orders, trades and pnl.  Changes that strategy functions make to the strategy context 
+        in worker processes are not copied back.
+        '''
+        global _worker_strategies
+        strategies = [self.strategies[name] for name in strategy_names]
+        shared = _shared_objects(strategies)
+        _worker_strategies = {name: self.strategies[name] for name in strategy_names}
+        num_processes, num_threads = self.thread_budget.split(max_processes, len(strategy_names))
+        try:
+            # on mac m1 the default start method is set to spawn so change to fork instead
+            with concurrent.futures.ProcessPoolExecutor(num_processes, 
+                                                        mp_context=mp.get_context('fork'), 
+                                                        initializer=limit_threads, 
+                                                        initargs=(num_threads,)) as executor:
+                fut_map = {executor.submit(_run_strategy_in_worker, name, stages, start_date, end_date): name for name in strategy_names}
+                results: dict[str, bytes] = {}
+                for future in concurrent.futures.as_completed(fut_map):
+                    name = fut_map[future]
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        raise type(e)(f'Exception: {str(e)} in strategy: {name}').with_traceback(sys.exc_info()[2])
+        finally:
+            _worker_strategies = {}
+            
+        for name in strategy_names:
+            strategy = self.strategies[name]
+            result = _ResultUnpickler(io.BytesIO(results[name]), shared).load()
+            for stage, seconds in result['timings']: self._record_timing(name, stage, seconds)
+            if 'indicator_values' in result: strategy.indicator_values = result['indicator_values']
+            if 'signal_values' in result: strategy.signal_values = result['signal_values']
+            if 'account' not in result: continue
+            account_state = result['account']
+            for symbol, contract in account_state['contracts'].items():
+                # Contracts created by rules in a worker process
+                if Contract.exists(symbol): continue
+                Contract._instances[symbol] = contract
+                contract.contract_group.add_contract(contract)
+            strategy._orders = result['orders']
+            strategy._trades = result['trades']
+            # Open orders, such as GTC orders, carry over to the next call to run_rules
+            strategy._set_open_order_state(result['open_orders'])
+            for attr, value in account_state.items():
+                setattr(strategy.account, attr, value)
                 
     def run(self, 
             strategy_names: Sequence[str] | None = None, 
             start_date: np.datetime64 = NAT, 
-            end_date: np.datetime64 = NAT) -> None:
+            end_date: np.datetime64 = NAT,
+            max_processes: int | None = 1) -> None:
         '''
         Run indicators, signals and rules.
         
@@ -144,10 +339,46 @@ class Portfolio:
               Sometimes we have a few strategies in a portfolio that need different lead times before they are ready to trade
               so you can set this so they are all ready by this date.  Default None
             end_date: Don't run rules after this date.  Default None
+            max_processes: Number of worker processes used to run strategies in parallel.  Strategies are independent
+              since each one has its own account, so each strategy can compute its indicators and signals and run its rules 
+              in its own process.  If set to None, we use one process per strategy, up to the number of cores.  
+              Default 1, i.e. run all strategies in this process
          '''
-        self.run_indicators()
-        self.run_signals()
-        self.run_rules(strategy_names, start_date, end_date)
+        self._run_stages(strategy_names, ['indicators', 'signals', 'rules'], start_date, end_date, max_processes)
+        
+    def df_stage_timings(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe with how long each stage, i.e. indicators, signals and rules, took for each strategy 
+        and the number of bars processed per second
+        '''
+        df = pd.DataFrame.from_records(self.stage_timings, columns=['strategy', 'stage', 'seconds', 'bars'])
+        df['bars_per_sec'] = df.bars / df.seconds.clip(lower=1e-9)
+        return df
+        
+    def _df_equity(self, sampling_frequency: str, strategy_names: Sequence[str] | None) -> pd.DataFrame:
+        '''
+        Returns a dataframe indexed by timestamp, with one column of equity per strategy, built directly from the 
+        pnl ledgers of strategy accounts.  Equity is nan for periods where a strategy has no pnl timestamps.
+        '''
+        if strategy_names is None: strategy_names = list(self.strategies.keys())
+        if len(strategy_names) == 0: raise Exception('portfolio must have at least one strategy')
+        timestamps_list, equity_list = [], []
+        for name in strategy_names:
+            account = self.strategies[name].account
+            # Same timestamps as Account.df_account_pnl
+            calc_timestamps = account.calc_timestamps
+            timestamps = np.insert(calc_timestamps, 0, calc_timestamps[0] - np.timedelta64(1, 'D'))
+            timestamps_list.append(timestamps)
+            equity_list.append(account.starting_equity + account.net_pnl_array(timestamps))
+            
+        all_timestamps = np.unique(np.concatenate(timestamps_list))
+        equity = np.full((len(all_timestamps), len(strategy_names)), np.nan)
+        for j, (timestamps, strategy_equity) in enumerate(zip(timestamps_list, equity_list)):
+            equity[np.searchsorted(all_timestamps, timestamps), j] = strategy_equity
+            
+        df = pd.DataFrame(equity, index=pd.DatetimeIndex(all_timestamps.astype('M8[ns]'), name='timestamp'), columns=list(strategy_names))
+        df = df.resample(sampling_frequency).last()
+        return df[df.notna().any(axis=1)]
         
     def df_returns(self, 
                    sampling_frequency: str = 'D', 
@@ -159,18 +390,29 @@ class Portfolio:
             sampling_frequency: Date frequency for rows.  Default 'D' for daily so we will have one row per day
             strategy_names: By default this is set to None and we use all strategies.
         '''
-        if strategy_names is None: strategy_names = list(self.strategies.keys())
-        if len(strategy_names) == 0: raise Exception('portfolio must have at least one strategy')
-        equity_list = []
-        for name in strategy_names:
-            equity = self.strategies[name].df_returns(sampling_frequency=sampling_frequency)[['timestamp', 'equity']]
-            equity.columns = ['timestamp', name]
-            equity = equity.set_index('timestamp')
-            equity_list.append(equity)
-        df = pd.concat(equity_list, axis=1)
-        df['equity'] = df.sum(axis=1)
+        df = self._df_equity(sampling_frequency, strategy_names)
+        df['equity'] = np.nansum(df.values, axis=1)
         df['ret'] = df.equity.pct_change()
         return df.reset_index()
+    
+    def df_return_contributions(self, 
+                                sampling_frequency: str = 'D', 
+                                strategy_names: Sequence[str] | None = None) -> pd.DataFrame:
+        '''
+        Return dataframe containing the contribution of each strategy to portfolio returns, i.e. the change in a strategy's 
+        equity divided by portfolio equity in the previous period.  Contributions in each period add up to the portfolio 
+        return in df_returns.
+        
+        Args:
+            sampling_frequency: Date frequency for rows.  Default 'D' for daily so we will have one row per day
+            strategy_names: By default this is set to None and we use all strategies.
+        '''
+        df = self._df_equity(sampling_frequency, strategy_names)
+        equity = np.nan_to_num(df.values)
+        total_equity = equity.sum(axis=1)
+        contributions = np.full(equity.shape, np.nan)
+        contributions[1:] = np.diff(equity, axis=0) / total_equity[:-1, np.newaxis]
+        return pd.DataFrame(contributions, index=df.index, columns=df.columns).reset_index()
         
     def evaluate_returns(self, 
                          sampling_frequency: str = 'D', 
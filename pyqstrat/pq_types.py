@@ -9,7 +9,7 @@ import math
 import datetime
 from dataclasses import dataclass, field
 from types import SimpleNamespace
-from typing import Any, ClassVar
+from typing import Any, Callable, ClassVar
 from enum import Enum
 from pyqstrat.pq_utils import assert_, get_child_logger
 
@@ -291,6 +291,27 @@ class Order:
     def cancel(self) -> None:
         self.status = OrderStatus.CANCELLED
         
+    def __setattr__(self, name: str, value: Any) -> None:
+        object.__setattr__(self, name, value)
+        listeners = self.__dict__.get('_listeners')
+        if listeners:
+            for listener in list(listeners): listener(self, name)
+        
+    def _add_listener(self, listener: Callable[[Order, str], None]) -> None:
+        '''
+        Call listener with this order and the name of the attribute whenever an attribute of the order is set, 
+        for example when it is filled, cancelled or its price is changed
+        '''
+        self.__dict__.setdefault('_listeners', []).append(listener)
+        
+    def _remove_listener(self, listener: Callable[[Order, str], None]) -> None:
+        listeners = self.__dict__.get('_listeners')
+        if listeners and listener in listeners: listeners.remove(listener)
+        
+    def __getstate__(self) -> dict[str, Any]:
+        # Listeners belong to the strategy that is running the order, so they are not copied or pickled with it
+        return {k: v for k, v in self.__dict__.items() if k != '_listeners'}
+        
 
 @dataclass(kw_only=True)
 class MarketOrder(Order):
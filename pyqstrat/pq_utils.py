@@ -147,6 +147,29 @@ def np_indexof_sorted(array: np.ndarray, value: Any) -> int:
     return idx
 
 
+def np_first_crossing(a: np.ndarray, level: float, start: int = 0, above: bool = True) -> int:
+    '''
+    Find the first index at or after start where the values in a cross level, i.e. a >= level if above is set
+    or a <= level otherwise.  NaNs never count as a crossing.  Returns len(a) if a never crosses level
+    
+    >>> a = np.array([5., 6., np.nan, 8., 4.])
+    >>> np_first_crossing(a, 7.5)
+    3
+    >>> np_first_crossing(a, 4.5, start=1, above=False)
+    4
+    >>> np_first_crossing(a, 10.)
+    5
+    >>> np_first_crossing(a, 5., start=5)
+    5
+    '''
+    if start >= len(a): return len(a)
+    sub = a[start:]
+    mask = (sub >= level) if above else (sub <= level)
+    idx = int(np.argmax(mask))
+    if not mask[idx]: return len(a)
+    return start + idx
+
+
 def np_find_closest(a: np.ndarray, v: Any) -> int | np.ndarray:
     '''
     From https://stackoverflow.com/questions/8914491/finding-the-nearest-value-and-return-the-index-of-array-in-python
@@ -0,0 +1,323 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import math
+import itertools
+import concurrent
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from typing import Any, Callable
+from collections.abc import Iterable, Sequence
+from pyqstrat.pq_utils import get_child_logger, assert_
+from pyqstrat.strategy import Strategy
+from pyqstrat.shared_data import SharedDataStore
+from pyqstrat.thread_budget import ThreadBudget
+from pyqstrat.optimize import Experiment, Optimizer, suggestion_key
+from pyqstrat.walk_forward import returns_sharpe_cost
+
+_logger = get_child_logger(__name__)
+
+# Indices of the groups that are tested, boolean mask of observations used for training, boolean mask of observations used for testing
+SplitType = tuple[tuple[int, ...], np.ndarray, np.ndarray]
+
+# Takes an array of daily returns and returns cost, other costs
+ReturnsCostType = Callable[[np.ndarray], tuple[float, dict[str, float]]]
+
+
+def combinatorial_purged_splits(num_obs: int,
+                                num_groups: int,
+                                num_test_groups: int,
+                                purge: int = 0,
+                                embargo: int = 0) -> list[SplitType]:
+    '''
+    Splits observations into num_groups contiguous groups and returns a train / test split for each combination of
+    num_test_groups groups that are tested.  Observations that are just before a test group are purged from the train set,
+    and observations just after a test group are embargoed, so information from the test set does not leak into training
+    through positions or labels that span the boundary.
+
+    Args:
+        num_obs: Number of observations, for example days
+        num_groups: Number of groups to split observations into
+        num_test_groups: Number of groups in the test set of each split
+        purge: Number of observations before each test group that are removed from the train set.  Default 0
+        embargo: Number of observations after each test group that are removed from the train set.  Default 0
+
+    >>> for test_groups, train, test in combinatorial_purged_splits(12, 4, 2, purge=1, embargo=1)[:3]:
+    ...     print(test_groups, ''.join(['T' if x else '.' for x in test]), ''.join(['t' if x else '.' for x in train]))
+    (0, 1) TTTTTT...... .......ttttt
+    (0, 2) TTT...TTT... ....t.....tt
+    (0, 3) TTT......TTT ....tttt....
+    '''
+    assert_(0 < num_test_groups < num_groups <= num_obs, f'invalid num_test_groups: {num_test_groups} num_groups: {num_groups} num_obs: {num_obs}')
+    assert_(purge >= 0 and embargo >= 0, f'purge: {purge} and embargo: {embargo} cannot be negative')
+    groups = np.array_split(np.arange(num_obs), num_groups)
+    splits: list[SplitType] = []
+    for test_groups in itertools.combinations(range(num_groups), num_test_groups):
+        test = np.full(num_obs, False)
+        for group in test_groups: test[groups[group]] = True
+        train = ~test
+        for group in test_groups:
+            start, end = groups[group][0], groups[group][-1] + 1
+            train[max(start - purge, 0):start] = False
+            train[end:end + embargo] = False
+        splits.append((test_groups, train, test))
+    return splits
+
+
+def split_paths(num_groups: int, num_test_groups: int) -> list[list[int]]:
+    '''
+    Returns backtest paths for combinatorial purged cross validation.  Each group is tested in more than one split.
+    A path tests each group exactly once, so its out of sample returns cover all observations.
+    Each path is a list containing, for each group, the index of the split that tests that group in this path.
+    Splits are in the order returned by combinatorial_purged_splits
+
+    >>> split_paths(4, 2)
+    [[0, 0, 1, 2], [1, 3, 3, 4], [2, 4, 5, 5]]
+    '''
+    combinations = list(itertools.combinations(range(num_groups), num_test_groups))
+    num_paths = math.comb(num_groups - 1, num_test_groups - 1)
+    paths: list[list[int]] = [[] for _ in range(num_paths)]
+    for group in range(num_groups):
+        splits = [i for i, test_groups in enumerate(combinations) if group in test_groups]
+        for path, split in zip(paths, splits): path.append(split)
+    return paths
+
+
+# Key in other costs that carries the train cost of each split and daily returns of an experiment back from the worker.
+# The Optimizer used by PurgedCrossValidation removes it before the experiment is stored
+_SPLIT_RESULTS = '_split_results'
+
+
+@dataclass
+class _SplitRunner:
+    '''Runs a strategy with a set of parameters and computes cost over the train set of each split'''
+    strategy_factory: Callable[[dict[str, Any]], Strategy]
+    cost_func: ReturnsCostType
+    dates: np.ndarray
+    splits: Sequence[SplitType]
+
+    def returns(self, params: dict[str, Any]) -> np.ndarray:
+        '''Daily returns of the strategy on each date, with 0 for dates without returns'''
+        strategy = self.strategy_factory(params)
+        strategy.run()
+        df = strategy.df_returns()
+        returns = pd.Series(df.ret.values, index=df.timestamp.values.astype('M8[D]'))
+        return returns.reindex(self.dates).fillna(0.).values
+
+    def __call__(self, suggestion: dict[str, Any]) -> tuple[float, dict[str, Any]]:
+        '''
+        Cost function for the Optimizer.  Each suggestion is run once over all dates and its cost is computed over the
+        train set of every split, so we don't need to run a backtest for each split.  Returns the mean train cost, 
+        and the train cost of each split and daily returns, which are needed to pick parameters for each split 
+        and compute out of sample costs without running the backtest again
+        '''
+        returns = self.returns(suggestion)
+        train_costs = np.array([self.cost_func(returns[train])[0] for _, train, _ in self.splits])
+        return float(np.mean(train_costs)), {'train_cost_std': float(np.std(train_costs)), _SPLIT_RESULTS: (train_costs, returns)}
+
+
+class _SplitOptimizer(Optimizer):
+    '''
+    Optimizer that passes the train cost of each split and daily returns of each experiment to on_result in the main process, 
+    instead of storing them in other costs
+    '''
+    def __init__(self, *args: Any, on_result: Callable[[dict[str, Any], np.ndarray, np.ndarray], None], **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._on_result = on_result
+
+    def _add_experiment(self, experiment: Experiment, from_cache: bool = False) -> None:
+        # Other costs are typed as floats but this entry holds a tuple of arrays
+        results: Any = experiment.other_costs.pop(_SPLIT_RESULTS, None)
+        if results is not None:
+            train_costs, returns = results
+            self._on_result(experiment.suggestion, train_costs, returns)
+        super()._add_experiment(experiment, from_cache)
+
+
+class PurgedCrossValidation:
+    '''
+    Combinatorial purged cross validation.  Dates of the strategy are split into groups, and each combination of
+    num_test_groups groups is tested once, with the rest of the dates, less purged and embargoed dates, used for training.
+    For each split, we pick the parameters with the lowest cost over its train set and compute their cost over its test set.
+    Test sets are also combined into backtest paths that each cover all dates, so you get a distribution of out of sample
+    metrics instead of the single number that walk forward gives you.
+
+    Each parameter set is backtested once, over all dates, by an Optimizer, and its cost over the train set of every split is
+    computed from its daily returns.  Out of sample costs are computed from the daily returns of the parameters picked 
+    for each split, so no backtest is run twice.  We only keep returns of parameters that are currently the best for some split.
+    The cost of each experiment in the Optimizer is its mean cost over the train sets of all splits.
+    To compute indicators once instead of for each parameter set, have strategy_factory clone a template built by 
+    StrategyBuilder.build_template, or read inputs from shared_data.
+
+    Args:
+        name: Display title for plotting, etc.
+        strategy_factory: A function that takes a dictionary of parameter name -> value and returns a Strategy
+            with indicators, signals and rules added, that has not been run yet
+        generator: An iterable, such as a generator, that yields parameter dictionaries to evaluate.  Costs are not sent back to it
+        timestamps: Timestamps of the strategies strategy_factory returns.  Splits are made over the dates in these
+        num_groups: Number of groups to split dates into.  Default 6
+        num_test_groups: Number of groups in the test set of each split.  Default 2
+        purge: Number of dates before each test group that are not used for training.  Default 0
+        embargo: Number of dates after each test group that are not used for training.  Default 0
+        cost_func: A function that takes an array of daily returns and returns cost and a dictionary of other costs.
+            Default returns_sharpe_cost
+        max_processes: See Optimizer
+        mp_start_method: See Optimizer
+        shared_data: See Optimizer
+        executor_factory: See Optimizer
+        thread_budget: See Optimizer
+    '''
+    def __init__(self,
+                 name: str,
+                 strategy_factory: Callable[[dict[str, Any]], Strategy],
+                 generator: Iterable[dict[str, Any]],
+                 timestamps: np.ndarray,
+                 num_groups: int = 6,
+                 num_test_groups: int = 2,
+                 purge: int = 0,
+                 embargo: int = 0,
+                 cost_func: ReturnsCostType = returns_sharpe_cost,
+                 max_processes: int | None = None,
+                 mp_start_method: str | None = None,
+                 shared_data: SharedDataStore | None = None,
+                 executor_factory: Callable[..., concurrent.futures.Executor] | None = None,
+                 thread_budget: ThreadBudget | None = None) -> None:
+        self.name = name
+        self.generator = generator
+        self.dates = np.unique(timestamps.astype('M8[D]'))
+        self.num_groups = num_groups
+        self.num_test_groups = num_test_groups
+        self.splits = combinatorial_purged_splits(len(self.dates), num_groups, num_test_groups, purge, embargo)
+        self.paths = split_paths(num_groups, num_test_groups)
+        self.cost_func = cost_func
+        self.max_processes = max_processes
+        self.mp_start_method = mp_start_method
+        self.shared_data = shared_data
+        self.executor_factory = executor_factory
+        self.thread_budget = thread_budget
+        self._split_runner = _SplitRunner(strategy_factory, cost_func, self.dates, self.splits)
+        self.optimizer: Optimizer | None = None
+        # For each split, train cost, suggestion key and parameters of the best experiment so far
+        self._best: list[tuple[float, str, dict[str, Any]] | None] = [None] * len(self.splits)
+        # suggestion key -> daily returns over all dates, for parameters that are the best for at least one split
+        self._returns: dict[str, np.ndarray] = {}
+
+    @property
+    def best_params(self) -> list[dict[str, Any] | None]:
+        '''Parameters with the lowest train cost for each split, or None if a split has no valid experiments'''
+        return [None if best is None else best[2] for best in self._best]
+
+    def _add_result(self, suggestion: dict[str, Any], train_costs: np.ndarray, returns: np.ndarray) -> None:
+        key = suggestion_key(suggestion)
+        for i, cost in enumerate(train_costs):
+            if not np.isfinite(cost): continue
+            # Break ties by suggestion so the result does not depend on the order in which experiments completed
+            best = self._best[i]
+            if best is None or (cost, key) < best[:2]: self._best[i] = (cost, key, suggestion)
+        keep = {best[1] for best in self._best if best is not None}
+        if key in keep: self._returns[key] = returns
+        if len(self._returns) > len(keep): self._returns = {k: v for k, v in self._returns.items() if k in keep}
+
+    def _suggestions(self) -> Iterable[dict[str, Any]]:
+        # The Optimizer sends costs to its generator, so wrap iterables that are not generators
+        yield from self.generator
+
+    def run(self, raise_on_error: bool = False) -> None:
+        '''
+        Backtest all parameter sets and pick the best ones for each split
+
+        Args:
+            raise_on_error: If set, exceptions stop the run instead of being printed.  Default False
+        '''
+        self._best = [None] * len(self.splits)
+        self._returns = {}
+        self.optimizer = _SplitOptimizer(self.name, self._suggestions(), self._split_runner,  # type: ignore
+                                         max_processes=self.max_processes, shared_data=self.shared_data, 
+                                         mp_start_method=self.mp_start_method, executor_factory=self.executor_factory, 
+                                         thread_budget=self.thread_budget, on_result=self._add_result)
+        self.optimizer.run(raise_on_error)
+        for i, params in enumerate(self.best_params):
+            if params is None: _logger.warning(f'no valid experiments for split: {i}')
+
+    def _test_returns(self, split: int) -> np.ndarray | None:
+        '''Daily returns of the parameters picked for this split, over all dates, or None if we don't have them'''
+        best = self._best[split]
+        if best is None: return None
+        return self._returns[best[1]]
+
+    def df_splits(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe with a row for each split, containing the groups it tests, the number of train and test dates,
+        best parameters, cost over the train set and cost and other costs over the test set
+        '''
+        assert_(self.optimizer is not None, 'run must be called first')
+        records = []
+        for i, (test_groups, train, test) in enumerate(self.splits):
+            record: dict[str, Any] = {'split': i, 'test_groups': test_groups, 'train_dates': int(train.sum()), 'test_dates': int(test.sum())}
+            best = self._best[i]
+            if best is not None:
+                record.update(best[2])
+                record['train_cost'] = best[0]
+            returns = self._test_returns(i)
+            if returns is not None:
+                cost, other_costs = self.cost_func(returns[test])
+                record['test_cost'] = cost
+                record.update({f'test_{k}': v for k, v in other_costs.items()})
+            records.append(record)
+        return pd.DataFrame.from_records(records)
+
+    def df_path_returns(self) -> pd.DataFrame:
+        '''
+        Returns out of sample daily returns for each backtest path, with columns timestamp, path, split and ret.
+        Split is the split whose parameters were used for that date
+        '''
+        groups = np.array_split(np.arange(len(self.dates)), self.num_groups)
+        dfs = []
+        for path, splits in enumerate(self.paths):
+            for group, split in enumerate(splits):
+                returns = self._test_returns(split)
+                if returns is None: continue
+                dfs.append(pd.DataFrame({'timestamp': self.dates[groups[group]], 'path': path, 'split': split, 'ret': returns[groups[group]]}))
+        assert_(len(dfs) > 0, 'no out of sample returns, run must be called first')
+        return pd.concat(dfs).reset_index(drop=True)
+
+    def df_paths(self) -> pd.DataFrame:
+        '''Returns a dataframe with a row for each backtest path, containing its cost and other costs'''
+        records = []
+        for path, df in self.df_path_returns().groupby('path'):
+            cost, other_costs = self.cost_func(df.ret.values)
+            records.append({'path': path, 'dates': len(df), 'cost': cost, **other_costs})
+        return pd.DataFrame.from_records(records)
+
+    def df_summary(self, quantiles: Sequence[float] = (0.05, 0.5, 0.95)) -> pd.DataFrame:
+        '''
+        Returns the distribution of out of sample cost and other costs over backtest paths, with a row for each metric and
+        columns for mean, std, min, max and quantiles, and the same over test sets of splits
+
+        Args:
+            quantiles: Quantiles to compute.  Default 5%, 50% and 95%
+        '''
+        dfs = []
+        df_splits = self.df_splits()
+        df_splits = df_splits[[col for col in df_splits.columns if col.startswith('test_') and col not in ['test_groups', 'test_dates']]]
+        df_splits.columns = ['cost' if col == 'test_cost' else col[len('test_'):] for col in df_splits.columns]
+        for source, df in [('paths', self.df_paths().drop(columns=['path', 'dates'])), ('splits', df_splits)]:
+            values = df.values.astype(float)
+            stats = {'mean': np.nanmean(values, axis=0), 'std': np.nanstd(values, axis=0),
+                     'min': np.nanmin(values, axis=0), 'max': np.nanmax(values, axis=0)}
+            for quantile in quantiles: stats[f'q{round(quantile * 100):02d}'] = np.nanquantile(values, quantile, axis=0)
+            df_stats = pd.DataFrame(stats, index=df.columns)
+            df_stats.insert(0, 'over', source)
+            dfs.append(df_stats)
+        df = pd.concat(dfs)
+        df.index.name = 'metric'
+        return df.reset_index()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
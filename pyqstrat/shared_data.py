@@ -0,0 +1,237 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import os
+import sys
+import uuid
+import pickle
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+from typing import Any
+from pyqstrat.pq_utils import get_child_logger, assert_
+
+_logger = get_child_logger(__name__)
+
+# backend, location (shared memory block name or filename), dtype string, shape
+SharedArraySpec = tuple[str, str, str, tuple[int, ...]]
+
+
+class SharedArray(np.ndarray):
+    '''
+    A read-only numpy array backed by shared memory or a memory mapped file, returned by SharedDataStore.get.
+    When pickled, for example to send it to a worker process, only the name of the shared memory block or file is sent
+    and the worker attaches to the same memory instead of receiving a copy.  Arrays derived from this one,
+    such as slices, are pickled as regular numpy arrays.
+    '''
+    _spec: SharedArraySpec | None
+    _buffer_owner: Any
+
+    def __array_finalize__(self, obj: Any) -> None:
+        self._spec = None
+        self._buffer_owner = getattr(obj, '_buffer_owner', None)
+
+    def __reduce__(self) -> Any:
+        if self._spec is None: return super().__reduce__()
+        return (_attach_array, (self._spec,))
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    # Only the store that created the block should unlink it.  Before python 3.13, attaching to a block also registers it
+    # with the resource tracker, which then unlinks it when the attaching process exits
+    if sys.version_info >= (3, 13): return shared_memory.SharedMemory(name=name, track=False)  # type: ignore
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _attach_array(spec: SharedArraySpec, shm: shared_memory.SharedMemory | None = None) -> SharedArray:
+    backend, location, dtype, shape = spec
+    if backend == 'shm':
+        if shm is None: shm = _attach_shared_memory(location)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).view(SharedArray)
+        array._buffer_owner = shm
+    else:
+        array = np.load(location, mmap_mode='r').view(SharedArray)
+    array.flags.writeable = False
+    array._spec = spec
+    return array
+
+
+class SharedDataStore:
+    '''
+    A store of named numpy arrays that are written once and then shared as read-only, zero copy views by strategies,
+    indicators, price functions and market simulators, in this process and in worker processes.
+    Arrays are stored in shared memory, or in memory mapped .npy files if you set the directory argument.
+
+    The store can be pickled and sent to worker processes, as can arrays returned by get.  Only names of the shared memory
+    blocks or files are sent, and the worker attaches to them.  The store that added the arrays owns them and
+    frees them when close is called, or when it is used as a context manager and the with block exits.
+
+    Args:
+        directory: If set, arrays are saved as .npy files in this directory and memory mapped instead of
+            being stored in shared memory.  Useful for arrays that are larger than available RAM.  Default None
+
+    >>> with SharedDataStore() as store:
+    ...     _ = store.add('close', np.array([10.1, 10.2, 10.5]))
+    ...     close = store.get('close')
+    ...     worker_store = pickle.loads(pickle.dumps(store))
+    ...     worker_close = worker_store.get('close')
+    ...     print(store.names(), worker_close.tolist(), close.flags.writeable)
+    ['close'] [10.1, 10.2, 10.5] False
+    '''
+    def __init__(self, directory: str | None = None) -> None:
+        self.directory = directory
+        self._specs: dict[str, SharedArraySpec] = {}
+        self._arrays: dict[str, SharedArray] = {}
+        self._owned: dict[str, shared_memory.SharedMemory | str] = {}
+        # DataFrame name -> column names.  Each column and the index is stored as a separate array
+        self._frames: dict[str, list[Any]] = {}
+        self._is_owner = True
+
+    def add(self, name: str, array: np.ndarray) -> SharedArray:
+        '''
+        Copy an array into the store and return a read-only view of it.  This is the only copy that is made.
+
+        Args:
+            name: Name used to look up the array
+            array: A numpy array.  Object arrays cannot be shared, so convert strings to fixed width numpy strings first
+        '''
+        assert_(self._is_owner, f'cannot add {name} to a store that was sent from another process')
+        assert_(name not in self._specs, f'{name} already exists in store')
+        array = np.ascontiguousarray(array)
+        assert_(array.dtype.kind != 'O', f'cannot share object array: {name}')
+        spec: SharedArraySpec
+        if self.directory is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._owned[name] = shm
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            spec = ('shm', shm.name, array.dtype.str, array.shape)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            filename = os.path.join(self.directory, f'{name}_{uuid.uuid4().hex}.npy')
+            np.save(filename, array)
+            self._owned[name] = filename
+            spec = ('file', filename, array.dtype.str, array.shape)
+        self._specs[name] = spec
+        return self.get(name)
+
+    def get(self, name: str) -> SharedArray:
+        '''Returns a read-only view of the array with this name'''
+        array = self._arrays.get(name)
+        if array is None:
+            assert_(name in self._specs, f'{name} not found in store')
+            owned = self._owned.get(name)
+            array = _attach_array(self._specs[name], owned if isinstance(owned, shared_memory.SharedMemory) else None)
+            self._arrays[name] = array
+        return array
+
+    def add_df(self, name: str, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Copy each column and the index of a DataFrame into the store and return a DataFrame built from read-only views of them.
+        
+        Args:
+            name: Name used to look up the DataFrame
+            df: A DataFrame with numeric, bool or datetime columns.  Convert string columns to fixed width numpy strings first
+
+        >>> with SharedDataStore() as store:
+        ...     df = store.add_df('bars', pd.DataFrame({'c': [10.1, 10.2], 'v': [200, 300]}, index=[5, 6]))
+        ...     worker_df = pickle.loads(pickle.dumps(store)).get_df('bars')
+        ...     print(worker_df.index.tolist(), worker_df.c.tolist(), worker_df.v.tolist())
+        [5, 6] [10.1, 10.2] [200, 300]
+        '''
+        assert_(name not in self._frames, f'{name} already exists in store')
+        self.add(f'{name}.__index__', df.index.values)
+        for i, column in enumerate(df.columns):
+            self.add(f'{name}.{i}', df.iloc[:, i].values)
+        self._frames[name] = list(df.columns)
+        return self.get_df(name)
+    
+    def get_df(self, name: str) -> pd.DataFrame:
+        '''Returns a DataFrame with this name.  Its columns and index are read-only views of arrays in the store'''
+        assert_(name in self._frames, f'{name} not found in store')
+        columns = {column: self.get(f'{name}.{i}') for i, column in enumerate(self._frames[name])}
+        return pd.DataFrame(columns, index=pd.Index(self.get(f'{name}.__index__'), copy=False), copy=False)
+    
+    def names(self) -> list[str]:
+        return list(self._specs.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def nbytes(self) -> int:
+        '''Total size of all arrays in the store'''
+        return sum([int(np.prod(shape)) * np.dtype(dtype).itemsize for _, _, dtype, shape in self._specs.values()])
+
+    def close(self) -> None:
+        '''
+        Free shared memory and delete files if this store created them.  Views returned by get should not be used after this.
+        '''
+        self._arrays.clear()
+        if not self._is_owner: return
+        for owned in self._owned.values():
+            if isinstance(owned, str):
+                if os.path.exists(owned): os.remove(owned)
+            else:
+                owned.unlink()
+                try:
+                    owned.close()
+                except BufferError:
+                    # Views are still being used.  The memory is freed once they are garbage collected
+                    pass
+        self._owned = {}
+        self._specs = {}
+        self._frames = {}
+
+    def __enter__(self) -> SharedDataStore:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {'directory': self.directory, '_specs': self._specs, '_frames': self._frames}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.directory = state['directory']
+        self._specs = state['_specs']
+        self._frames = state['_frames']
+        self._arrays = {}
+        self._owned = {}
+        self._is_owner = False
+
+    def __repr__(self) -> str:
+        return f'SharedDataStore({self.names()} {self.nbytes() / 1e6:.1f} MB)'
+
+
+def test_shared_data_store() -> None:
+    from pyqstrat.pq_utils import get_temp_dir
+    close = np.arange(100.)
+    timestamps = np.arange(np.datetime64('2023-01-03'), np.datetime64('2023-01-03') + 100)
+    for directory in [None, get_temp_dir() + '/pq_shared_data_test']:
+        with SharedDataStore(directory) as store:
+            store.add('close', close)
+            store.add('timestamp', timestamps)
+            assert_(np.array_equal(store.get('timestamp'), timestamps))
+            shared_close = store.get('close')
+            assert_(shared_close is store.get('close'))
+            assert_(not shared_close.flags.writeable)
+            worker_store = pickle.loads(pickle.dumps(store))
+            assert_(np.array_equal(worker_store.get('close'), close))
+            # slices are sent as copies
+            assert_(len(pickle.dumps(shared_close)) < len(pickle.dumps(shared_close[:50])))
+            worker_store.close()
+            # Closing a store sent from another process does not free the arrays
+            assert_(np.array_equal(store.get('close'), close))
+        assert_(store.names() == [])
+
+
+if __name__ == "__main__":
+    test_shared_data_store()
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
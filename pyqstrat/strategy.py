@@ -6,6 +6,8 @@ import numpy as np
 import pandas as pd
 import types
 import sys
+import copy
+import bisect
 from collections import defaultdict
 from pprint import pformat
 import math
@@ -13,9 +15,10 @@ import plotly.graph_objects as go
 from pyqstrat.evaluator import compute_return_metrics, display_return_metrics, plot_return_metrics
 from pyqstrat.account import Account
 from pyqstrat.pq_types import ContractGroup, Contract, Order, Trade, RoundTripTrade, TimeInForce, OrderStatus
-from pyqstrat.pq_utils import series_to_array, assert_
+from pyqstrat.pq_types import LimitOrder, StopLimitOrder
+from pyqstrat.pq_utils import series_to_array, assert_, np_first_crossing
 from types import SimpleNamespace
-from typing import Callable, Any, Union, Sequence
+from typing import Callable, Any, Union, Sequence, Iterable, Iterator
 from pyqstrat.pq_utils import get_child_logger
 
 
@@ -23,6 +26,9 @@ StrategyContextType = SimpleNamespace
 
 PriceFunctionType = Callable[[Contract, np.ndarray, int, StrategyContextType], float]
 
+# Returns the price array for a contract, aligned with strategy timestamps, or None if not available
+TriggerPriceFunctionType = Callable[[Contract, StrategyContextType], Union[np.ndarray, None]]
+
 IndicatorType = Callable[[ContractGroup, np.ndarray, SimpleNamespace, StrategyContextType], np.ndarray]
 
 SignalType = Callable[[ContractGroup, np.ndarray, SimpleNamespace, SimpleNamespace, StrategyContextType], np.ndarray]
@@ -59,6 +65,102 @@ NAT = np.datetime64('NaT')
 _logger = get_child_logger(__name__)
 
 
+class OpenOrders(Sequence[Order]):
+    '''
+    The current orders passed to trading rules.  Also keeps a count of open orders for each contract group and contract,
+    updated as soon as an order is filled or cancelled, so rules can check for open orders without looping through 
+    current orders.  Orders can only be added with append or extend, and closed orders are removed with remove_closed.
+    
+    >>> ContractGroup.clear_cache()
+    >>> Contract.clear_cache()
+    >>> ibm = Contract.create('IBM', contract_group=ContractGroup.get('IBM'))
+    >>> aapl = Contract.create('AAPL', contract_group=ContractGroup.get('AAPL'))
+    >>> from pyqstrat.pq_types import MarketOrder
+    >>> orders = OpenOrders([MarketOrder(contract=ibm, timestamp=np.datetime64('2023-01-03'), qty=10)])
+    >>> orders.append(MarketOrder(contract=aapl, timestamp=np.datetime64('2023-01-03'), qty=10))
+    >>> len(orders), orders.has_open_orders(ContractGroup.get('AAPL')), orders.has_open_orders(contract=ibm)
+    (2, True, True)
+    >>> orders[0].cancel()
+    >>> orders.has_open_orders(ContractGroup.get('IBM')), len(orders)
+    (False, 2)
+    >>> orders.remove_closed()
+    >>> len(orders), orders[0].contract.symbol
+    (1, 'AAPL')
+    '''
+    def __init__(self, orders: Sequence[Order] = ()) -> None:
+        self._orders: list[Order] = []
+        self._num_open = 0
+        self._num_open_by_cgroup: dict[str, int] = defaultdict(int)
+        self._num_open_by_symbol: dict[str, int] = defaultdict(int)
+        # ids of orders included in the counts above
+        self._counted: set[int] = set()
+        self.extend(orders)
+        
+    def _count(self, order: Order, num: int) -> None:
+        self._num_open += num
+        self._num_open_by_cgroup[order.contract.contract_group.name] += num
+        self._num_open_by_symbol[order.contract.symbol] += num
+            
+    def _on_change(self, order: Order, name: str) -> None:
+        if name != 'status' or order.is_open() or id(order) not in self._counted: return
+        self._counted.remove(id(order))
+        self._count(order, -1)
+        order._remove_listener(self._on_change)
+        
+    def append(self, order: Order) -> None:
+        self._orders.append(order)
+        if not order.is_open() or id(order) in self._counted: return
+        self._counted.add(id(order))
+        self._count(order, 1)
+        order._add_listener(self._on_change)
+        
+    def extend(self, orders: Iterable[Order]) -> None:
+        for order in orders: self.append(order)
+        
+    def remove_closed(self) -> None:
+        '''Remove orders that are not open'''
+        if self._num_open == len(self._orders): return
+        self._orders = [order for order in self._orders if order.is_open()]
+        
+    def __getitem__(self, index: Any) -> Any:
+        return self._orders[index]
+    
+    def __len__(self) -> int:
+        return len(self._orders)
+    
+    def __iter__(self) -> Iterator[Order]:
+        return iter(self._orders)
+    
+    def __repr__(self) -> str:
+        return repr(self._orders)
+    
+    def __getstate__(self) -> dict[str, Any]:
+        # Counts are keyed by order ids, so rebuild them when unpickling
+        return {'orders': self._orders}
+    
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(state['orders'])  # type: ignore
+    
+    def has_open_orders(self, contract_group: ContractGroup | None = None, contract: Contract | None = None) -> bool:
+        '''
+        Returns whether there are any open orders for the given contract if it is set, otherwise for the given contract group
+        '''
+        if contract is not None: return self._num_open_by_symbol.get(contract.symbol, 0) > 0
+        assert_(contract_group is not None, 'either contract_group or contract must be set')
+        return self._num_open_by_cgroup.get(contract_group.name, 0) > 0  # type: ignore
+    
+    
+def has_open_orders(orders: Sequence[Order], contract_group: ContractGroup | None = None, contract: Contract | None = None) -> bool:
+    '''
+    Returns whether there are any open orders for the given contract if it is set, otherwise for the given contract group.
+    Uses the counts kept by OpenOrders if orders is an OpenOrders, which is what strategies pass to rules
+    '''
+    if isinstance(orders, OpenOrders): return orders.has_open_orders(contract_group, contract)
+    if contract is not None: return any(order.is_open() and order.contract.symbol == contract.symbol for order in orders)
+    assert_(contract_group is not None, 'either contract_group or contract must be set')
+    return any(order.is_open() and order.contract.contract_group.name == contract_group.name for order in orders)  # type: ignore
+    
+
 class Strategy:
     def __init__(self, 
                  timestamps: np.ndarray,
@@ -99,6 +201,8 @@ class Strategy:
         self.contract_groups = contract_groups
         if strategy_context is None: strategy_context = types.SimpleNamespace()
         self.strategy_context = strategy_context
+        self.price_function = price_function
+        self.pnl_calc_time = pnl_calc_time
         self.account = Account(contract_groups, timestamps, price_function, strategy_context, starting_equity, pnl_calc_time)
         assert_(trade_lag >= 0, f'trade_lag cannot be negative: {trade_lag}')
         self.trade_lag = trade_lag
@@ -116,7 +220,7 @@ class Strategy:
         self._trades: list[Trade] = []
         # a list of all orders created used for display
         self._orders: list[Order] = []
-        self._current_orders: list[Order] = []
+        self._current_orders = OpenOrders()
         self.indicator_deps: dict[str, list[str]] = {}
         self.indicator_cgroups: dict[str, list[ContractGroup]] = {}
         self.indicator_values: dict[str, SimpleNamespace] = defaultdict(types.SimpleNamespace)
@@ -124,6 +228,13 @@ class Strategy:
         self.signal_deps: dict[str, list[str]] = {}
         self.signal_cgroups: dict[str, list[ContractGroup]] = {}
         self.trades_iter: list[list] = [[] for x in range(len(timestamps))]  # For debugging, we don't really need this as a member variable
+        self.trigger_price_func: TriggerPriceFunctionType | None = None
+        # Open orders that are not resting, in the order they were created.  These are sent to market simulators
+        self._active_orders: list[Order] = []
+        self._order_seq: dict[int, int] = {}  # id(order) -> sequence number, used to put woken orders back in order
+        # Resting orders are not in active orders till their wake up index, or till they are changed or cancelled
+        self._resting_orders: dict[int, tuple[Order, int]] = {}  # id(order) -> (order, wake up index)
+        self._resting_wake_iter: dict[int, list[Order]] = defaultdict(list)  # wake up index -> orders
         
     def add_indicator(self, 
                       name: str, 
@@ -204,6 +315,59 @@ class Strategy:
         '''Add a market simulator.  A market simulator is a function that takes orders as input and returns trades.'''
         self.market_sims.append(market_sim_function)
         
+    def set_trigger_price_function(self, trigger_price_func: TriggerPriceFunctionType) -> None:
+        '''
+        Set a function that returns the price array for a contract, aligned with strategy timestamps, or None if there is 
+        no such array for that contract.  GTC limit and stop orders for contracts with a price array are scanned once when 
+        they are created, to find the first bar where price crosses the limit or trigger price.  These orders are not sent
+        to market simulators before that bar, unless they are cancelled or their price or qty is changed by a rule.
+        
+        Market simulators must not fill a limit order or trigger a stop order on a bar where the price array has not 
+        crossed the order level.  For example, if you use a market simulator that adds slippage to a close price, 
+        return the close price array.
+        '''
+        self.trigger_price_func = trigger_price_func
+        
+    def clone(self, 
+              starting_equity: float | None = None, 
+              strategy_context: StrategyContextType | None = None,
+              price_function: PriceFunctionType | None = None,
+              pnl_calc_time: int | None = None) -> Strategy:
+        '''
+        Returns a new strategy with the same timestamps, contract groups, settings and indicators as this one, but with no signals, 
+        rules or market simulators and a new Account.  Indicator values that have already been computed are referenced by the new
+        strategy, not copied or recomputed, so you can compute indicators once and then cheaply run many strategies that only 
+        differ in their signals, rules or market simulators.  Indicator arrays are shared, so signals and rules must not modify them.
+        
+        Args:
+            starting_equity: Starting equity of the new strategy.  If not set, we use the starting equity of this strategy. Default None
+            strategy_context: Strategy context of the new strategy.  If not set, we use a shallow copy of the strategy context 
+                of this strategy. Default None
+            price_function: Price function of the new strategy.  If not set, we use the price function of this strategy. Default None
+            pnl_calc_time: PNL calculation time of the new strategy.  If not set, we use the one from this strategy. Default None
+        '''
+        if starting_equity is None: starting_equity = self.account.starting_equity
+        if strategy_context is None: strategy_context = copy.copy(self.strategy_context)
+        if price_function is None: price_function = self.price_function
+        if pnl_calc_time is None: pnl_calc_time = self.pnl_calc_time
+        strategy = Strategy(self.timestamps, 
+                            self.contract_groups, 
+                            price_function, 
+                            starting_equity, 
+                            pnl_calc_time, 
+                            self.trade_lag, 
+                            self.run_final_calc, 
+                            self.log_trades, 
+                            self.log_orders, 
+                            strategy_context)
+        strategy.indicators = dict(self.indicators)
+        strategy.indicator_deps = dict(self.indicator_deps)
+        strategy.indicator_cgroups = dict(self.indicator_cgroups)
+        for cgroup_name, values in self.indicator_values.items():
+            strategy.indicator_values[cgroup_name] = types.SimpleNamespace(**vars(values))
+        strategy.trigger_price_func = self.trigger_price_func
+        return strategy
+        
     def run_indicators(self, 
                        indicator_names: Sequence[str] | None = None, 
                        contract_groups: Sequence[ContractGroup] | None = None, 
@@ -426,9 +590,16 @@ class Strategy:
                     _logger.info(f'ORDER: {orders[0]}')
                     
             self._orders += orders
-            self._current_orders += orders
+            self._current_orders.extend(orders)
             # _logger.info(f'current_orders: {self._current_orders}')
             
+            for order in orders:
+                self._order_seq[id(order)] = len(self._order_seq)
+                if self.trigger_price_func is not None:
+                    order_idx = int(np.searchsorted(self.timestamps, order.timestamp))
+                    if self._add_resting_order(order, max(i, order_idx + self.trade_lag)): continue
+                self._active_orders.append(order)
+            
             if self.trade_lag == 0:
                 # we don't need to do this for the last rule function 
                 # since the sim_market at the beginning of this function will take care of it
@@ -437,15 +608,78 @@ class Strategy:
             else:
                 self._update_current_orders()
                 
+    def _get_resting_level(self, order: Order) -> tuple[float, bool]:
+        '''
+        Returns the price level a resting order is waiting for and whether price has to go above (or below) it for the 
+        order to fill or trigger.  Level is nan if the order cannot rest
+        '''
+        if order.time_in_force != TimeInForce.GTC or order.status != OrderStatus.OPEN: return math.nan, False
+        if isinstance(order, StopLimitOrder):
+            if not order.triggered: return order.trigger_price, order.qty > 0
+            return order.limit_price, order.qty < 0
+        if isinstance(order, LimitOrder): return order.limit_price, order.qty < 0
+        return math.nan, False
+    
+    def _add_resting_order(self, order: Order, start_idx: int) -> bool:
+        '''
+        Find the first index at or after start_idx where the order can fill. If this is later than start_idx
+        we don't send the order to market simulators till then, or till the order is changed or cancelled.
+        Returns whether the order is resting
+        '''
+        assert self.trigger_price_func is not None  # keep mypy happy
+        level, above = self._get_resting_level(order)
+        if not math.isfinite(level): return False
+        prices = self.trigger_price_func(order.contract, self.strategy_context)
+        if prices is None: return False
+        wake_idx = np_first_crossing(prices, level, start_idx, above)
+        if wake_idx <= start_idx: return False
+        self._resting_orders[id(order)] = (order, wake_idx)
+        order._add_listener(self._on_resting_order_change)
+        if wake_idx < len(self.timestamps): self._resting_wake_iter[wake_idx].append(order)
+        return True
+    
+    def _wake_order(self, order: Order) -> None:
+        '''Move a resting order back to active orders, in the position it was created in'''
+        del self._resting_orders[id(order)]
+        order._remove_listener(self._on_resting_order_change)
+        if order.is_open(): bisect.insort(self._active_orders, order, key=lambda x: self._order_seq[id(x)])
+        
+    def _on_resting_order_change(self, order: Order, name: str) -> None:
+        '''A rule cancelled or changed a resting order, so the level we scanned for may no longer apply'''
+        self._wake_order(order)
+            
     def _update_current_orders(self) -> None:
         '''
         Remove any orders that are not open
         '''
-        # _logger.info(f'before update: {self._current_orders}')
-        if any([not order.is_open() for order in self._current_orders]):
-            self._current_orders = [order for order in self._current_orders if order.is_open()]
-        # _logger.info(f'after update: {self._current_orders}')
-            
+        self._current_orders.remove_closed()
+        # Current orders only has open orders now, and resting orders are always open, so this is only true if some
+        # active orders were closed
+        if len(self._active_orders) + len(self._resting_orders) > len(self._current_orders):
+            self._active_orders = [order for order in self._active_orders if order.is_open()]
+
+    def _get_open_order_state(self) -> dict[str, Any]:
+        '''
+        Returns the open orders that later calls to run_rules continue from, so they can be copied back from a worker process.
+        Resting orders are keyed by order id, which changes when orders are pickled, so they are returned as a list
+        '''
+        return {'current_orders': self._current_orders,
+                'active_orders': self._active_orders,
+                'resting_orders': list(self._resting_orders.values())}
+
+    def _set_open_order_state(self, state: dict[str, Any]) -> None:
+        '''Restores open orders returned by _get_open_order_state.  Orders in state must be the same objects as in _orders'''
+        self._current_orders = state['current_orders']
+        self._active_orders = state['active_orders']
+        self._order_seq = {}
+        for order in self._orders: self._order_seq[id(order)] = len(self._order_seq)
+        self._resting_orders = {}
+        self._resting_wake_iter = defaultdict(list)
+        for order, wake_idx in state['resting_orders']:
+            self._resting_orders[id(order)] = (order, wake_idx)
+            order._add_listener(self._on_resting_order_change)
+            if wake_idx < len(self.timestamps): self._resting_wake_iter[wake_idx].append(order)
+
     def run(self) -> None:
         self.run_indicators()
         self.run_signals()
@@ -475,7 +709,15 @@ class Strategy:
         '''
         Go through all open orders and run market simulators to generate a list of trades and return any orders that were not filled.
         '''
-        for order in self._current_orders:
+        woken_orders = []
+        for order in self._resting_wake_iter.pop(i, []):
+            # Skip orders that were already woken because they changed, and may be resting till a different index now
+            resting = self._resting_orders.get(id(order))
+            if resting is None or resting[1] != i: continue
+            self._wake_order(order)
+            woken_orders.append(order)
+        
+        for order in self._active_orders:
             idx = np.searchsorted(self.timestamps, order.timestamp)
             assert_(bool(idx >= 0 and idx < len(self.timestamps) and idx <= i), 
                     f'{i} {idx} {len(self.timestamps)} {order.timestamp}')
@@ -496,8 +738,7 @@ class Strategy:
         for market_sim_function in self.market_sims:
             try:
                 self._update_current_orders()
-                
-                trades = market_sim_function(self._current_orders, 
+                trades = market_sim_function(self._active_orders, 
                                              i, 
                                              self.timestamps, 
                                              self.indicator_values, 
@@ -516,6 +757,13 @@ class Strategy:
                 raise type(e)(f'Exception: {str(e)} at index: {i} function: {market_sim_function}').with_traceback(sys.exc_info()[2])
                 
         self._update_current_orders()
+        
+        # If a woken order did not fill, for example because of slippage, or a stop order was triggered but its limit was not hit
+        # scan again from the next bar
+        rested = False
+        for order in woken_orders:
+            if order.is_open() and self._add_resting_order(order, i + 1): rested = True
+        if rested: self._active_orders = [order for order in self._active_orders if id(order) not in self._resting_orders]
             
     def df_data(self, 
                 contract_groups: Sequence[ContractGroup] | None = None, 
@@ -17,12 +17,33 @@ from pyqstrat.pq_types import Contract, ContractGroup, DEFAULT_CG
 from pyqstrat.strategy import PriceFunctionType, StrategyContextType, MarketSimulatorType
 from pyqstrat.strategy import RuleType, IndicatorType, SignalType
 from pyqstrat.strategy_components import VectorSignal, VectorIndicator, SimpleMarketSimulator
+from pyqstrat.shared_data import SharedDataStore
 from pyqstrat.pq_utils import assert_, get_child_logger
 
 
 _logger = get_child_logger(__name__)
 
 
+def _same_indicator(strategy: Strategy,
+                    name: str,
+                    indicator: IndicatorType,
+                    contract_groups: Sequence[ContractGroup] | None,
+                    depends_on: Sequence[str] | None) -> bool:
+    '''Returns whether the indicator with this name in the strategy is the same as the one passed in'''
+    if contract_groups is None: contract_groups = strategy.contract_groups
+    if [cg.name for cg in contract_groups] != [cg.name for cg in strategy.indicator_cgroups[name]]: return False
+    if strategy.indicator_deps[name] != ([] if depends_on is None else list(depends_on)): return False
+    existing = strategy.indicators[name]
+    if existing is indicator: return True
+    # Vector indicators are created again each time a builder adds a series indicator, so compare their values
+    if isinstance(existing, VectorIndicator) and isinstance(indicator, VectorIndicator):
+        return np.array_equal(existing.vector, indicator.vector, equal_nan=np.issubdtype(indicator.vector.dtype, np.inexact))
+    try:
+        return bool(existing == indicator)
+    except Exception:
+        return False
+
+
 @dataclass
 class StrategyBuilder:
     '''
@@ -177,10 +198,7 @@ class StrategyBuilder:
         self.signals.append((sig_name, VectorSignal(self.data[column_name].values), contract_groups, None, None))
         self.rules.append((rule_name, rule_function, sig_name, None, position_filter))
 
-    def __call__(self) -> Strategy:
-        '''
-        Generates a strategy object that we can then run and evaluate
-        '''
+    def _create_strategy(self) -> Strategy:
         assert_(self.price_function is not None, 'price function must be set')
         if self.timestamps is None:
             assert_(self.data is not None, 'data cannot be None if timestamps is not set')
@@ -190,19 +208,73 @@ class StrategyBuilder:
         else:
             _contract_groups = list(self.contract_groups.values())
         
-        strat = Strategy(_timestamps, 
-                         _contract_groups, 
-                         self.price_function,  # type: ignore
-                         self.starting_equity, 
-                         self.pnl_calc_time, 
-                         self.trade_lag, 
-                         True,
-                         self.log_trades,
-                         self.log_orders,
-                         self.strategy_context)
+        return Strategy(_timestamps, 
+                        _contract_groups, 
+                        self.price_function,  # type: ignore
+                        self.starting_equity, 
+                        self.pnl_calc_time, 
+                        self.trade_lag, 
+                        True,
+                        self.log_trades,
+                        self.log_orders,
+                        self.strategy_context)
+    
+    def build_template(self, shared_data: SharedDataStore | None = None, prefix: str = 'template') -> Strategy:
+        '''
+        Generates a strategy that only contains the indicators added to this builder, and computes them.  Pass this template
+        to __call__ so that strategies built for each experiment in an optimization reuse these indicator values instead
+        of recomputing them.  Indicator values in the template are read-only.
+        
+        If you build the template before running the Optimizer, for example as a member of a cost function object,
+        worker processes receive it once, when they start.  With the fork start method they share its memory 
+        with this process, and with spawn they receive a copy, unless you set shared_data.
         
+        Args:
+            shared_data: If set, each indicator array is copied into this store, and the template references the shared 
+                arrays.  Worker processes then attach to the arrays instead of receiving a copy.  Default None
+            prefix: Indicator arrays are added to shared_data with names like {prefix}.{contract group}.{indicator}.  
+                Use a different prefix for each template that you add to the same store.  Default "template"
+        '''
+        strat = self._create_strategy()
+        for name, indicator, contract_groups, depends_on in self.indicators:
+            strat.add_indicator(name, indicator, contract_groups, depends_on)
+        strat.run_indicators()
+        for cgroup_name, values in strat.indicator_values.items():
+            for name, array in vars(values).items():
+                if shared_data is not None:
+                    array = shared_data.add(f'{prefix}.{cgroup_name}.{name}', array)
+                elif isinstance(array, np.ndarray):
+                    # Use a view so we don't change the flags of arrays that were passed in by the caller
+                    array = array.view()
+                    array.flags.writeable = False
+                setattr(values, name, array)
+        return strat
+
+    def __call__(self, template: Strategy | None = None) -> Strategy:
+        '''
+        Generates a strategy object that we can then run and evaluate
+        
+        Args:
+            template: A strategy returned by build_template.  If set, the new strategy shares indicator values with the template 
+                and only indicators that are not in the template are computed when it runs.  Timestamps and contract groups
+                are taken from the template.  Default None
+        '''
         assert_(self.rules is not None and len(self.rules) > 0, 'rules cannot be empty or None')
+        if template is None:
+            strat = self._create_strategy()
+        else:
+            assert_(self.price_function is not None, 'price function must be set')
+            strat = template.clone(self.starting_equity, self.strategy_context, self.price_function, self.pnl_calc_time)
+            strat.trade_lag = self.trade_lag
+            strat.log_trades = self.log_trades
+            strat.log_orders = self.log_orders
+
         for name, indicator, contract_groups, depends_on in self.indicators:
+            if name in strat.indicators:
+                # Indicator values come from the template, so it must compute the indicator the same way we would
+                assert_(_same_indicator(strat, name, indicator, contract_groups, depends_on),
+                        f'indicator: {name} has a different definition in the template')
+                continue
             strat.add_indicator(name, indicator, contract_groups, depends_on)
              
         for name, signal_function, contract_groups, depends_on_inds, depends_on_sigs in self.signals:
@@ -6,15 +6,17 @@
 # $$_end_markdown
 # $$_code
 # $$_ %%checkall
+from __future__ import annotations
 import numpy as np
 from dataclasses import dataclass
+from collections import OrderedDict
 import math
 from types import SimpleNamespace
-from typing import Sequence, Callable
+from typing import Sequence, Callable, Any
 from pyqstrat.account import Account
 from pyqstrat.pq_types import Contract, ContractGroup, Trade, Order, VWAPOrder
-from pyqstrat.pq_types import MarketOrder, LimitOrder, TimeInForce
-from pyqstrat.strategy import PriceFunctionType, StrategyContextType
+from pyqstrat.pq_types import MarketOrder, LimitOrder, TimeInForce, OrderStatus
+from pyqstrat.strategy import PriceFunctionType, StrategyContextType, has_open_orders
 from pyqstrat.pq_utils import assert_, get_child_logger, np_indexof_sorted
 
 
@@ -188,6 +190,90 @@ class PriceFuncDict:
         return price
     
 
+@dataclass
+class PriceFuncCache:
+    '''
+    A function object with a signature of PriceFunctionType that memoizes another price function for recently used bars.
+    Basket prices are composed from cached component prices so each leg is looked up once per bar.  Nothing wraps price
+    functions automatically, so pass the same instance to the strategy, rules and market simulators, so a price looked 
+    up by one of them is reused by the others.  Prices are cached by timestamps array and timestamp, so strategies in a 
+    portfolio with different timestamps can share an instance.  The least recently used bar is dropped when more than
+    max_bars bars are cached, so lookups for a few earlier bars, for example when the account computes PNL for previous days,
+    don't evict the current bar.  The wrapped price function must return the same price for the same timestamp.
+    
+    Args:
+        price_func: The price function to memoize
+        max_bars: Maximum number of bars to cache prices for.  Default 4
+        
+    >>> timestamps = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-04'))
+    >>> calls = []
+    >>> def price_func(contract, timestamps, i, context):
+    ...     calls.append((contract.symbol, i))
+    ...     return {'AAPL': 10., 'IBM': 20.}[contract.symbol] + i
+    >>> Contract.clear_cache()
+    >>> aapl, ibm = Contract.create('AAPL'), Contract.create('IBM')
+    >>> basket = Contract.create('AAPL_IBM', components=[(aapl, 1), (ibm, -1)])
+    >>> cache = PriceFuncCache(price_func)
+    >>> cache(basket, timestamps, 1, None), cache(aapl, timestamps, 1, None), cache(basket, timestamps, 1, None)
+    (-10.0, 11.0, -10.0)
+    >>> calls
+    [('AAPL', 1), ('IBM', 1)]
+    >>> cache(aapl, timestamps, 2, None), cache(aapl, timestamps, 0, None), cache(aapl, timestamps, 2, None)
+    (12.0, 10.0, 12.0)
+    >>> calls[2:]
+    [('AAPL', 2), ('AAPL', 0)]
+    >>> cache(aapl, timestamps[1:], 0, None), cache(aapl, timestamps, 0, None)
+    (10.0, 10.0)
+    >>> calls[4:]
+    [('AAPL', 0)]
+    '''
+    price_func: PriceFunctionType
+    max_bars: int
+        
+    def __init__(self, price_func: PriceFunctionType, max_bars: int = 4) -> None:
+        assert_(max_bars > 0, f'max_bars must be positive: {max_bars}')
+        self.price_func = price_func
+        self.max_bars = max_bars
+        # (id of timestamps array, timestamp) -> symbol -> price, in least recently used order
+        self._bars: OrderedDict[tuple[int, Any], dict[str, float]] = OrderedDict()
+        # Timestamps arrays in _bars.  We keep a reference so their ids are not reused by other arrays while they are cached
+        self._arrays: dict[int, np.ndarray] = {}
+        
+    def clear(self) -> None:
+        '''Remove all cached prices'''
+        self._bars.clear()
+        self._arrays.clear()
+        
+    def _compute(self, contract: Contract, timestamps: np.ndarray, i: int, context: StrategyContextType) -> float:
+        if not contract.is_basket(): return self.price_func(contract, timestamps, i, context)
+        price = 0.
+        for _contract, ratio in contract.components:
+            price += self(_contract, timestamps, i, context) * ratio
+        return price
+    
+    def _get_bar(self, timestamps: np.ndarray, i: int) -> dict[str, float]:
+        key = (id(timestamps), timestamps[i])
+        prices = self._bars.get(key)
+        if prices is not None:
+            self._bars.move_to_end(key)
+            return prices
+        prices = {}
+        self._bars[key] = prices
+        self._arrays[id(timestamps)] = timestamps
+        if len(self._bars) > self.max_bars:
+            (array_id, _), _ = self._bars.popitem(last=False)
+            if not any([k[0] == array_id for k in self._bars]): del self._arrays[array_id]
+        return prices
+        
+    def __call__(self, contract: Contract, timestamps: np.ndarray, i: int, context: StrategyContextType) -> float:
+        prices = self._get_bar(timestamps, i)
+        price = prices.get(contract.symbol)
+        if price is None:
+            price = self._compute(contract, timestamps, i, context)
+            prices[contract.symbol] = price
+        return price
+    
+
 @dataclass
 class SimpleMarketSimulator:
     '''
@@ -208,6 +294,10 @@ class SimpleMarketSimulator:
     >>> assert(len(out) == 1)
     >>> assert(math.isclose(out[0].price, -1.3))
     >>> assert(out[0].qty == 10)    
+    >>> buy_order = LimitOrder(contract=put_contract, timestamp=timestamp, qty=10, limit_price=5, reason_code='TEST')
+    >>> sell_order = LimitOrder(contract=put_contract, timestamp=timestamp, qty=-10, limit_price=5, reason_code='TEST')
+    >>> out = sim([buy_order, sell_order], 0, np.array([timestamp]), {}, {}, SimpleNamespace())
+    >>> assert(len(out) == 1 and out[0].qty == 10 and math.isclose(out[0].price, 4.8))
     '''
     price_func: PriceFunctionType
     slippage_pct: float
@@ -261,8 +351,8 @@ class SimpleMarketSimulator:
             price = raw_price + slippage
             price = round(price, self.price_rounding)
             if isinstance(order, LimitOrder) and np.isfinite(order.limit_price):
-                if ((abs(order.qty > 0) and order.limit_price > price) 
-                        or (abs(order.qty < 0) and order.limit_price < price)):
+                if ((order.qty > 0 and price > order.limit_price) 
+                        or (order.qty < 0 and price < order.limit_price)):
                     continue
             commission = self.commission * order.qty
             if order.qty < 0: commission = -commission
@@ -274,6 +364,144 @@ class SimpleMarketSimulator:
         return trades
     
 
+@dataclass
+class QuoteMarketSimulator:
+    '''
+    A function object with a signature of MarketSimulatorType that fills market and limit orders against
+    top of book quotes.  Buys fill at the ask and sells at the bid, and fills are capped by the quoted size.
+    Orders in the same contract and direction share the quoted size in the order they were created.
+    Quotes are stored in columnar form, i.e. 2D arrays with one row per strategy timestamp and one column per contract.  
+    Any object that returns a numpy array for a row index, such as a numpy memmap or an h5py dataset, can be used
+    so only the rows we need are read into memory. This simulator ignores basket contracts and contracts not in symbols
+    
+    Args:
+        symbols: Contract symbols corresponding to the quote columns
+        bid: Bid price per timestamp per contract
+        ask: Ask price per timestamp per contract
+        bid_size: Quantity available at the bid per timestamp per contract
+        ask_size: Quantity available at the ask per timestamp per contract
+        commission: Commission paid per contract traded. Default 0
+        allow_partial_fills: If set, orders larger than the quoted size are partially filled. Otherwise they
+            are only filled when the full qty is available. Default True
+        post_trade_func: A function called with each trade and the strategy context after the trade is created. Default None
+        
+    >>> ContractGroup.clear_cache()
+    >>> Contract.clear_cache()
+    >>> aapl, ibm = Contract.create('AAPL'), Contract.create('IBM')
+    >>> timestamps = np.array(['2023-01-03 09:30', '2023-01-03 09:31'], dtype='M8[m]')
+    >>> bid = np.array([[10.1, 20.1], [10.2, 20.2]])
+    >>> ask = np.array([[10.3, 20.3], [10.4, 20.4]])
+    >>> bid_size = np.array([[100, 50], [100, 50]])
+    >>> ask_size = np.array([[200, 30], [200, 30]])
+    >>> sim = QuoteMarketSimulator(['AAPL', 'IBM'], bid, ask, bid_size, ask_size)
+    >>> orders = [MarketOrder(contract=ibm, timestamp=timestamps[0], qty=20),
+    ...           MarketOrder(contract=ibm, timestamp=timestamps[0], qty=20),
+    ...           LimitOrder(contract=aapl, timestamp=timestamps[0], qty=-50, limit_price=10.2),
+    ...           LimitOrder(contract=aapl, timestamp=timestamps[0], qty=-50, limit_price=10.1)]
+    >>> trades = sim(orders, 1, timestamps, {}, {}, SimpleNamespace())
+    >>> [(trade.contract.symbol, trade.qty, trade.price) for trade in trades]
+    [('IBM', 20.0, 20.4), ('IBM', 10.0, 20.4), ('AAPL', -50.0, 10.2), ('AAPL', -50.0, 10.2)]
+    >>> orders[1].status, orders[1].qty
+    (<OrderStatus.PARTIALLY_FILLED: 2>, 10.0)
+    '''
+    symbols: Sequence[str]
+    bid: np.ndarray
+    ask: np.ndarray
+    bid_size: np.ndarray
+    ask_size: np.ndarray
+    commission: float
+    allow_partial_fills: bool
+    post_trade_func: Callable[[Trade, StrategyContextType], None] | None
+        
+    def __init__(self,
+                 symbols: Sequence[str],
+                 bid: np.ndarray,
+                 ask: np.ndarray,
+                 bid_size: np.ndarray,
+                 ask_size: np.ndarray,
+                 commission: float = 0.,
+                 allow_partial_fills: bool = True,
+                 post_trade_func: Callable[[Trade, StrategyContextType], None] | None = None) -> None:
+        for name, array in [('bid', bid), ('ask', ask), ('bid_size', bid_size), ('ask_size', ask_size)]:
+            assert_(len(array.shape) == 2 and array.shape[1] == len(symbols),
+                    f'{name} must have shape (num timestamps, {len(symbols)}), got: {array.shape}')
+        self.symbols = symbols
+        self.bid = bid
+        self.ask = ask
+        self.bid_size = bid_size
+        self.ask_size = ask_size
+        self.commission = commission
+        self.allow_partial_fills = allow_partial_fills
+        self.post_trade_func = post_trade_func
+        self._symbol_idx = {symbol: j for j, symbol in enumerate(symbols)}
+        
+    @staticmethod
+    def from_hdf5(filename: str, key: str, **kwargs: Any) -> QuoteMarketSimulator:
+        '''
+        Create a simulator from a group in an hdf5 file containing the datasets symbols, bid, ask, bid_size and ask_size.
+        The quote datasets are read into memory and the file is closed.  If they do not fit into memory, open the file
+        yourself and pass the h5py datasets to the constructor.  Any other arguments are passed to the constructor
+        '''
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            assert_(key in f, f'{key} not found in {filename}')
+            grp = f[key]
+            symbols = [symbol.decode() if isinstance(symbol, bytes) else symbol for symbol in grp['symbols'][:]]
+            bid, ask, bid_size, ask_size = [grp[name][:] for name in ['bid', 'ask', 'bid_size', 'ask_size']]
+        return QuoteMarketSimulator(symbols, bid, ask, bid_size, ask_size, **kwargs)
+    
+    def __call__(self,
+                 orders: Sequence[Order],
+                 i: int, 
+                 timestamps: np.ndarray, 
+                 indicators: dict[str, SimpleNamespace],
+                 signals: dict[str, SimpleNamespace],
+                 strategy_context: SimpleNamespace) -> list[Trade]:
+        _orders = [order for order in orders if isinstance(order, (MarketOrder, LimitOrder)) 
+                   and order.status in [OrderStatus.OPEN, OrderStatus.PARTIALLY_FILLED]
+                   and order.contract.symbol in self._symbol_idx]
+        if not len(_orders): return []
+        
+        cols = np.array([self._symbol_idx[order.contract.symbol] for order in _orders])
+        qtys = np.array([order.qty for order in _orders], dtype=float)
+        limits = np.array([order.limit_price if isinstance(order, LimitOrder) else math.nan for order in _orders])
+        buy = qtys > 0
+        
+        bid, ask, bid_size, ask_size = self.bid[i], self.ask[i], self.bid_size[i], self.ask_size[i]
+        prices = np.where(buy, ask[cols], bid[cols])
+        available = np.where(buy, ask_size[cols], bid_size[cols]).astype(float)
+        
+        fillable = np.isfinite(prices) & (available > 0)
+        has_limit = np.isfinite(limits)
+        fillable &= ~has_limit | np.where(buy, prices <= limits, prices >= limits)
+        
+        # Orders in the same contract and direction share the quoted size in the order they were sent
+        abs_qtys = np.where(fillable, np.abs(qtys), 0.)
+        sort_idx = np.lexsort((buy, cols))
+        sorted_qtys = abs_qtys[sort_idx]
+        cum_qtys = np.cumsum(sorted_qtys)
+        key = cols[sort_idx] * 2 + buy[sort_idx]
+        group_start = np.concatenate([[True], key[1:] != key[:-1]])
+        group_offset = np.maximum.accumulate(np.where(group_start, cum_qtys - sorted_qtys, 0.))
+        prior_qtys = np.empty_like(abs_qtys)
+        prior_qtys[sort_idx] = cum_qtys - sorted_qtys - group_offset
+        fill_qtys = np.clip(available - prior_qtys, 0, abs_qtys)
+        if not self.allow_partial_fills: fill_qtys = np.where(fill_qtys < abs_qtys, 0., fill_qtys)
+        fill_qtys = np.floor(fill_qtys) * np.sign(qtys)
+        
+        timestamp = timestamps[i]
+        trades = []
+        for j in np.nonzero(fill_qtys)[0]:
+            order = _orders[j]
+            fill_qty = float(fill_qtys[j])
+            trade = Trade(order.contract, order, timestamp, fill_qty, float(prices[j]), commission=self.commission * abs(fill_qty))
+            order.fill(fill_qty)
+            trades.append(trade)
+            if self.post_trade_func is not None:
+                self.post_trade_func(trade, strategy_context)
+        return trades
+    
+    
 @dataclass
 class PercentOfEquityTradingRule:
     '''
@@ -395,13 +623,8 @@ class VWAPEntryRule:
                  current_orders: Sequence[Order],
                  strategy_context: StrategyContextType) -> list[Order]:
         timestamp = timestamps[i]
-        if self.single_entry_per_day:
-            date = timestamp.astype('M8[D]')
-            trades = account.get_trades_for_date(contract_group.name, date)
-            if len(trades): return []
-            
-        for order in current_orders:
-            if order.contract.contract_group == contract_group and order.is_open(): return []
+        if self.single_entry_per_day and account.num_trades_for_date(contract_group, timestamp): return []
+        if has_open_orders(current_orders, contract_group): return []
 
         orders: list[Order] = []
         contracts = contract_group.get_contracts()
@@ -462,8 +685,7 @@ class VWAPCloseRule:
                  current_orders: Sequence[Order],
                  strategy_context: StrategyContextType) -> list[Order]:
         timestamp = timestamps[i]
-        for order in current_orders:
-            if order.contract.contract_group == contract_group and order.is_open(): return []
+        if has_open_orders(current_orders, contract_group): return []
         positions = account.positions(contract_group, timestamp)
         orders: list[Order] = []
         for (contract, qty) in positions:
@@ -662,7 +884,6 @@ class BracketOrderEntryRule:
                  current_orders: Sequence[Order],
                  strategy_context: StrategyContextType) -> list[Order]:
         timestamp = timestamps[i]
-        date = timestamp.astype('M8[D]')
 
         contracts: list[Contract] = []
         if self.contract_filter is not None:
@@ -677,9 +898,7 @@ class BracketOrderEntryRule:
             
         orders: list[Order] = []
         for contract in contracts:
-            if self.single_entry_per_day:
-                trades = account.get_trades_for_date(contract_group.name, date)
-                if len(trades): continue
+            if self.single_entry_per_day and account.num_trades_for_date(contract_group, timestamp): continue
             
             entry_price_est = self.price_func(contract, timestamps, i, strategy_context)  # type: ignore
             if math.isnan(entry_price_est): continue
@@ -722,6 +941,140 @@ class BracketOrderEntryRule:
         return orders
     
 
+@dataclass
+class TopNEntryRule:
+    '''
+    A rule that ranks contracts cross-sectionally and enters the top N contracts at each bar.
+    Indicators are 2D matrices with one row per strategy timestamp and one column per contract, so ranking, 
+    sizing and order generation are done for all contracts at once instead of calling a price function 
+    per contract. Order qty is proportional to inverse volatility if vol_matrix is set, otherwise 
+    equity is allocated equally to the selected contracts.  Only contracts in the contract group the rule is called with
+    are ranked, so to rank across all the symbols, add the rule to a contract group that contains all of them
+    
+    Args:
+        reason_code: Reason for the orders created used for display
+        symbols: Contract symbols corresponding to matrix columns.  Contracts must be created before the rule is called
+        rank_matrix: Values we rank contracts by
+        price_matrix: Estimated entry price per timestamp per contract, used for sizing
+        num_contracts: Number of contracts to enter
+        vol_matrix: Volatility per timestamp per contract.  If set, we size inversely proportional to volatility. Default None
+        long: Whether we want to go long or short. Default True
+        select_highest: If set, we pick the contracts with the highest values in rank_matrix, otherwise the lowest. Default True
+        percent_of_equity: Percentage of current equity allocated across all selected contracts. Default 0.1
+        
+    >>> Contract.clear_cache()
+    >>> ContractGroup.clear_cache()
+    >>> for symbol in ['A', 'B', 'C', 'D']: _ = Contract.create(symbol)
+    >>> timestamps = np.arange(np.datetime64('2023-01-01'), np.datetime64('2023-01-03'))
+    >>> rank_matrix = np.array([[0.1, 0.5, np.nan, 0.3], [0.4, 0.2, 0.9, 0.1]])
+    >>> price_matrix = np.array([[10., 20., 30., 40.], [10., 20., 30., 40.]])
+    >>> vol_matrix = np.array([[0.1, 0.1, 0.1, 0.3], [0.1, 0.1, 0.3, 0.1]])
+    >>> rule = TopNEntryRule('TOP2', ['A', 'B', 'C', 'D'], rank_matrix, price_matrix, 2, vol_matrix)
+    >>> account = SimpleNamespace(equity=lambda timestamp: 1e6)
+    >>> orders = rule(ContractGroup.get_default(), 0, timestamps, SimpleNamespace(), np.array([]), account, [], SimpleNamespace())
+    >>> [(order.contract.symbol, order.qty) for order in orders]
+    [('B', 3750.0), ('D', 625.0)]
+    >>> orders = rule(ContractGroup.get_default(), 1, timestamps, SimpleNamespace(), np.array([]), account, [], SimpleNamespace())
+    >>> [(order.contract.symbol, order.qty) for order in orders]
+    [('C', 833.0), ('A', 7500.0)]
+    >>> group = ContractGroup.get('EF')
+    >>> for symbol in ['E', 'F']: _ = Contract.create(symbol, group)
+    >>> rule = TopNEntryRule('BOTTOM1', ['E', 'A', 'F'], rank_matrix[:, :3], price_matrix[:, :3], 1, select_highest=False)
+    >>> orders = rule(group, 1, timestamps, SimpleNamespace(), np.array([]), account, [], SimpleNamespace())
+    >>> [(order.contract.symbol, order.qty) for order in orders]
+    [('E', 10000.0)]
+    '''
+    reason_code: str
+    symbols: Sequence[str]
+    rank_matrix: np.ndarray
+    price_matrix: np.ndarray
+    num_contracts: int
+    vol_matrix: np.ndarray | None
+    long: bool
+    select_highest: bool
+    percent_of_equity: float
+        
+    def __init__(self,
+                 reason_code: str,
+                 symbols: Sequence[str],
+                 rank_matrix: np.ndarray,
+                 price_matrix: np.ndarray,
+                 num_contracts: int,
+                 vol_matrix: np.ndarray | None = None,
+                 long: bool = True,
+                 select_highest: bool = True,
+                 percent_of_equity: float = 0.1) -> None:
+        assert_(num_contracts > 0, f'num_contracts must be positive: {num_contracts}')
+        for name, matrix in [('rank_matrix', rank_matrix), ('price_matrix', price_matrix), ('vol_matrix', vol_matrix)]:
+            if matrix is None: continue
+            assert_(matrix.shape == rank_matrix.shape and matrix.shape[1] == len(symbols), 
+                    f'{name} must have shape (num timestamps, {len(symbols)}) got: {matrix.shape}')
+        self.reason_code = reason_code
+        self.symbols = symbols
+        self.rank_matrix = rank_matrix
+        self.price_matrix = price_matrix
+        self.num_contracts = num_contracts
+        self.vol_matrix = vol_matrix
+        self.long = long
+        self.select_highest = select_highest
+        self.percent_of_equity = percent_of_equity
+        self._contracts: list[Contract | None] | None = None
+        # Contract group name -> which columns are contracts in that group
+        self._group_masks: dict[str, np.ndarray] = {}
+        
+    def __call__(self,
+                 contract_group: ContractGroup,
+                 i: int,
+                 timestamps: np.ndarray,
+                 indicator_values: SimpleNamespace,
+                 signal_values: np.ndarray,
+                 account: Account,
+                 current_orders: Sequence[Order],
+                 strategy_context: StrategyContextType) -> list[Order]:
+        if self._contracts is None: self._contracts = [Contract.get(symbol) for symbol in self.symbols]
+        in_group = self._group_masks.get(contract_group.name)
+        if in_group is None:
+            in_group = np.array([contract is not None and contract.contract_group == contract_group for contract in self._contracts])
+            self._group_masks[contract_group.name] = in_group
+        
+        ranks = self.rank_matrix[i]
+        prices = self.price_matrix[i]
+        valid = np.isfinite(ranks) & np.isfinite(prices) & (prices > 0)
+        if self.vol_matrix is not None:
+            vols = self.vol_matrix[i]
+            valid &= np.isfinite(vols) & (vols > 0)
+        valid &= in_group
+        
+        num_valid = int(np.sum(valid))
+        if num_valid == 0: return []
+        n = min(self.num_contracts, num_valid)
+        
+        # Sort so that higher is better, and push invalid contracts to the end
+        scores = np.where(valid, ranks if self.select_highest else -ranks, -np.inf)
+        selected = np.argpartition(-scores, n - 1)[:n]
+        selected = selected[np.argsort(-scores[selected], kind='stable')]
+        
+        if self.vol_matrix is not None:
+            weights = 1. / self.vol_matrix[i][selected]
+            weights /= np.sum(weights)
+        else:
+            weights = np.full(n, 1. / n)
+            
+        curr_equity = account.equity(timestamps[i])
+        qtys = np.floor(weights * self.percent_of_equity * curr_equity / prices[selected])
+        if not self.long: qtys = -qtys
+        
+        timestamp = timestamps[i]
+        orders: list[Order] = []
+        for j, qty in zip(selected, qtys):
+            if qty == 0: continue
+            orders.append(MarketOrder(contract=self._contracts[j],  # type: ignore
+                                      timestamp=timestamp,
+                                      qty=float(qty),
+                                      reason_code=self.reason_code))
+        return orders
+    
+
 @dataclass
 class ClosePositionExitRule:
     '''
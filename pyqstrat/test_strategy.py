@@ -15,8 +15,9 @@ import pandas as pd
 import pyqstrat as pq
 import math
 import os
+import pickle
 from types import SimpleNamespace
-from typing import Sequence
+from typing import Callable, Sequence
 
 _logger = pq.get_child_logger(__name__)
 
@@ -276,9 +277,478 @@ def test_strategy_2() -> None:
     strategy.run()
     
 
+def test_resting_orders() -> None:
+    '''Test that resting limit orders are only sent to the market simulator once price crosses the limit'''
+    timestamps = np.arange(np.datetime64('2018-01-05T08:00'), np.datetime64('2018-01-05T08:10'))
+    prices = np.array([100., 100., 99., 98., 97., 96., 94., 95., 96., 97.])
+    
+    def entry_signal(contract_group: pq.ContractGroup,
+                     timestamps: np.ndarray,
+                     indicators: SimpleNamespace, 
+                     parent_signals: SimpleNamespace,
+                     strategy_context: pq.StrategyContextType) -> np.ndarray: 
+        return np.arange(len(timestamps)) == 1
+    
+    def entry_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract('IBM')
+        return [pq.LimitOrder(contract=contract, timestamp=timestamps[i], qty=10, limit_price=95,  # type: ignore
+                              time_in_force=pq.TimeInForce.GTC)]
+    
+    def amend_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        for order in orders: order.limit_price = 97.5  # type: ignore
+        return []
+    
+    def get_price(contract: pq.Contract, timestamps: np.ndarray, i: int, strategy_context: pq.StrategyContextType) -> float:
+        return prices[i]
+    
+    def run(use_trigger_prices: bool, amend: bool = False) -> tuple[list[int], list[pq.Trade]]:
+        pq.ContractGroup.clear_cache()
+        pq.Contract.clear_cache()
+        cg = pq.ContractGroup.get('IBM')
+        pq.Contract.create('IBM', cg)
+        sim_indices: list[int] = []
+
+        def market_sim(orders, i, timestamps, indicators, signals, strategy_context):
+            if len(orders): sim_indices.append(i)
+            trades = []
+            for order in orders:  # buy limit orders fill once the price is at or below the limit
+                if prices[i] > order.limit_price: continue
+                trades.append(pq.Trade(order.contract, order, timestamps[i], order.qty, prices[i]))
+                order.fill()
+            return trades
+        
+        strategy = pq.Strategy(timestamps, [cg], get_price, trade_lag=1, log_trades=False)
+        strategy.add_signal('entry_sig', entry_signal)
+        strategy.add_rule('entry_rule', entry_rule, signal_name='entry_sig')
+        if amend:
+            strategy.add_signal('amend_sig', lambda cg, ts, ind, sig, ctx: np.arange(len(ts)) == 3)
+            strategy.add_rule('amend_rule', amend_rule, signal_name='amend_sig')
+        strategy.add_market_sim(market_sim)
+        if use_trigger_prices: strategy.set_trigger_price_function(lambda contract, context: prices)
+        strategy.run()
+        return sim_indices, strategy.trades()
+    
+    sim_indices, trades = run(False)
+    assert sim_indices == [2, 3, 4, 5, 6]
+    resting_sim_indices, resting_trades = run(True)
+    assert resting_sim_indices == [6]
+    assert len(trades) == 1 and len(resting_trades) == 1
+    assert trades[0].timestamp == resting_trades[0].timestamp == timestamps[6]
+    assert trades[0].price == resting_trades[0].price == 94.
+    
+    # Changing the limit price of a resting order wakes it up, so it fills on the next bar
+    sim_indices, trades = run(False, amend=True)
+    resting_sim_indices, resting_trades = run(True, amend=True)
+    assert sim_indices == [2, 3, 4] and resting_sim_indices == [4]
+    assert len(trades) == len(resting_trades) == 1 and trades[0].timestamp == resting_trades[0].timestamp == timestamps[4]
+    
+
+def test_price_func_cache() -> None:
+    '''
+    Test that a price cache shared by strategies with different timestamps in a portfolio, their accounts and market simulators
+    gives the same results as the uncached price function, and keeps caching when it is reused for another run
+    '''
+    start = np.datetime64('2018-01-05T08:00:00')
+    timestamps_list: list[np.ndarray] = [np.arange(start, start + np.timedelta64(10, 'm'), np.timedelta64(1, 'm')),
+                                         np.arange(start + np.timedelta64(30, 's'), start + np.timedelta64(10, 'm'), np.timedelta64(1, 'm'))]
+    num_calls = [0]
+    
+    def get_price(contract: pq.Contract, timestamps: np.ndarray, i: int, strategy_context: pq.StrategyContextType) -> float:
+        num_calls[0] += 1
+        return 100. + (timestamps[i] - start) / np.timedelta64(1, 's')
+    
+    def entry_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract('IBM')
+        return [pq.MarketOrder(contract=contract, timestamp=timestamps[i], qty=10, reason_code='ENTER')]  # type: ignore
+    
+    def run(price_func: pq.PriceFunctionType) -> pq.Portfolio:
+        pq.ContractGroup.clear_cache()
+        pq.Contract.clear_cache()
+        cg = pq.ContractGroup.get('IBM')
+        pq.Contract.create('IBM', cg)
+        portfolio = pq.Portfolio()
+        # Both strategies trade the same contract at bars with the same indices but different timestamps
+        for k, timestamps in enumerate(timestamps_list):
+            strategy = pq.Strategy(timestamps, [cg], price_func, trade_lag=1, log_trades=False)
+            strategy.add_signal('entry_sig', lambda cg, ts, ind, sig, ctx: np.isin(np.arange(len(ts)), [1, 5]))
+            strategy.add_rule('entry_rule', entry_rule, signal_name='entry_sig')
+            strategy.add_market_sim(pq.SimpleMarketSimulator(price_func))
+            portfolio.add_strategy(f'strategy_{k}', strategy)
+        portfolio.run()
+        return portfolio
+    
+    expected = run(get_price)
+    uncached_calls = num_calls[0]
+    cache = pq.PriceFuncCache(get_price)
+    for _ in range(2):
+        num_calls[0] = 0
+        # Run again without clearing the cache
+        portfolio = run(cache)
+        assert num_calls[0] < uncached_calls
+        for name in ['strategy_0', 'strategy_1']:
+            pd.testing.assert_frame_equal(portfolio.strategies[name].df_trades(), expected.strategies[name].df_trades())
+            pd.testing.assert_frame_equal(portfolio.strategies[name].df_returns(), expected.strategies[name].df_returns())
+    assert (expected.strategies['strategy_0'].df_trades().price.values != expected.strategies['strategy_1'].df_trades().price.values).all()
+
+
+def test_portfolio_multi_process() -> None:
+    '''Test that running portfolio strategies in worker processes gives the same results as running them in one process'''
+    timestamps = np.arange(np.datetime64('2018-01-05T08:00'), np.datetime64('2018-01-05T08:10'))
+    prices = {'IBM': np.arange(100., 110.), 'MSFT': np.arange(50., 40., -1)}
+    
+    def entry_signal(contract_group: pq.ContractGroup,
+                     timestamps: np.ndarray,
+                     indicators: SimpleNamespace, 
+                     parent_signals: SimpleNamespace,
+                     strategy_context: pq.StrategyContextType) -> np.ndarray: 
+        return np.isin(np.arange(len(timestamps)), [1, 5])
+    
+    def entry_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract(contract_group.name)
+        return [pq.MarketOrder(contract=contract, timestamp=timestamps[i], qty=10, reason_code='ENTER')]  # type: ignore
+    
+    def get_price(contract: pq.Contract, timestamps: np.ndarray, i: int, strategy_context: pq.StrategyContextType) -> float:
+        return prices[contract.symbol][i]
+    
+    def run(max_processes: int) -> pq.Portfolio:
+        pq.ContractGroup.clear_cache()
+        pq.Contract.clear_cache()
+        portfolio = pq.Portfolio()
+        for symbol in ['IBM', 'MSFT']:
+            cg = pq.ContractGroup.get(symbol)
+            pq.Contract.create(symbol, cg)
+            strategy = pq.Strategy(timestamps, [cg], get_price, trade_lag=1, log_trades=False)
+            strategy.add_indicator('price', pq.VectorIndicator(prices[symbol]))
+            strategy.add_signal('entry_sig', entry_signal, depends_on_indicators=['price'])
+            strategy.add_rule('entry_rule', entry_rule, signal_name='entry_sig')
+            strategy.add_market_sim(pq.SimpleMarketSimulator(get_price))
+            portfolio.add_strategy(symbol, strategy)
+        portfolio.run(max_processes=max_processes)
+        return portfolio
+    
+    serial = run(1)
+    parallel = run(2)
+    for name in ['IBM', 'MSFT']:
+        trades = parallel.strategies[name].trades()
+        assert len(trades) == 2
+        assert trades[0].contract is pq.Contract.get(name)
+        assert len(parallel.strategies[name].orders()) == 2
+        assert np.array_equal(parallel.strategies[name].indicator_values[name].price, prices[name])
+        assert parallel.strategies[name].signal_values[name].entry_sig.sum() == 2
+        pd.testing.assert_frame_equal(serial.strategies[name].df_trades(), parallel.strategies[name].df_trades())
+    pd.testing.assert_frame_equal(serial.df_returns(), parallel.df_returns())
+    
+    # Portfolio returns are the sum of strategy equity, and strategy contributions add up to portfolio returns
+    df_returns = parallel.df_returns()
+    df_equity = [parallel.strategies[name].df_returns()[['timestamp', 'equity']].set_index('timestamp') for name in ['IBM', 'MSFT']]
+    assert np.allclose(df_returns.equity.values, pd.concat(df_equity, axis=1).sum(axis=1).values)
+    df_contributions = parallel.df_return_contributions()
+    assert np.allclose(df_contributions[['IBM', 'MSFT']].sum(axis=1).values[1:], df_returns.ret.values[1:])
+    df_timings = parallel.df_stage_timings()
+    assert list(df_timings.stage) == ['indicators', 'signals', 'rules'] * 2
+    assert (df_timings.bars == len(timestamps)).all()
+    
+    
+def test_portfolio_rules_in_segments() -> None:
+    '''
+    Test that GTC orders left open when rules are run for one date range in worker processes are still open, 
+    and resting if they were, when rules are run for the next date range
+    '''
+    timestamps = np.arange(np.datetime64('2018-01-05T08:00'), np.datetime64('2018-01-05T08:10'))
+    prices = np.array([100., 100., 99., 98., 97., 96., 94., 95., 96., 97.])
+    
+    def entry_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract(contract_group.name)
+        return [pq.LimitOrder(contract=contract, timestamp=timestamps[i], qty=10, limit_price=95,  # type: ignore
+                              time_in_force=pq.TimeInForce.GTC)]
+    
+    def market_sim(orders, i, timestamps, indicators, signals, strategy_context):
+        trades = []
+        for order in orders:  # buy limit orders fill once the price is at or below the limit
+            if prices[i] > order.limit_price: continue
+            trades.append(pq.Trade(order.contract, order, timestamps[i], order.qty, prices[i]))
+            order.fill()
+        return trades
+    
+    def get_price(contract: pq.Contract, timestamps: np.ndarray, i: int, strategy_context: pq.StrategyContextType) -> float:
+        return prices[i]
+    
+    def run(max_processes: int) -> pq.Portfolio:
+        pq.ContractGroup.clear_cache()
+        pq.Contract.clear_cache()
+        portfolio = pq.Portfolio()
+        for symbol, use_trigger_prices in [('IBM', False), ('MSFT', True)]:
+            cg = pq.ContractGroup.get(symbol)
+            pq.Contract.create(symbol, cg)
+            strategy = pq.Strategy(timestamps, [cg], get_price, trade_lag=1, log_trades=False)
+            strategy.add_signal('entry_sig', lambda cg, ts, ind, sig, ctx: np.arange(len(ts)) == 1)
+            strategy.add_rule('entry_rule', entry_rule, signal_name='entry_sig')
+            strategy.add_market_sim(market_sim)
+            if use_trigger_prices: strategy.set_trigger_price_function(lambda contract, context: prices)
+            portfolio.add_strategy(symbol, strategy)
+        portfolio.run_indicators()
+        portfolio.run_signals()
+        portfolio.run_rules(end_date=timestamps[3], max_processes=max_processes)
+        for name in ['IBM', 'MSFT']:
+            strategy = portfolio.strategies[name]
+            assert len(strategy.trades()) == 0 and len(strategy._current_orders) == 1
+        assert len(portfolio.strategies['MSFT']._resting_orders) == 1
+        portfolio.run_rules(start_date=timestamps[4], max_processes=max_processes)
+        return portfolio
+    
+    serial = run(1)
+    parallel = run(2)
+    for name in ['IBM', 'MSFT']:
+        trades = parallel.strategies[name].trades()
+        assert len(trades) == 1 and trades[0].timestamp == timestamps[6] and trades[0].price == 94.
+        pd.testing.assert_frame_equal(serial.strategies[name].df_trades(), parallel.strategies[name].df_trades())
+        pd.testing.assert_frame_equal(serial.strategies[name].df_orders(), parallel.strategies[name].df_orders())
+    pd.testing.assert_frame_equal(serial.df_returns(), parallel.df_returns())
+    
+    
+def _momentum_strategy_factory(num_backtests: list[int] | None = None) -> tuple[np.ndarray, np.ndarray, Callable[[dict], pq.Strategy]]:
+    '''
+    Returns dates, timestamps and a function that builds a momentum strategy on one contract, with the lookback in params.
+    If num_backtests is set, we append to it each time a strategy is built
+    '''
+    dates = np.arange(np.datetime64('2018-01-01'), np.datetime64('2018-12-31'))
+    dates = dates[np.is_busday(dates)]
+    timestamps = dates + np.timedelta64(10, 'h')
+    prices = 100 + 10 * np.sin(np.arange(len(timestamps)) * 2 * np.pi / 40) + 0.05 * np.arange(len(timestamps))
+    
+    def momentum(contract_group: pq.ContractGroup,
+                 timestamps: np.ndarray,
+                 indicators: SimpleNamespace, 
+                 strategy_context: pq.StrategyContextType) -> np.ndarray: 
+        lookback = strategy_context.lookback
+        return np.concatenate([np.full(lookback, 0.), indicators.price[lookback:] - indicators.price[:-lookback]])
+    
+    def trade_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract(contract_group.name)
+        position = account.position(contract_group, timestamps[i])
+        qty = 100 - position if indicators.momentum[i] > 0 else -position
+        if math.isclose(qty, 0): return []
+        return [pq.MarketOrder(contract=contract, timestamp=timestamps[i], qty=qty, reason_code='ENTER')]  # type: ignore
+    
+    def get_price(contract: pq.Contract, timestamps: np.ndarray, i: int, strategy_context: pq.StrategyContextType) -> float:
+        return prices[i]
+    
+    def strategy_factory(params: dict) -> pq.Strategy:
+        if num_backtests is not None: num_backtests.append(1)
+        cg = pq.ContractGroup.get('IBM')
+        pq.Contract.get_or_create('IBM', cg)
+        strategy = pq.Strategy(timestamps, [cg], get_price, starting_equity=1e5, trade_lag=1, log_trades=False, 
+                               strategy_context=SimpleNamespace(lookback=params['lookback']))
+        strategy.add_indicator('price', pq.VectorIndicator(prices))
+        strategy.add_indicator('momentum', momentum, depends_on=['price'])
+        # Run the rule on every bar so it can exit when momentum turns
+        strategy.add_signal('always', lambda cg, ts, ind, sig, ctx: np.full(len(ts), True))
+        strategy.add_rule('trade_rule', trade_rule, signal_name='always')
+        strategy.add_market_sim(pq.SimpleMarketSimulator(get_price))
+        return strategy
+    return dates, timestamps, strategy_factory
+    
+
+def test_walk_forward() -> None:
+    '''Test that walk forward picks parameters for each fold and stitches out of sample returns from test windows'''
+    dates, timestamps, strategy_factory = _momentum_strategy_factory()
+    pq.ContractGroup.clear_cache()
+    pq.Contract.clear_cache()
+    windows = pq.rolling_windows(dates[0], dates[-1], np.timedelta64(120, 'D'), np.timedelta64(60, 'D'))
+    results = []
+    for max_processes in [1, 2]:
+        walk_forward = pq.WalkForward('test', strategy_factory, lambda: ({'lookback': lookback} for lookback in [2, 5, 10, 20]), 
+                                      windows, max_processes=max_processes)
+        walk_forward.run(raise_on_error=True)
+        assert len(walk_forward.optimizer.experiments) == 4 * len(windows)  # type: ignore
+        df_folds = walk_forward.df_folds()
+        assert len(df_folds) == len(windows) and df_folds.test_cost.notnull().all()
+        df_returns = walk_forward.df_returns()
+        assert df_returns.timestamp.is_monotonic_increasing and (df_returns.timestamp.values >= windows[0][2]).all()
+        assert list(df_returns.fold.unique()) == list(range(len(windows)))
+        results.append((df_folds, df_returns))
+    pd.testing.assert_frame_equal(results[0][0], results[1][0])
+    pd.testing.assert_frame_equal(results[0][1], results[1][1])
+    
+
+def test_purged_cv() -> None:
+    '''Test that combinatorial purged cross validation picks parameters for each split and builds out of sample paths'''
+    num_backtests: list[int] = []
+    dates, timestamps, strategy_factory = _momentum_strategy_factory(num_backtests)
+    pq.ContractGroup.clear_cache()
+    pq.Contract.clear_cache()
+    results = []
+    for max_processes in [1, 2]:
+        cv = pq.PurgedCrossValidation('test', strategy_factory, ({'lookback': lookback} for lookback in [2, 5, 10, 20]), timestamps,
+                                      num_groups=6, num_test_groups=2, purge=5, embargo=5, max_processes=max_processes)
+        cv.run(raise_on_error=True)
+        assert len(cv.optimizer.experiments) == 4  # type: ignore
+        # Each parameter set is backtested once, and only aggregate train costs are stored in the experiments
+        if max_processes == 1: assert len(num_backtests) == 4
+        assert all([list(experiment.other_costs.keys()) == ['train_cost_std'] for experiment in cv.optimizer.experiments])  # type: ignore
+        df_splits = cv.df_splits()
+        assert len(df_splits) == 15 and df_splits.test_cost.notnull().all()
+        assert (df_splits.train_dates + df_splits.test_dates < len(dates)).all()
+        df_path_returns = cv.df_path_returns()
+        # Each of the 5 paths covers every date once
+        assert len(df_path_returns) == 5 * len(dates)
+        assert (df_path_returns.groupby('path').timestamp.nunique() == len(dates)).all()
+        df_paths = cv.df_paths()
+        assert len(df_paths) == 5 and df_paths.cost.notnull().all()
+        df_summary = cv.df_summary()
+        assert list(df_summary.over.unique()) == ['paths', 'splits'] and df_summary['max'].ge(df_summary['min']).all()
+        results.append((df_splits, df_paths))
+    pd.testing.assert_frame_equal(results[0][0], results[1][0])
+    pd.testing.assert_frame_equal(results[0][1], results[1][1])
+    
+
+def test_strategy_template() -> None:
+    '''Test that strategies built from a template share indicator values with it and give the same results as strategies built without one'''
+    timestamps = np.arange(np.datetime64('2018-01-02T10:00'), np.datetime64('2018-01-02T10:00') + np.timedelta64(60, 'm'))
+    prices = 100 + 5 * np.sin(np.arange(len(timestamps)) / 4)
+    df = pd.DataFrame({'timestamp': timestamps, 'price': prices})
+    num_calls = [0]
+    
+    def moving_average(contract_group: pq.ContractGroup,
+                       timestamps: np.ndarray,
+                       indicators: SimpleNamespace, 
+                       strategy_context: pq.StrategyContextType) -> np.ndarray: 
+        num_calls[0] += 1
+        return pd.Series(indicators.price).rolling(5, min_periods=1).mean().values
+    
+    def above_signal(contract_group: pq.ContractGroup,
+                     timestamps: np.ndarray,
+                     indicators: SimpleNamespace, 
+                     parent_signals: SimpleNamespace,
+                     strategy_context: pq.StrategyContextType) -> np.ndarray: 
+        return indicators.price > indicators.ma + strategy_context.threshold
+    
+    def trade_rule(contract_group: pq.ContractGroup,
+                   i: int,
+                   timestamps: np.ndarray,
+                   indicators: SimpleNamespace,
+                   signal: np.ndarray,
+                   account: pq.Account,
+                   orders: Sequence[pq.Order],
+                   strategy_context: pq.StrategyContextType) -> list[pq.Order]:
+        contract = contract_group.get_contract('IBM')
+        return [pq.MarketOrder(contract=contract, timestamp=timestamps[i], qty=10, reason_code='ENTER')]  # type: ignore
+    
+    pq.ContractGroup.clear_cache()
+    pq.Contract.clear_cache()
+    price_function = pq.PriceFuncArrays(np.full(len(timestamps), 'IBM'), timestamps, prices)
+    
+    def make_builder(threshold: float) -> pq.StrategyBuilder:
+        builder = pq.StrategyBuilder(df)
+        cg = pq.ContractGroup.get('IBM')
+        pq.Contract.get_or_create('IBM', cg)
+        builder.add_contract_group(cg)
+        builder.set_price_function(price_function)
+        builder.set_trade_lag(0)
+        builder.set_log_trades(False)
+        builder.set_strategy_context(SimpleNamespace(threshold=threshold))
+        builder.add_series_indicator('price', 'price')
+        builder.add_indicator('ma', moving_average, depends_on=['price'])
+        builder.add_signal('above', above_signal, depends_on_indicators=['price', 'ma'])
+        builder.add_rule('trade_rule', trade_rule, 'above')
+        return builder
+    
+    template = make_builder(0.)().clone()
+    template.run_indicators()
+    assert len(template.rules) == 0 and num_calls[0] == 1
+    template = make_builder(0.).build_template()
+    assert num_calls[0] == 2 and not template.indicator_values['IBM'].ma.flags.writeable
+    for threshold in [0., 0.5, 1.]:
+        expected = make_builder(threshold)()
+        expected.run()
+        strategy = make_builder(threshold)(template)
+        strategy.run()
+        assert strategy.indicator_values['IBM'].ma is template.indicator_values['IBM'].ma
+        assert len(strategy.trades()) > 0
+        pd.testing.assert_frame_equal(strategy.df_pnl(), expected.df_pnl())
+    assert num_calls[0] == 5  # each strategy built without the template computes the moving average again
+
+    # Strategies use the price function of the builder, not the one the template was built with
+    builder = make_builder(0.)
+    builder.set_price_function(pq.PriceFuncArrays(np.full(len(timestamps), 'IBM'), timestamps, prices * 2))
+    assert builder(template).price_function is builder.price_function
+
+    # An indicator with the same name as one in the template but a different definition is an error
+    builder = make_builder(0.)
+    builder.indicators[1] = ('ma', lambda cg, ts, ind, ctx: ind.price, None, ['price'])
+    try:
+        builder(template)
+        assert False, 'expected an exception'
+    except pq.PQException:
+        pass
+
+    # Indicator arrays in shared memory are attached to, not copied, when the template is sent to another process
+    builder = make_builder(0.5)
+    builder.indicators = [indicator for indicator in builder.indicators if indicator[0] == 'price']
+    with pq.SharedDataStore() as store:
+        template = builder.build_template(shared_data=store)
+        assert store.names() == ['template.IBM.price']
+        worker_template = pickle.loads(pickle.dumps(template))
+        assert isinstance(worker_template.indicator_values['IBM'].price, pq.SharedArray)
+        strategy = make_builder(0.5)(worker_template)
+        strategy.run()
+        expected = make_builder(0.5)()
+        expected.run()
+        pd.testing.assert_frame_equal(strategy.df_pnl(), expected.df_pnl())
+        
+        
 if __name__ == '__main__':
     test_strategy()
     test_strategy_2()
+    test_resting_orders()
+    test_price_func_cache()
+    test_portfolio_multi_process()
+    test_portfolio_rules_in_segments()
+    test_walk_forward()
+    test_strategy_template()
+    test_purged_cv()
 # $$_end_code
 # $$_markdown
 # # 
@@ -0,0 +1,102 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import os
+import threadpoolctl
+from dataclasses import dataclass
+from pyqstrat.pq_utils import get_child_logger, assert_
+
+_logger = get_child_logger(__name__)
+
+# Environment variables read by OpenMP, OpenBLAS, MKL, Apple Accelerate and numexpr when they start their thread pools
+THREAD_LIMIT_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def available_cores() -> int:
+    '''Number of cores this process is allowed to run on, which may be less than the number of cores on the machine'''
+    if hasattr(os, 'sched_getaffinity'): return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def limit_threads(num_threads: int) -> None:
+    '''
+    Limit the number of threads that BLAS and OpenMP libraries, for example the ones numpy, scipy and statsmodels use,
+    start in this process.  Call this in a worker process before it does any work.
+
+    Libraries that are already loaded, which includes the BLAS library used by numpy once pyqstrat is imported, and 
+    is always the case in a forked worker, are limited using threadpoolctl.  We also set environment variables that 
+    libraries which are loaded later read when they start.
+
+    Args:
+        num_threads: Maximum number of threads each library can use
+    '''
+    assert_(num_threads > 0, f'num_threads must be positive: {num_threads}')
+    for var in THREAD_LIMIT_ENV_VARS: os.environ[var] = str(num_threads)
+    threadpoolctl.threadpool_limits(limits=num_threads)
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    '''
+    Splits cores between worker processes and threads within each worker, so that running several processes that each use
+    multi-threaded libraries like BLAS does not start more threads than there are cores.  The Optimizer, WalkForward and
+    Portfolio use this to decide how many worker processes to start and limit the threads each of them uses.
+
+    Args:
+        num_cores: Number of cores to use.  Default is the number of cores this process is allowed to run on
+        threads_per_process: Threads that each worker process can use.  If not set, cores are split evenly between
+            worker processes.  Set this when the work in each process is itself parallel, for example large matrix operations,
+            to run fewer processes with more threads each.  Default None
+
+    >>> ThreadBudget(num_cores=64).split()
+    (64, 1)
+    >>> ThreadBudget(num_cores=64).split(max_processes=4)
+    (4, 16)
+    >>> ThreadBudget(num_cores=64).split(num_tasks=6)
+    (6, 10)
+    >>> ThreadBudget(num_cores=64, threads_per_process=4).split()
+    (16, 4)
+    '''
+    num_cores: int | None = None
+    threads_per_process: int | None = None
+
+    def __post_init__(self) -> None:
+        assert_(self.num_cores is None or self.num_cores > 0, f'num_cores must be positive: {self.num_cores}')
+        assert_(self.threads_per_process is None or self.threads_per_process > 0,
+                f'threads_per_process must be positive: {self.threads_per_process}')
+
+    def split(self, max_processes: int | None = None, num_tasks: int | None = None) -> tuple[int, int]:
+        '''
+        Returns the number of worker processes to start and the number of threads each one can use
+
+        Args:
+            max_processes: Maximum number of worker processes.  If not set, we start as many as the cores allow
+            num_tasks: If set, we don't start more processes than there are tasks to run, so each process can use more threads
+        '''
+        num_cores = self.num_cores or available_cores()
+        if max_processes is None: max_processes = max(1, num_cores // (self.threads_per_process or 1))
+        num_processes = max_processes if num_tasks is None else max(1, min(max_processes, num_tasks))
+        num_threads = self.threads_per_process or max(1, num_cores // num_processes)
+        return num_processes, num_threads
+
+
+# Functions used in unit testing
+def _get_thread_limit() -> int:
+    '''Largest number of threads any BLAS or OpenMP library loaded in this process can use'''
+    return max([info['num_threads'] for info in threadpoolctl.threadpool_info()])
+
+
+def test_thread_budget() -> None:
+    import numpy  # noqa: F401  load BLAS in the parent so forked workers inherit a thread pool that was already started
+    from pyqstrat.worker_pool import WorkerPool
+    for threads in [1, 3]:
+        with WorkerPool(2, threads_per_worker=threads) as pool:
+            assert_([pool.submit(_get_thread_limit).result() for _ in range(4)] == [threads] * 4)
+
+
+if __name__ == "__main__":
+    test_thread_budget()
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -0,0 +1,287 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import sys
+import concurrent
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+from collections.abc import Sequence
+from pyqstrat.pq_utils import get_child_logger, assert_
+from pyqstrat.strategy import Strategy
+from pyqstrat.evaluator import compute_amean, compute_sharpe
+from pyqstrat.shared_data import SharedDataStore
+from pyqstrat.thread_budget import ThreadBudget
+from pyqstrat.optimize import Optimizer, suggestion_key, _init_worker as _init_optimizer_worker
+
+_logger = get_child_logger(__name__)
+
+# train start, train end, test start, test end.  Rules are run from start to end inclusive
+WindowType = tuple[np.datetime64, np.datetime64, np.datetime64, np.datetime64]
+
+# Takes a strategy that has been run, and the start and end of the window it was run over, and returns cost, other costs
+WindowCostType = Callable[[Strategy, np.datetime64, np.datetime64], tuple[float, dict[str, float]]]
+
+
+def rolling_windows(start_date: np.datetime64,
+                    end_date: np.datetime64,
+                    train_period: np.timedelta64,
+                    test_period: np.timedelta64,
+                    anchored: bool = False) -> list[WindowType]:
+    '''
+    Returns consecutive train / test windows where each test window follows its train window and test windows do not overlap
+
+    Args:
+        start_date: Start of the first train window
+        end_date: No window ends after this date.  The last test window is shortened if needed
+        train_period: Length of each train window
+        test_period: Length of each test window.  Windows move forward by this much
+        anchored: If set, all train windows start at start_date and get longer, instead of moving forward.  Default False
+
+    >>> for window in rolling_windows(np.datetime64('2023-01-01'), np.datetime64('2023-05-15'), np.timedelta64(60, 'D'), np.timedelta64(30, 'D')):
+    ...     print([str(date) for date in window])
+    ['2023-01-01', '2023-03-01', '2023-03-02', '2023-03-31']
+    ['2023-01-31', '2023-03-31', '2023-04-01', '2023-04-30']
+    ['2023-03-02', '2023-04-30', '2023-05-01', '2023-05-15']
+    '''
+    one = np.timedelta64(1, np.datetime_data(start_date.dtype)[0])
+    windows: list[WindowType] = []
+    test_start = start_date + train_period
+    while test_start <= end_date:
+        train_start = start_date if anchored else test_start - train_period
+        test_end = min(test_start + test_period - one, end_date)
+        windows.append((train_start, test_start - one, test_start, test_end))
+        test_start += test_period
+    return windows
+
+
+def window_returns(strategy: Strategy, start_date: np.datetime64, end_date: np.datetime64) -> pd.DataFrame:
+    '''Returns daily returns of a strategy between start_date and end_date inclusive.  See Strategy.df_returns'''
+    df = strategy.df_returns()
+    dates = df.timestamp.values.astype('M8[D]')
+    mask = (dates >= start_date.astype('M8[D]')) & (dates <= end_date.astype('M8[D]'))
+    return df[mask].reset_index(drop=True)
+
+
+def returns_sharpe_cost(returns: np.ndarray) -> tuple[float, dict[str, float]]:
+    '''
+    Returns negative sharpe ratio of daily returns, and sharpe and total return as other costs
+    
+    >>> cost, other_costs = returns_sharpe_cost(np.array([0.01, -0.005, 0.002, 0.004]))
+    >>> print(round(cost, 2), round(other_costs['return'], 4))
+    -8.15 0.011
+    '''
+    sharpe = compute_sharpe(returns, compute_amean(returns, 252), 252)
+    if not np.isfinite(sharpe): sharpe = 0.
+    return -sharpe, {'sharpe': sharpe, 'return': float(np.prod(1 + returns) - 1)}
+
+
+def sharpe_cost(strategy: Strategy, start_date: np.datetime64, end_date: np.datetime64) -> tuple[float, dict[str, float]]:
+    '''
+    Default cost function for WalkForward.  Returns negative sharpe ratio of daily returns in the window,
+    and sharpe and total return as other costs
+    '''
+    return returns_sharpe_cost(window_returns(strategy, start_date, end_date).ret.values)
+
+
+@dataclass
+class _FoldRunner:
+    '''Runs a strategy with a set of parameters over the train or test window of a fold'''
+    strategy_factory: Callable[[dict[str, Any]], Strategy]
+    cost_func: WindowCostType
+    windows: Sequence[WindowType]
+
+    def _run(self, params: dict[str, Any], start_date: np.datetime64, end_date: np.datetime64) -> Strategy:
+        strategy = self.strategy_factory(params)
+        strategy.run_indicators()
+        strategy.run_signals()
+        strategy.run_rules(start_date=start_date, end_date=end_date)
+        return strategy
+
+    def __call__(self, suggestion: dict[str, Any]) -> tuple[float, dict[str, float]]:
+        '''Cost function for the Optimizer.  The suggestion contains the fold number as well as parameters'''
+        params = dict(suggestion)
+        train_start, train_end, _, _ = self.windows[params.pop('fold')]
+        strategy = self._run(params, train_start, train_end)
+        return self.cost_func(strategy, train_start, train_end)
+
+    def test(self, fold: int, params: dict[str, Any]) -> tuple[float, dict[str, float], pd.DataFrame, float]:
+        '''Returns cost, other costs, returns and starting equity over the test window'''
+        _, _, test_start, test_end = self.windows[fold]
+        strategy = self._run(params, test_start, test_end)
+        cost, other_costs = self.cost_func(strategy, test_start, test_end)
+        return cost, other_costs, window_returns(strategy, test_start, test_end), strategy.account.starting_equity
+
+
+# Set in each worker process that runs test windows
+_worker_fold_runner: _FoldRunner | None = None
+
+
+def _init_worker(fold_runner: _FoldRunner, shared_data: SharedDataStore | None) -> None:
+    global _worker_fold_runner
+    _worker_fold_runner = fold_runner
+    # So cost functions and strategy factories can call get_shared_data
+    _init_optimizer_worker(fold_runner, shared_data)
+
+
+def _run_test_fold(fold: int, params: dict[str, Any]) -> tuple[float, dict[str, float], pd.DataFrame, float]:
+    assert _worker_fold_runner is not None
+    return _worker_fold_runner.test(fold, params)
+
+
+class WalkForward:
+    '''
+    Walk forward optimization.  For each fold, finds the parameters with the lowest cost over the train window,
+    and then runs the strategy with those parameters over the test window.  Out of sample returns from test windows are
+    stitched together so you can evaluate them as one equity curve.
+
+    Train windows for all folds are optimized at the same time by a single Optimizer, so all processes are kept busy
+    even if each fold has only a few suggestions.  Test windows are then run in parallel as well.
+    '''
+    def __init__(self,
+                 name: str,
+                 strategy_factory: Callable[[dict[str, Any]], Strategy],
+                 generator_factory: Callable[[], Iterable[dict[str, Any]]],
+                 windows: Sequence[WindowType],
+                 cost_func: WindowCostType = sharpe_cost,
+                 max_processes: int | None = None,
+                 mp_start_method: str | None = None,
+                 shared_data: SharedDataStore | None = None,
+                 journal: str | None = None,
+                 executor_factory: Callable[..., concurrent.futures.Executor] | None = None,
+                 thread_budget: ThreadBudget | None = None) -> None:
+        '''
+        Args:
+            name: Display title for plotting, etc.
+            strategy_factory: A function that takes a dictionary of parameter name -> value and returns a Strategy
+                with indicators, signals and rules added, that has not been run yet
+            generator_factory: A function that returns a new generator of parameter dictionaries.  It is called once for each fold
+            windows: List of (train start, train end, test start, test end).  See rolling_windows
+            cost_func: A function that takes a strategy that has been run, start and end of the window it was run over
+                and returns cost and a dictionary of other costs.  Default sharpe_cost
+            max_processes: Number of processes to use.  If not set, the number of CPU cores on your machine is used
+            mp_start_method: See Optimizer
+            shared_data: See Optimizer
+            journal: See Optimizer.  Lets you resume a walk forward run that stopped during optimization of train windows
+            executor_factory: See Optimizer
+            thread_budget: See Optimizer
+        '''
+        assert_(len(windows) > 0, 'no windows')
+        for window in windows:
+            assert_(bool(window[0] <= window[1] < window[2] <= window[3]), f'invalid window: {window}')
+        self.name = name
+        self.generator_factory = generator_factory
+        self.windows = windows
+        self.max_processes = max_processes
+        self.mp_start_method = mp_start_method
+        self.shared_data = shared_data
+        self.journal = journal
+        self.executor_factory = executor_factory
+        self.thread_budget = thread_budget
+        self._fold_runner = _FoldRunner(strategy_factory, cost_func, windows)
+        self.optimizer: Optimizer | None = None
+        self.best_params: list[dict[str, Any] | None] = []
+        self._test_results: dict[int, tuple[float, dict[str, float], pd.DataFrame, float]] = {}
+
+    def _train_suggestions(self) -> Iterable[dict[str, Any]]:
+        for fold in range(len(self.windows)):
+            for params in self.generator_factory():
+                assert_('fold' not in params, 'fold cannot be used as a parameter name')
+                yield {'fold': fold, **params}
+
+    def _find_best_params(self) -> list[dict[str, Any] | None]:
+        assert self.optimizer is not None
+        best: list[Any] = [None] * len(self.windows)
+        for experiment in self.optimizer.experiments:
+            if not np.isfinite(experiment.cost): continue
+            fold = experiment.suggestion['fold']
+            # Break ties by suggestion so the result does not depend on the order in which experiments completed
+            if best[fold] is None or (experiment.cost, suggestion_key(experiment.suggestion)) < (best[fold].cost, suggestion_key(best[fold].suggestion)):
+                best[fold] = experiment
+        return [None if experiment is None else {k: v for k, v in experiment.suggestion.items() if k != 'fold'} for experiment in best]
+
+    def run(self, raise_on_error: bool = False) -> None:
+        '''
+        Optimize parameters over train windows and then run test windows with the best parameters
+
+        Args:
+            raise_on_error: If set, exceptions in any fold stop the run instead of being printed.  Default False
+        '''
+        self.optimizer = Optimizer(self.name, self._train_suggestions(), self._fold_runner,  # type: ignore
+                                   max_processes=self.max_processes, journal=self.journal,
+                                   shared_data=self.shared_data, mp_start_method=self.mp_start_method,
+                                   executor_factory=self.executor_factory, thread_budget=self.thread_budget)
+        self.optimizer.run(raise_on_error)
+        self.best_params = self._find_best_params()
+        fold_params = {fold: params for fold, params in enumerate(self.best_params) if params is not None}
+        for fold, params in enumerate(self.best_params):
+            if params is None: _logger.warning(f'no valid experiments for fold: {fold}, skipping test window')
+        self._test_results = {}
+
+        def add_result(fold: int, get_result: Callable[[], tuple[float, dict[str, float], pd.DataFrame, float]]) -> None:
+            try:
+                self._test_results[fold] = get_result()
+            except Exception as e:
+                new_exc = type(e)(f'Exception: {str(e)} in test window for fold: {fold}').with_traceback(sys.exc_info()[2])
+                if raise_on_error: raise new_exc
+                else: print(str(new_exc))
+
+        if self.optimizer._single_process():
+            for fold, params in fold_params.items():
+                add_result(fold, lambda: self._fold_runner.test(fold, params))
+            return
+
+        with self.optimizer._executor(_init_worker, (self._fold_runner, self.shared_data), num_tasks=len(fold_params)) as executor:
+            fut_map = {executor.submit(_run_test_fold, fold, params): fold for fold, params in fold_params.items()}
+            for future in concurrent.futures.as_completed(fut_map):
+                add_result(fut_map[future], future.result)
+
+    def df_folds(self) -> pd.DataFrame:
+        '''
+        Returns a dataframe with a row for each fold, containing its window, best parameters,
+        cost and other costs over the train window and cost and other costs over the test window
+        '''
+        assert_(self.optimizer is not None, 'run must be called first')
+        assert self.optimizer is not None
+        train = {suggestion_key(experiment.suggestion): experiment for experiment in self.optimizer.experiments}
+        records = []
+        for fold, (train_start, train_end, test_start, test_end) in enumerate(self.windows):
+            record: dict[str, Any] = {'fold': fold, 'train_start': train_start, 'train_end': train_end,
+                                      'test_start': test_start, 'test_end': test_end}
+            params = self.best_params[fold]
+            if params is not None:
+                record.update(params)
+                experiment = train[suggestion_key({'fold': fold, **params})]
+                record['train_cost'] = experiment.cost
+                record.update({f'train_{k}': v for k, v in experiment.other_costs.items()})
+            if fold in self._test_results:
+                cost, other_costs, _, _ = self._test_results[fold]
+                record['test_cost'] = cost
+                record.update({f'test_{k}': v for k, v in other_costs.items()})
+            records.append(record)
+        return pd.DataFrame.from_records(records)
+
+    def df_returns(self) -> pd.DataFrame:
+        '''
+        Returns out of sample daily returns from all test windows, in order, with columns timestamp, fold, ret and equity.
+        Equity is compounded from the starting equity of the strategy
+        '''
+        assert_(len(self._test_results) > 0, 'no test windows were run')
+        dfs = []
+        for fold in sorted(self._test_results.keys()):
+            df = self._test_results[fold][2][['timestamp', 'ret']].copy()
+            df.insert(1, 'fold', fold)
+            dfs.append(df)
+        df = pd.concat(dfs).reset_index(drop=True)
+        starting_equity = self._test_results[min(self._test_results.keys())][3]
+        df['equity'] = starting_equity * np.cumprod(1 + np.nan_to_num(df.ret.values))
+        return df
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code
@@ -0,0 +1,406 @@
+# $$_ Lines starting with # $$_* autogenerated by jup_mini. Do not modify these
+# $$_code
+# $$_ %%checkall
+from __future__ import annotations
+import os
+import sys
+import math
+import time
+import signal
+import threading
+import collections
+import concurrent.futures
+import multiprocessing as mp
+from dataclasses import dataclass
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Any, Callable
+from pyqstrat.pq_utils import get_child_logger, assert_, PQException
+from pyqstrat.thread_budget import limit_threads
+
+_logger = get_child_logger(__name__)
+
+
+class LimitExceededError(PQException):
+    '''
+    A task ran longer or used more memory than the limits set for a WorkerPool.  The worker process running it was terminated.
+
+    Args:
+        message: What limit was exceeded
+        seconds: How long the task ran before it was terminated
+        pid: Process id of the worker that was terminated
+        rss_mb: Resident memory of the worker in MB when it was terminated, or nan if we could not get it
+    '''
+    def __init__(self, message: str, seconds: float = math.nan, pid: int = 0, rss_mb: float = math.nan) -> None:
+        super().__init__(message)
+        self.seconds = seconds
+        self.pid = pid
+        self.rss_mb = rss_mb
+
+    def __reduce__(self) -> Any:
+        return (LimitExceededError, (str(self), self.seconds, self.pid, self.rss_mb))
+
+
+def memory_limit_supported() -> bool:
+    '''Returns True if we can get the memory used by a worker process on this platform, so WorkerPool can enforce max_memory_mb'''
+    return os.path.exists('/proc/self/statm')
+
+
+def _rss_mb(pid: int) -> float:
+    '''Current resident memory of a process in MB, or nan if we cannot get it'''
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return math.nan
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+@dataclass
+class _PoolTask:
+    fn: Callable
+    args: tuple
+    kwargs: dict[str, Any]
+    future: concurrent.futures.Future
+
+
+def _worker_main(conn: Connection, initializer: Callable | None, initargs: tuple, threads_per_worker: int | None) -> None:
+    if threads_per_worker is not None: limit_threads(threads_per_worker)
+    if initializer is not None: initializer(*initargs)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None: return
+        fn, args, kwargs = message
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except (EOFError, OSError):
+            return
+        except Exception as e:
+            # Results or exceptions that cannot be pickled
+            conn.send((False, PQException(f'could not send result of {fn}: {e}')))
+
+
+def _zygote_main(conn: Connection, initializer: Callable | None, initargs: tuple, threads_per_worker: int | None) -> None:
+    '''
+    Forks a worker each time it receives a request and sends back its process id and the pool's end of its connection.
+    With the fork start method, workers that replace terminated ones are forked from this process, which is started before
+    the pool starts any threads and never starts any itself.  Forking the pool process itself while its threads are running 
+    can deadlock the child, if another thread holds a lock, for example the one for stdout, when we fork.
+    '''
+    # Workers we fork are reaped automatically when they exit
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None: return
+        pool_conn, worker_conn = mp.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            conn.close()
+            pool_conn.close()
+            exit_code = 0
+            try:
+                _worker_main(worker_conn, initializer, initargs, threads_per_worker)
+            except BaseException:
+                exit_code = 1
+            finally:
+                # Don't run exit handlers inherited from the zygote
+                os._exit(exit_code)
+        worker_conn.close()
+        conn.send(pid)
+        reduction.send_handle(conn, pool_conn.fileno(), pid)
+        pool_conn.close()
+
+
+class _ForkedProcess:
+    '''
+    A worker process forked by the zygote.  Since it is not a child of the pool process, we check whether it is alive 
+    using its process id instead of waiting for it to exit
+    '''
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.exitcode = None
+        
+    def is_alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+    
+    def kill(self) -> None:
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        
+    def join(self, timeout: float | None = None) -> None:
+        deadline = math.inf if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and time.monotonic() < deadline: time.sleep(0.01)
+
+
+class WorkerPool(concurrent.futures.Executor):
+    '''
+    A pool of worker processes, like concurrent.futures.ProcessPoolExecutor, that can also limit how long each task runs
+    and how much memory its worker uses.  A task that exceeds a limit fails with LimitExceededError, and its worker process
+    is terminated and replaced by a new one, so the pool keeps running and memory used by the task is returned to the OS.
+    terminate stops tasks that are running right away instead of waiting for them.
+
+    Args:
+        max_workers: Number of worker processes.  Default is the number of cores on this machine
+        mp_context: Multiprocessing context used to start workers.  Default is the default multiprocessing context
+        initializer: If set, called with initargs in each worker when it starts, including workers that replace terminated ones
+        initargs: Arguments for initializer
+        timeout_seconds: If set, a task that runs for longer than this many seconds is terminated.  Default None
+        max_memory_mb: If set, a task is terminated if the resident memory of its worker goes above this many MB.
+            Only supported on platforms where memory_limit_supported returns True, such as Linux.  Default None
+        poll_interval: Seconds between checks of the limits.  Default 0.1
+        threads_per_worker: If set, each worker limits the threads that BLAS and OpenMP libraries use to this many.
+            See limit_threads and ThreadBudget.  Default None
+
+    >>> with WorkerPool(2) as pool:
+    ...     print(list(pool.map(pow, [2, 3, 4], [2, 2, 2])))
+    [4, 9, 16]
+    >>> with WorkerPool(1, timeout_seconds=0.5) as pool:
+    ...     future = pool.submit(time.sleep, 30)
+    ...     print(type(future.exception()).__name__, pool.submit(pow, 2, 3).result())
+    LimitExceededError 8
+    '''
+    def __init__(self,
+                 max_workers: int | None = None,
+                 mp_context: Any = None,
+                 initializer: Callable | None = None,
+                 initargs: tuple = (),
+                 timeout_seconds: float | None = None,
+                 max_memory_mb: float | None = None,
+                 poll_interval: float = 0.1,
+                 threads_per_worker: int | None = None) -> None:
+        if max_workers is None: max_workers = os.cpu_count() or 1
+        assert_(max_workers > 0, f'max_workers must be positive: {max_workers}')
+        assert_(timeout_seconds is None or timeout_seconds > 0, f'timeout_seconds must be positive: {timeout_seconds}')
+        assert_(max_memory_mb is None or memory_limit_supported(), f'max_memory_mb is not supported on {sys.platform}')
+        self.max_workers = max_workers
+        self._context = mp_context if mp_context is not None else mp.get_context()
+        self._initializer = initializer
+        self._initargs = initargs
+        self.timeout_seconds = timeout_seconds
+        self.max_memory_mb = max_memory_mb
+        self.poll_interval = poll_interval
+        self.threads_per_worker = threads_per_worker
+        self._condition = threading.Condition()
+        self._queue: collections.deque[_PoolTask] = collections.deque()
+        self._shutdown = False
+        self._terminated = False
+        # Start workers before we start any threads, since forking a process with threads is not safe.
+        # With fork, workers that replace terminated ones are forked by a zygote process we start now, see _zygote_main
+        self._zygote_lock = threading.Lock()
+        self._zygote: tuple[Any, Connection] | None = None
+        if self._context.get_start_method() == 'fork':
+            zygote_conn, conn = self._context.Pipe()
+            zygote = self._context.Process(target=_zygote_main, args=(conn, initializer, initargs, threads_per_worker), daemon=True)
+            zygote.start()
+            conn.close()
+            self._zygote = (zygote, zygote_conn)
+        workers = [self._start_worker() for _ in range(max_workers)]
+        self._threads = [threading.Thread(target=self._serve, args=(worker,), daemon=True) for worker in workers]
+        for thread in self._threads: thread.start()
+
+    def _start_worker(self) -> tuple[Any, Connection]:
+        conn, worker_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, 
+                                        args=(worker_conn, self._initializer, self._initargs, self.threads_per_worker), 
+                                        daemon=True)
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def _replace_worker(self) -> tuple[Any, Connection]:
+        '''Start a worker to replace one that was terminated, from a thread that serves tasks'''
+        if self._zygote is None: return self._start_worker()
+        zygote, zygote_conn = self._zygote
+        with self._zygote_lock:
+            zygote_conn.send(True)
+            pid = zygote_conn.recv()
+            fd = reduction.recv_handle(zygote_conn)
+        return _ForkedProcess(pid), Connection(fd)
+    
+    def _stop_zygote(self) -> None:
+        if self._zygote is None: return
+        zygote, zygote_conn = self._zygote
+        with self._zygote_lock:
+            try:
+                zygote_conn.send(None)
+            except (EOFError, OSError):
+                pass
+            zygote.join(timeout=1)
+            if zygote.is_alive(): zygote.kill()
+            zygote_conn.close()
+            self._zygote = None
+
+    def _next_task(self) -> _PoolTask | None:
+        '''Wait for a task to run.  Returns None when the pool shuts down and there are no more tasks'''
+        with self._condition:
+            while True:
+                if self._terminated: return None
+                while len(self._queue):
+                    task = self._queue.popleft()
+                    if task.future.set_running_or_notify_cancel(): return task
+                if self._shutdown: return None
+                self._condition.wait()
+
+    def _limit_exceeded(self, pid: int, seconds: float) -> str:
+        '''Returns a description of the limit this worker exceeded, or an empty string if it is within limits'''
+        if self.timeout_seconds is not None and seconds > self.timeout_seconds:
+            return f'timeout: ran for more than {self.timeout_seconds} seconds'
+        if self.max_memory_mb is not None and _rss_mb(pid) > self.max_memory_mb:
+            return f'memory: used more than {self.max_memory_mb} MB'
+        return ''
+
+    def _run_task(self, task: _PoolTask, process: Any, conn: Connection) -> bool:
+        '''Runs a task on a worker.  Returns False if the worker was terminated or died and has to be replaced'''
+        try:
+            conn.send((task.fn, task.args, task.kwargs))
+        except (EOFError, OSError) as e:
+            task.future.set_exception(PQException(f'worker process {process.pid} exited: {e}'))
+            return False
+        except Exception as e:
+            # For example, the function or its arguments cannot be pickled
+            task.future.set_exception(e)
+            return True
+        start_time = time.monotonic()
+        while True:
+            try:
+                if conn.poll(self.poll_interval):
+                    succeeded, result = conn.recv()
+                    break
+            except (EOFError, OSError):
+                task.future.set_exception(PQException(f'worker process {process.pid} exited with code: {process.exitcode}'))
+                return False
+            seconds = time.monotonic() - start_time
+            reason = 'worker pool was terminated' if self._terminated else self._limit_exceeded(process.pid, seconds)
+            if reason:
+                rss_mb = _rss_mb(process.pid)
+                process.kill()
+                process.join()
+                _logger.info(f'terminated worker: {process.pid} {reason}')
+                if self._terminated:
+                    task.future.set_exception(PQException(reason))
+                else:
+                    task.future.set_exception(LimitExceededError(reason, seconds, process.pid, rss_mb))
+                return False
+        if succeeded:
+            task.future.set_result(result)
+        else:
+            task.future.set_exception(result)
+        return True
+
+    def _serve(self, worker: tuple[Any, Connection]) -> None:
+        process, conn = worker
+        try:
+            while True:
+                task = self._next_task()
+                if task is None: break
+                if process is None: process, conn = self._replace_worker()
+                if not self._run_task(task, process, conn):
+                    conn.close()
+                    if process.is_alive(): process.kill()
+                    process.join()
+                    process = None
+        finally:
+            if process is not None:
+                try:
+                    conn.send(None)
+                except (EOFError, OSError):
+                    pass
+                process.join(timeout=1)
+                if process.is_alive(): process.kill()
+                conn.close()
+
+    def submit(self, fn: Callable, /, *args: Any, **kwargs: Any) -> concurrent.futures.Future:
+        with self._condition:
+            assert_(not self._shutdown, 'cannot submit after shutdown')
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            self._queue.append(_PoolTask(fn, args, kwargs, future))
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for task in self._queue: task.future.cancel()
+                self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads: thread.join()
+            self._stop_zygote()
+
+    def terminate(self) -> None:
+        '''Cancel tasks that have not started, terminate workers that are running tasks and wait for all workers to exit'''
+        with self._condition:
+            self._terminated = True
+        self.shutdown(wait=True, cancel_futures=True)
+
+    def __exit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        # If the with block raised, for example a KeyboardInterrupt, don't wait for tasks to finish
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.shutdown(wait=True)
+
+
+# Functions used in unit testing
+def _use_memory(mb: float) -> float:
+    import numpy as np
+    array = np.ones(int(mb * 1e6 / 8))
+    time.sleep(10)
+    return float(array.sum())
+
+
+def test_worker_pool() -> None:
+    with WorkerPool(2, timeout_seconds=1) as pool:
+        futures = [pool.submit(time.sleep, seconds) for seconds in [0.1, 30, 0.1]]
+        results = [future.exception() for future in futures]
+        assert_(results[0] is None and results[2] is None and isinstance(results[1], LimitExceededError))
+        assert_(1 <= results[1].seconds < 10 and results[1].pid > 0)  # type: ignore
+        # The worker that was terminated is replaced
+        assert_(sorted(pool.map(abs, [-1, -2, -3, -4])) == [1, 2, 3, 4])
+        
+    # With fork, a worker that replaces a terminated one is forked from the zygote instead of from this process, which has threads running
+    with WorkerPool(1, timeout_seconds=0.5) as pool:
+        assert_(pool.submit(os.getppid).result() == os.getpid())
+        assert_(isinstance(pool.submit(time.sleep, 30).exception(), LimitExceededError))
+        parent_pid = pool.submit(os.getppid).result()
+        assert_(parent_pid != os.getpid() if mp.get_start_method() == 'fork' else parent_pid == os.getpid())
+
+    if memory_limit_supported():
+        max_memory_mb = _rss_mb(os.getpid()) + 200
+        with WorkerPool(1, max_memory_mb=max_memory_mb) as pool:
+            exception = pool.submit(_use_memory, 400).exception()
+            assert_(isinstance(exception, LimitExceededError) and str(exception).startswith('memory'))
+            assert_(pool.submit(abs, -1).result() == 1)
+
+    start_time = time.monotonic()
+    pool = WorkerPool(2)
+    futures = [pool.submit(time.sleep, 30) for _ in range(4)]
+    time.sleep(0.5)
+    pool.terminate()
+    assert_(time.monotonic() - start_time < 10 and all([future.done() for future in futures]))
+    assert_(sum([future.cancelled() for future in futures]) == 2)
+
+
+if __name__ == "__main__":
+    test_worker_pool()
+    import doctest
+    doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+# $$_end_code